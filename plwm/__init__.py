@@ -35,6 +35,7 @@ __all__ = [ 'border',
             'composite',
             'cycle',
             'deltamove',
+            'efilter',
             'event',
             'filters',
             'focus',
@@ -52,7 +52,7 @@ class BorderClient:
         self.border_color = None
         self.border_focuscolor = None
 
-        if self.no_border_clients(self):
+        if cfilter.compiled(self.no_border_clients)(self):
             self.setborderwidth(0)
 
         else:
@@ -60,7 +60,7 @@ class BorderClient:
 
             manager = None
             for f, m in self.border_colors:
-                if f(self):
+                if cfilter.compiled(f)(self):
                     manager = m
                     break
             else:
@@ -53,6 +53,14 @@ Compound filters:
   Or(filter, filter...)   true if any of the filters are true
   Not(filter)             true if the filter is false
 
+Filters can be compiled into a single optimized callable:
+
+  compile(filter)   return a compiled version of filter
+  compiled(filter)  like compile, but caches the result per filter
+
+Compiled filters memoize their results per client, unless they
+contain filters not in this module.
+
 """
 
 import re
@@ -135,3 +143,429 @@ class glob_name(_GlobName, _Resource): pass
 class title(_StringName, _Title): pass
 class re_title(_ReName, _Title): pass
 class glob_title(_GlobName, _Title): pass
+
+
+#
+# Filter compilation
+#
+
+# Compiling a filter flattens nested And and Or filters, removes
+# constant subfilters, turns glob patterns into precompiled regexps
+# and merges several name, title or pattern matches inside an Or into
+# a single dict lookup or regexp.  The subfilters of And and Or are
+# then ordered so cheap checks are made before expensive ones, and
+# finally the tree is turned into nested functions.
+
+# Relative costs of evaluating the filters.  Title filters must fetch
+# the title, which can mean a round trip to the server.  Unknown
+# filters are assumed to be expensive, and are kept in their original
+# order.
+_cost_constant = 0
+_cost_state = 1
+_cost_lookup = 2
+_cost_regexp = 3
+_cost_unknown = 5
+_cost_title = 10
+
+# Regexps with inline flags, named groups, other (?...) extensions or
+# backreferences can change meaning when merged into an alternation,
+# so they are matched on their own
+_unmergeable_re = re.compile(r'\(\?|\\[1-9]')
+
+
+# The client state that filters can depend on.  The resource name
+# and class never change, so filters only depending on them can be
+# memoized for the lifetime of the client.
+DEPENDS_TITLE = 'title'
+DEPENDS_MAPPED = 'mapped'
+
+
+class _Compiled(filters.Filter):
+    """A compiled filter, calling the function generated from SOURCE.
+
+    DEPENDS is a tuple of the mutable client state the filter depends
+    on, or None if the result shouldn't be memoized, e.g. because it
+    contains unknown filters.
+
+    Results are memoized in the filter_cache of the client, which
+    must call Client.invalidate_filter_cache() when the state
+    changes.  The cache is cleared if it grows beyond
+    filter_cache_size entries.
+    """
+
+    def __init__(self, source, func, depends):
+        super(_Compiled, self).__init__()
+        self.source = source
+        self.func = func
+        self.depends = depends
+
+    def __call__(self, c):
+        if self.depends is None:
+            return self.func(c)
+
+        cache = getattr(c, 'filter_cache', None)
+        if cache is None:
+            return self.func(c)
+
+        try:
+            return cache[self]
+        except KeyError:
+            if len(cache) >= filter_cache_size:
+                cache.clear()
+            r = cache[self] = self.func(c)
+            return r
+
+    def __str__(self):
+        return 'compiled(%s)' % str(self.source)
+
+
+class _Match(object):
+    """Intermediate node of merged name or title matches.
+
+    NAMES is a list of exact strings to match, SEARCH a list of
+    regexps to search for, either strings or a single precompiled
+    regexp if the match isn't mergeable, and MATCH a list of regexps
+    which must
+    match the entire string.  If TITLE is true, the client title is
+    matched, otherwise the resource name and class.  If MERGEABLE is
+    false the match must not be merged with others.
+    """
+
+    def __init__(self, title, names = (), search = (), match = (),
+                 mergeable = 1):
+        self.title = title
+        self.names = list(names)
+        self.search = list(search)
+        self.match = list(match)
+        self.mergeable = mergeable
+
+
+def _glob_regexp(pattern):
+    """Return an unanchored regexp string matching the glob PATTERN.
+    """
+    r = fnmatch.translate(pattern)
+
+    # Remove the end anchor and flags, they are added again when
+    # the patterns are merged
+    for suffix in ('\\Z(?ms)', '$'):
+        if r.endswith(suffix):
+            return r[:-len(suffix)]
+    return r
+
+
+def _as_match(f):
+    """Return a _Match equivalent to F, or None if it isn't a
+    mergeable name or title filter.
+    """
+    if not isinstance(f, _NameBase):
+        return None
+
+    if f.pattern is None:
+        return None
+
+    istitle = isinstance(f, _Title)
+    if not istitle and not isinstance(f, _Resource):
+        return None
+
+    if isinstance(f, _StringName):
+        return _Match(istitle, names = [f.pattern])
+    elif isinstance(f, _ReName):
+        # The flags of a precompiled regexp would be lost if its
+        # pattern was merged, so it is searched with as it is
+        if f.pattern.flags:
+            return _Match(istitle, search = [f.pattern], mergeable = 0)
+
+        p = f.pattern.pattern
+        return _Match(istitle, search = [p],
+                      mergeable = _unmergeable_re.search(p) is None)
+    elif isinstance(f, _GlobName):
+        return _Match(istitle, match = [_glob_regexp(f.pattern)])
+    else:
+        return None
+
+
+def _merge_matches(matches, title):
+    r = _Match(title)
+    for m in matches:
+        r.names.extend(m.names)
+        r.search.extend(m.search)
+        r.match.extend(m.match)
+    return r
+
+
+def _optimize(f):
+    """Return an optimized tree equivalent to the filter F.
+    """
+
+    if isinstance(f, filters.Not):
+        sub = _optimize(f.filter)
+        if sub is filters.true:
+            return filters.false
+        elif sub is filters.false:
+            return filters.true
+        elif isinstance(sub, filters.Not):
+            return sub.filter
+        else:
+            return filters.Not(sub)
+
+    if isinstance(f, filters.And):
+        compound = filters.And
+        identity = filters.true
+        absorbing = filters.false
+    elif isinstance(f, filters.Or):
+        compound = filters.Or
+        identity = filters.false
+        absorbing = filters.true
+    else:
+        m = _as_match(f)
+        if m is not None:
+            return m
+        else:
+            return f
+
+    # Flatten nested compound filters of the same kind
+    subs = []
+    for s in f.filters:
+        s = _optimize(s)
+        if s is identity:
+            continue
+        if s is absorbing:
+            return absorbing
+        if isinstance(s, compound):
+            subs.extend(s.filters)
+        else:
+            subs.append(s)
+
+    # Merge the name and title matches of an Or
+    if compound is filters.Or:
+        merged = []
+        resources = []
+        titles = []
+        for s in subs:
+            if isinstance(s, _Match) and s.mergeable:
+                if s.title:
+                    titles.append(s)
+                else:
+                    resources.append(s)
+            else:
+                merged.append(s)
+
+        if resources:
+            merged.append(_merge_matches(resources, 0))
+        if titles:
+            merged.append(_merge_matches(titles, 1))
+        subs = merged
+
+    # Cheap checks first.  The sort is stable, so filters of the same
+    # cost keep their order.
+    decorated = [(_cost(s), i, s) for i, s in zip(range(len(subs)), subs)]
+    decorated.sort()
+    subs = [s for c, i, s in decorated]
+
+    if not subs:
+        return identity
+    elif len(subs) == 1:
+        return subs[0]
+    else:
+        r = compound()
+        r.filters = tuple(subs)
+        return r
+
+
+def _cost(f):
+    if f is filters.true or f is filters.false:
+        return _cost_constant
+    elif f is is_client or f is mapped or f is iconified:
+        return _cost_state
+    elif isinstance(f, _Match):
+        if f.title:
+            return _cost_title
+        elif f.search or f.match:
+            return _cost_regexp
+        else:
+            return _cost_lookup
+    elif isinstance(f, filters.Not):
+        return _cost(f.filter)
+    elif isinstance(f, (filters.And, filters.Or)):
+        return max([_cost(s) for s in f.filters])
+    else:
+        return _cost_unknown
+
+
+def _dependencies(f):
+    """Return a dict of the mutable client state the optimized tree F
+    depends on, or None if it contains unknown filters.
+    """
+
+    if f is filters.true or f is filters.false or f is is_client:
+        return {}
+    elif f is mapped or f is iconified:
+        return {DEPENDS_MAPPED: 1}
+    elif isinstance(f, _Match):
+        if f.title:
+            return {DEPENDS_TITLE: 1}
+        else:
+            return {}
+    elif isinstance(f, _Compiled):
+        if f.depends is None:
+            return None
+        deps = {}
+        for d in f.depends:
+            deps[d] = 1
+        return deps
+    elif isinstance(f, filters.Not):
+        return _dependencies(f.filter)
+    elif isinstance(f, (filters.And, filters.Or)):
+        deps = {}
+        for s in f.filters:
+            d = _dependencies(s)
+            if d is None:
+                return None
+            deps.update(d)
+        return deps
+    else:
+        return None
+
+
+def _generate(f):
+    """Return a function evaluating the optimized tree F.
+    """
+
+    if f is filters.true:
+        return lambda c: True
+    elif f is filters.false:
+        return lambda c: False
+    elif f is is_client:
+        return lambda c: isinstance(c, wmanager.Client)
+    elif f is mapped:
+        return lambda c: c.is_mapped()
+    elif f is iconified:
+        return lambda c: not c.is_mapped()
+
+    elif isinstance(f, _Match):
+        return _generate_match(f)
+
+    elif isinstance(f, filters.Not):
+        sub = _generate(f.filter)
+        return lambda c, sub = sub: not sub(c)
+
+    elif isinstance(f, filters.And):
+        subs = tuple([_generate(s) for s in f.filters])
+        if len(subs) == 2:
+            f1, f2 = subs
+            return lambda c, f1 = f1, f2 = f2: bool(f1(c) and f2(c))
+
+        def and_filter(c, subs = subs):
+            for s in subs:
+                if not s(c):
+                    return False
+            return True
+        return and_filter
+
+    elif isinstance(f, filters.Or):
+        subs = tuple([_generate(s) for s in f.filters])
+        if len(subs) == 2:
+            f1, f2 = subs
+            return lambda c, f1 = f1, f2 = f2: bool(f1(c) or f2(c))
+
+        def or_filter(c, subs = subs):
+            for s in subs:
+                if s(c):
+                    return True
+            return False
+        return or_filter
+
+    else:
+        return f
+
+
+def _generate_match(m):
+    if m.names:
+        names = {}
+        for n in m.names:
+            names[n] = 1
+    else:
+        names = None
+
+    if len(m.search) == 1:
+        search = re.compile(m.search[0]).search
+    elif m.search:
+        search = re.compile('|'.join(['(?:%s)' % r for r in m.search])).search
+    else:
+        search = None
+
+    if m.match:
+        match = re.compile('(?:%s)\\Z' % '|'.join(['(?:%s)' % r for r in m.match]),
+                           re.DOTALL).match
+    else:
+        match = None
+
+    def check(s, names = names, search = search, match = match):
+        if s is None:
+            return False
+        if names is not None and names.has_key(s):
+            return True
+        if search is not None and search(s) is not None:
+            return True
+        if match is not None and match(s) is not None:
+            return True
+        return False
+
+    if m.title:
+        return lambda c, check = check: check(c.get_title())
+    else:
+        return lambda c, check = check: check(c.res_name) or check(c.res_class)
+
+
+def compile(filter, memoize = 1):
+    """Return a filter equivalent to FILTER, but compiled into a single
+    function which is faster to evaluate.
+
+    Unknown filters in FILTER are called as they are, but may be
+    reordered after cheaper checks.
+
+    If MEMOIZE is true and FILTER doesn't contain unknown filters,
+    the results are memoized per client.  This should only be done
+    for long-lived filters, e.g. those configured in class
+    attributes, as each memoizing filter takes up an entry in the
+    cache of every client it is called for.
+    """
+
+    tree = _optimize(filter)
+    deps = None
+    if memoize:
+        deps = _dependencies(tree)
+        if deps is not None:
+            deps = tuple(deps.keys())
+    return _Compiled(filter, _generate(tree), deps)
+
+
+# Map (filter, memoize) to the compiled filters.  The cache is cleared
+# when it grows beyond compiled_cache_size, to not keep short-lived
+# filters forever.
+_compiled_filters = {}
+compiled_cache_size = 256
+
+# The most memoized filter results kept per client
+filter_cache_size = 64
+
+def compiled(filter, memoize = 1):
+    """Return compile(FILTER, MEMOIZE), only compiling each filter
+    once.
+
+    Functions and other callables which aren't Filter objects are
+    returned as they are.
+    """
+
+    if not isinstance(filter, filters.Filter):
+        return filter
+
+    key = (filter, memoize)
+    try:
+        return _compiled_filters[key]
+    except KeyError:
+        if len(_compiled_filters) >= compiled_cache_size:
+            _compiled_filters.clear()
+
+        c = _compiled_filters[key] = compile(filter, memoize)
+        return c
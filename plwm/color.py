@@ -20,6 +20,10 @@
 
 import types
 
+from Xlib import error
+from Xlib.protocol import request
+from Xlib.xobject import colormap
+
 class ColorError(Exception): pass
 
 
@@ -42,24 +46,68 @@ class Color:
         except KeyError:
             pass
 
-        if type(color) is types.StringType:
-            col = self.color_map.alloc_named_color(color)
-        elif type(color) is types.TupleType and len(color) == 3:
-            col = self.color_map.alloc_color(color[0], color[1], color[2])
-        else:
-            raise TypeError("string or 3-tuple expected")
+        return self.get_colors([color], default)[0]
 
-        # If color allocation fails and there is a default color, simply
-        # recurse to try to allocate it
-        if col is None:
-            if default:
-                return self.get_color(default)
+    def get_colors(self, colors, default = None):
+        """Return a list of the pixel values corresponding to the
+        list COLORS, each in the same format as for get_color().
+
+        All colors that haven't been allocated yet are allocated
+        with a single round trip to the server, so this should be
+        preferred over several calls to get_color().
+
+        If a color can't be found and DEFAULT is provided, that color
+        is used instead.
+        """
+
+        # Send all allocation requests before waiting for any reply
+        pending = []
+        requested = {}
+        for color in colors:
+            if self.color_alloced.has_key(color) or requested.has_key(color):
+                continue
+            requested[color] = 1
+
+            rgb = parse_color(color)
+            if rgb is None:
+                req = request.AllocNamedColor(display = self.color_map.display,
+                                              defer = 1,
+                                              cmap = self.color_map.id,
+                                              name = color)
             else:
-                raise ColorError(color)
-        else:
-            self.color_alloced[color] = col.pixel
+                req = request.AllocColor(display = self.color_map.display,
+                                         defer = 1,
+                                         cmap = self.color_map.id,
+                                         red = rgb[0],
+                                         green = rgb[1],
+                                         blue = rgb[2])
+            pending.append((color, req))
+
+        for color, req in pending:
+            try:
+                req.reply()
+            except error.BadName:
+                continue
+            self.color_alloced[color] = req.pixel
 
-        return self.color_alloced[color]
+        pixels = []
+        for color in colors:
+            try:
+                pixels.append(self.color_alloced[color])
+            except KeyError:
+                # If color allocation fails and there is a default
+                # color, simply recurse to try to allocate it
+                if default:
+                    pixels.append(self.get_color(default))
+                else:
+                    raise ColorError(color)
+
+        return pixels
+
+    def color_count(self):
+        """Return the number of colors allocated on this screen.
+        """
+        return len(self.color_alloced)
 
     def get_color_res(self, res_name, res_class, default = None):
         """Return the pixel value for the color defined in
@@ -74,3 +122,25 @@ class Color:
 
         return self.get_color(col, default)
 
+
+def parse_color(color):
+    """Return COLOR as an (r, g, b) tuple if it is a tuple or an
+    #rgb string, or None if it is a color name to be looked up by
+    the server.
+    """
+
+    if type(color) is types.TupleType and len(color) == 3:
+        return color
+
+    if type(color) is not types.StringType:
+        raise TypeError("string or 3-tuple expected")
+
+    for r in colormap.rgb_res:
+        m = r.match(color)
+        if m:
+            rgb = []
+            for s in m.groups():
+                rgb.append(int(s + '0' * (4 - len(s)), 16))
+            return tuple(rgb)
+
+    return None
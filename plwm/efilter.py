@@ -0,0 +1,75 @@
+#
+# efilter.py -- Event filter functions
+#
+#    Copyright (C) 2009  Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""plwm.efilter contains classes which can be used to create event
+filters, used as predicates when adding handlers to an
+event.Dispatcher.
+
+A filter is called with one argument, an event object.  The return
+value is true or false, depending on how the filter evaluated for the
+event.
+
+The filters in this module declare which events they can match, which
+allows the dispatcher to only evaluate them for relevant events.
+
+Simple filter functions:
+
+  true, all     always true
+  false, none   always false
+
+Functions matching event fields:
+
+  event_type(type...)    true if the event type is one of the types
+  window(window...)      true if the event window is one of the windows
+
+Compound filters:
+
+  And(filter, filter...)  true if all the filters are true
+  Or(filter, filter...)   true if any of the filters are true
+  Not(filter)             true if the filter is false
+
+"""
+
+import filters
+
+from filters import true, all, false, none, And, Or, Not
+
+
+class event_type(filters.Filter):
+    def __init__(self, *types):
+        super(event_type, self).__init__()
+        self.event_types = types
+
+    def __call__(self, evt):
+        return getattr(evt, 'type', None) in self.event_types
+
+    def __str__(self):
+        return 'event_type(%s)' % ', '.join(map(str, self.event_types))
+
+
+class window(filters.Filter):
+    def __init__(self, *windows):
+        super(window, self).__init__()
+        self.event_windows = windows
+
+    def __call__(self, evt):
+        return getattr(evt, 'window', None) in self.event_windows
+
+    def __str__(self):
+        return 'window(%s)' % ', '.join(map(str, self.event_windows))
@@ -22,6 +22,9 @@ import time
 import select
 import errno
 import traceback
+import heapq
+import os
+import collections
 
 from Xlib import X
 
@@ -55,6 +58,13 @@ class Dispatcher(object):
     and do their own cleanup.
 
 
+    Handlers are indexed on the event types, and optionally event
+    windows, that their predicates declare that they can match (see
+    plwm.filters and plwm.efilter).  Predicates are then only called
+    for events they can match.  Predicates without declarations, e.g.
+    plain functions, are called for all events.
+
+
     Within a dispatcher all handlers matching a predicate will be
     called in some undefined order.  If you think you need to enforce
     a specific order among the handlers, that really means that the
@@ -89,12 +99,30 @@ class Dispatcher(object):
         if lower_dispatcher is not None:
             lower_dispatcher.higher_dispatcher = self
 
-        # For now the trivial implementation:
-        # list of (predicate, handler) pairs
-        self.handlers = []
+        # Map (predicate, handler) pairs to their sequence number,
+        # which gives the order they were added in
+        self.handlers = {}
+        self.sequence = 0
 
-        # Map groups to list of (predicate, handler) pairs
+        # Map groups to dicts of (predicate, handler) pairs, and each
+        # grouped pair to its group
         self.groups = {}
+        self.item_groups = {}
+
+        # Map handlers to dicts of their (predicate, handler) pairs
+        self.handler_items = {}
+
+        # Map event types, or (event type, window) tuples, to buckets
+        # of (predicate, handler) pairs whose predicate declares that
+        # it can match those events.
+        self.index = {}
+
+        # Bucket of (predicate, handler) pairs which can match any event
+        self.fallback = _HandlerBucket()
+
+        # Map (predicate, handler) pairs to their index keys, or None
+        # for the fallback pairs
+        self.item_keys = {}
 
 
     def add_handler(self, handler, predicate, group = None):
@@ -114,14 +142,22 @@ class Dispatcher(object):
         """
 
         item = (predicate, handler)
-        if item not in self.handlers:
-            self.handlers.append(item)
+        if not self.handlers.has_key(item):
+            self.handlers[item] = self.sequence
+            self.sequence += 1
+            self._index_item(item)
+
+            try:
+                self.handler_items[handler][item] = None
+            except KeyError:
+                self.handler_items[handler] = { item: None }
 
             if group is not None:
                 try:
-                    self.groups[group].append(item)
+                    self.groups[group][item] = None
                 except KeyError:
-                    self.groups[group] = [item]
+                    self.groups[group] = { item: None }
+                self.item_groups[item] = group
 
 
     def remove_handler(self, handler, predicate = None):
@@ -136,21 +172,24 @@ class Dispatcher(object):
         identity when being removed.
         """
 
-        i = 0
-        while i < len(self.handlers):
-            p2, h2 = item = self.handlers[i]
+        items = self.handler_items.get(handler)
+        if not items:
+            return
+
+        if predicate is None:
+            remove = items.keys()
+        elif items.has_key((predicate, handler)):
+            remove = [(predicate, handler)]
+        else:
+            return
 
-            if handler == h2 and (predicate is None or predicate == p2):
-                del self.handlers[i]
+        for item in remove:
+            self._remove_item(item)
 
-                # Also remove from any groups
-                for group_handlers in self.groups.itervalues():
-                    try:
-                        group_handlers.remove(item)
-                    except ValueError:
-                        pass
-            else:
-                i += 1
+            # Also remove from its group, if any
+            group = self.item_groups.pop(item, None)
+            if group is not None:
+                del self.groups[group][item]
 
 
     def remove_group(self, group):
@@ -163,18 +202,103 @@ class Dispatcher(object):
             self.higher_dispatcher.remove_group(group)
             
         try:
-            group_handlers = self.groups[group]
+            group_handlers = self.groups.pop(group)
         except KeyError:
             return
 
-        i = 0
-        while i < len(self.handlers):
-            if self.handlers[i] in group_handlers:
-                del self.handlers[i]
+        for item in group_handlers:
+            del self.item_groups[item]
+            self._remove_item(item)
+
+
+    def _remove_item(self, item):
+        del self.handlers[item]
+        self._unindex_item(item)
+
+        handler = item[1]
+        items = self.handler_items[handler]
+        del items[item]
+        if not items:
+            del self.handler_items[handler]
+
+
+    def _index_item(self, item):
+        predicate = item[0]
+        types = getattr(predicate, 'event_types', None)
+        windows = getattr(predicate, 'event_windows', None)
+        seq = self.handlers[item]
+
+        if types is None:
+            keys = None
+            self.fallback.add(item, seq)
+        else:
+            if windows is None:
+                keys = types
             else:
-                i += 1
-    
-        del self.groups[group]
+                keys = [(t, w) for t in types for w in windows]
+
+            # Don't add the handler twice to the same bucket
+            keys = dict.fromkeys(keys).keys()
+
+            for k in keys:
+                try:
+                    self.index[k].add(item, seq)
+                except KeyError:
+                    bucket = self.index[k] = _HandlerBucket()
+                    bucket.add(item, seq)
+
+        self.item_keys[item] = keys
+
+
+    def _unindex_item(self, item):
+        keys = self.item_keys.pop(item)
+
+        if keys is None:
+            self.fallback.remove(item)
+        else:
+            for k in keys:
+                bucket = self.index[k]
+                bucket.remove(item)
+                if not bucket:
+                    del self.index[k]
+
+
+    def _candidates(self, event):
+        """Return the (predicate, handler) pairs which can match EVENT,
+        in the order they were added.
+        """
+
+        etype = getattr(event, 'type', None)
+        if etype is None or not self.index:
+            return self.fallback.ordered()
+
+        buckets = []
+
+        bucket = self.index.get(etype)
+        if bucket is not None:
+            buckets.append(bucket)
+
+        window = getattr(event, 'window', None)
+        if window is not None:
+            bucket = self.index.get((etype, window))
+            if bucket is not None:
+                buckets.append(bucket)
+
+        if not buckets:
+            return self.fallback.ordered()
+
+        if self.fallback:
+            buckets.append(self.fallback)
+
+        if len(buckets) == 1:
+            return buckets[0].ordered()
+
+        # Merge the buckets, restoring the order the handlers were added
+        items = []
+        for b in buckets:
+            items.extend(b.sequenced())
+        items.sort()
+        return [item for n, item in items]
 
 
     NO_MATCH = 0
@@ -217,7 +341,12 @@ class Dispatcher(object):
         # They didn't handle it, so we get a shot at it
         result = Dispatcher.NO_MATCH
 
-        for predicate, handler in self.handlers:
+        for item in self._candidates(event):
+            # Skip handlers removed by previous handlers
+            if not self.handlers.has_key(item):
+                continue
+
+            predicate, handler = item
             if catch_exceptions:
                 try:
                     c = predicate(event)
@@ -262,6 +391,45 @@ class Dispatcher(object):
             self.higher_dispatcher.lower_dispatcher = self.lower_dispatcher
     
 
+
+class _HandlerBucket:
+    """A set of (predicate, handler) pairs in a Dispatcher, which
+    can be iterated over in the order the pairs were added.
+    """
+
+    def __init__(self):
+        # Map pairs to sequence numbers
+        self.items = {}
+
+        # Cached list of the pairs, sorted on sequence number
+        self.ordered_items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item, seq):
+        self.items[item] = seq
+
+        # Pairs are added with increasing sequence numbers, so the
+        # cached list stays sorted
+        if self.ordered_items is not None:
+            self.ordered_items.append(item)
+
+    def remove(self, item):
+        del self.items[item]
+        self.ordered_items = None
+
+    def ordered(self):
+        if self.ordered_items is None:
+            items = self.sequenced()
+            items.sort()
+            self.ordered_items = [item for n, item in items]
+        return self.ordered_items
+
+    def sequenced(self):
+        return [(n, item) for item, n in self.items.iteritems()]
+
+
 class BottomDispatcher(Dispatcher):
     """
     The bottom dispatcher class, which have additional methods for
@@ -424,6 +592,9 @@ def new_event_type():
 
 
 class TimerEvent:
+    # The TimerQueue this timer is waiting in, if any
+    _queue = None
+
     def __init__(self, event_type, after = 0, at = 0):
         self.type = event_type
         if at > 0:
@@ -434,6 +605,11 @@ class TimerEvent:
     def cancel(self):
         self.time = None
 
+        # Tell the queue that it now holds a dead entry
+        if self._queue is not None:
+            self._queue.timer_cancelled(self)
+            self._queue = None
+
     def str(self):
         if self.time is None:
             return '<%s cancelled>' % self.__class__.__name__
@@ -441,6 +617,88 @@ class TimerEvent:
             return '<%s at %d in %d seconds>' % (self.__class__.__name__, self.time,
                                                  time.time() - self.time)
 
+
+class TimerQueue:
+    """Priority queue of TimerEvents, ordered on their expiry time.
+
+    Timers are kept in a heap, so adding a timer and removing the
+    first one is O(log n).  Cancelled timers are not removed when
+    cancelled, but are skipped when they reach the head of the queue.
+    If too many of them accumulate the heap is compacted.
+    """
+
+    # Compact the heap when at least this many timers are cancelled,
+    # and they make up more than half of the heap.
+    compact_threshold = 32
+
+    def __init__(self):
+        # Heap of [time, sequence number, timer] entries.  The
+        # sequence number keeps timers with equal times in the order
+        # they were added, and ensures that TimerEvents are never
+        # compared.
+        self.heap = []
+        self.sequence = 0
+        self.cancelled = 0
+        self.compactions = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def add(self, timer):
+        """Add TIMER to the queue.
+        """
+        heapq.heappush(self.heap, [timer.time, self.sequence, timer])
+        self.sequence = self.sequence + 1
+        timer._queue = self
+
+    def first(self):
+        """Return the first uncancelled timer, or None if the queue
+        is empty.  The timer is not removed from the queue.
+        """
+        while self.heap:
+            timer = self.heap[0][2]
+            if timer.time is not None:
+                return timer
+
+            heapq.heappop(self.heap)
+            self.cancelled = self.cancelled - 1
+
+        return None
+
+    def pop(self):
+        """Remove and return the first uncancelled timer, or None if
+        the queue is empty.
+        """
+        timer = self.first()
+        if timer is not None:
+            heapq.heappop(self.heap)
+            timer._queue = None
+        return timer
+
+    def timer_cancelled(self, timer):
+        """Called by TIMER when it is cancelled while in the queue.
+        """
+        self.cancelled = self.cancelled + 1
+        if (self.cancelled >= self.compact_threshold
+            and 2 * self.cancelled > len(self.heap)):
+            self.compact()
+
+    def compact(self):
+        """Remove all cancelled timers from the heap.
+        """
+        self.heap = [e for e in self.heap if e[2].time is not None]
+        heapq.heapify(self.heap)
+        self.cancelled = 0
+        self.compactions = self.compactions + 1
+
+    def pending(self):
+        """Return a list of all uncancelled timers, earliest first.
+        """
+        entries = [e for e in self.heap if e[2].time is not None]
+        entries.sort()
+        return [e[2] for e in entries]
+
+
 class FileEvent:
     READ = 1
     WRITE = 2
@@ -461,18 +719,27 @@ class FileEvent:
         self.state = 0
         self.unhandled = 0
 
+        # The EventFetcher watching this file, if any
+        self._fetcher = None
+
     def fileno(self):
         return self.file.fileno()
 
     def cancel(self):
         self.file = None
 
+        if self._fetcher is not None:
+            self._fetcher.remove_file(self)
+
     def set_mode(self, newmode = None, set = 0, clear = 0):
         if newmode is not None:
             self.mode = newmode
 
         self.mode = (self.mode | set) & ~clear
 
+        if self._fetcher is not None:
+            self._fetcher.update_file(self)
+
     def str(self):
         if self.file is None:
             return '<%s cancelled>' % self.__class__.__name__
@@ -487,13 +754,386 @@ class FileEvent:
 
             return '<%s for %s mode %s>' % (self.__class__.__name__, self.file, mode)
 
+
+class Multiplexer:
+    """Base class for the I/O multiplexers used by EventFetcher.
+
+    A multiplexer keeps a persistent registration of file descriptors
+    and the FileEvent modes they are watched for.  The registration
+    is only changed by calls to set(), so waiting doesn't have to
+    rebuild it.
+    """
+
+    # Reported by wait() for file descriptors which no longer are open
+    INVALID = 8
+
+    def set(self, fd, mode):
+        """Watch FD for MODE, a mask of FileEvent.READ, WRITE and
+        EXCEPTION.  If MODE is 0, stop watching FD.
+        """
+        raise NotImplementedError('%s.set()' % self.__class__.__name__)
+
+    def wait(self, timeout = None):
+        """Wait for at most TIMEOUT seconds, or indefinitely if None,
+        for any watched file descriptor to become ready.
+
+        Returns a list of (fd, mode) tuples, where mode is a mask of
+        the ready FileEvent modes or INVALID.  The list is empty if
+        the wait timed out.
+        """
+        raise NotImplementedError('%s.wait()' % self.__class__.__name__)
+
+
+class SelectMultiplexer(Multiplexer):
+    """Multiplexer using select(), available everywhere.
+    """
+
+    def __init__(self):
+        self.modes = {}
+        self.lists = None
+
+    def set(self, fd, mode):
+        if mode:
+            self.modes[fd] = mode
+        else:
+            try:
+                del self.modes[fd]
+            except KeyError:
+                pass
+
+        # Rebuild the select lists on the next wait
+        self.lists = None
+
+    def wait(self, timeout = None):
+        if self.lists is None:
+            read = []
+            write = []
+            exc = []
+            for fd, mode in self.modes.items():
+                if mode & FileEvent.READ:
+                    read.append(fd)
+                if mode & FileEvent.WRITE:
+                    write.append(fd)
+                if mode & FileEvent.EXCEPTION:
+                    exc.append(fd)
+            self.lists = read, write, exc
+
+        read, write, exc = self.lists
+
+        try:
+            if timeout is None:
+                readable, writable, excable = select.select(read, write, exc)
+            else:
+                readable, writable, excable = select.select(read, write, exc,
+                                                            timeout)
+        except select.error, val:
+            if val[0] != errno.EBADF:
+                raise
+
+            # Some file has been closed without being removed, find it
+            ready = []
+            for fd in self.modes.keys():
+                try:
+                    os.fstat(fd)
+                except OSError:
+                    ready.append((fd, Multiplexer.INVALID))
+            return ready
+
+        ready = {}
+        for fd in readable:
+            ready[fd] = FileEvent.READ
+        for fd in writable:
+            ready[fd] = ready.get(fd, 0) | FileEvent.WRITE
+        for fd in excable:
+            ready[fd] = ready.get(fd, 0) | FileEvent.EXCEPTION
+
+        return ready.items()
+
+
+class PollMultiplexer(Multiplexer):
+    """Multiplexer using poll(), where available.
+    """
+
+    def __init__(self):
+        self.poll = select.poll()
+        self.fds = {}
+
+    def set(self, fd, mode):
+        if mode:
+            events = 0
+            if mode & FileEvent.READ:
+                events = events | select.POLLIN
+            if mode & FileEvent.WRITE:
+                events = events | select.POLLOUT
+            if mode & FileEvent.EXCEPTION:
+                events = events | select.POLLPRI
+
+            self.poll.register(fd, events)
+            self.fds[fd] = mode
+
+        elif self.fds.has_key(fd):
+            del self.fds[fd]
+            self.poll.unregister(fd)
+
+    def wait(self, timeout = None):
+        if timeout is None:
+            result = self.poll.poll()
+        else:
+            result = self.poll.poll(int(timeout * 1000 + 0.5))
+
+        ready = []
+        for fd, events in result:
+            if events & select.POLLNVAL:
+                ready.append((fd, Multiplexer.INVALID))
+                continue
+
+            # Mimic select(), where hangups and errors make a file
+            # readable and writable
+            mode = 0
+            if events & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                mode = mode | FileEvent.READ
+            if events & (select.POLLOUT | select.POLLERR):
+                mode = mode | FileEvent.WRITE
+            if events & select.POLLPRI:
+                mode = mode | FileEvent.EXCEPTION
+
+            ready.append((fd, mode & self.fds.get(fd, 0)))
+
+        return ready
+
+
+class EpollMultiplexer(Multiplexer):
+    """Multiplexer using epoll, available on Linux.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.fds = {}
+
+    def set(self, fd, mode):
+        if mode:
+            events = 0
+            if mode & FileEvent.READ:
+                events = events | select.EPOLLIN
+            if mode & FileEvent.WRITE:
+                events = events | select.EPOLLOUT
+            if mode & FileEvent.EXCEPTION:
+                events = events | select.EPOLLPRI
+
+            if self.fds.has_key(fd):
+                try:
+                    self.epoll.modify(fd, events)
+                except (IOError, OSError), val:
+                    # The file was closed and the kernel forgot about
+                    # it, and its descriptor has now been reused
+                    if val.errno != errno.ENOENT:
+                        raise
+                    self.epoll.register(fd, events)
+            else:
+                self.epoll.register(fd, events)
+            self.fds[fd] = mode
+
+        elif self.fds.has_key(fd):
+            del self.fds[fd]
+
+            # The kernel has already forgotten closed files
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError):
+                pass
+
+    def wait(self, timeout = None):
+        if timeout is None:
+            timeout = -1
+
+        ready = []
+        for fd, events in self.epoll.poll(timeout):
+            mode = 0
+            if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                mode = mode | FileEvent.READ
+            if events & (select.EPOLLOUT | select.EPOLLERR):
+                mode = mode | FileEvent.WRITE
+            if events & select.EPOLLPRI:
+                mode = mode | FileEvent.EXCEPTION
+
+            ready.append((fd, mode & self.fds.get(fd, 0)))
+
+        return ready
+
+
+def default_multiplexer():
+    """Return a new multiplexer object of the most efficient kind
+    available on this system.
+    """
+
+    if hasattr(select, 'epoll'):
+        return EpollMultiplexer()
+    elif hasattr(select, 'poll'):
+        return PollMultiplexer()
+    else:
+        return SelectMultiplexer()
+
+
+
+class EventCoalescer:
+    """Collapse superseded X events in a burst of events.
+
+    For each (window, event type) only the last MotionNotify and
+    ConfigureNotify event is kept, and consecutive Expose events are
+    merged into one covering the bounding box of all exposed areas.
+    The surviving event keeps the position of the last one it
+    replaces.
+
+    Events are only coalesced over other coalescable events: any
+    other event for the same window, e.g. a ButtonRelease, keeps the
+    events before it intact.
+
+    ConfigureNotify events also carry the stacking order, so they are
+    only merged if they have the same above_sibling, and a window
+    restacked above another one keeps the earlier ConfigureNotify
+    events of that sibling.
+    """
+
+    default_types = (X.MotionNotify, X.ConfigureNotify, X.Expose)
+
+    def __init__(self, types = None):
+        """Create a coalescer for the X event TYPES, by default
+        MotionNotify, ConfigureNotify and Expose.
+        """
+
+        if types is None:
+            types = self.default_types
+
+        self.types = {}
+        for t in types:
+            self.enable(t)
+
+        # Map event types to number of dropped events
+        self.dropped = {}
+
+    def enable(self, event_type):
+        """Start coalescing events of EVENT_TYPE.
+        """
+        if event_type not in self.default_types:
+            raise ValueError('can\'t coalesce event type %s' % event_type)
+        self.types[event_type] = 1
+
+    def disable(self, event_type):
+        """Stop coalescing events of EVENT_TYPE.
+        """
+        try:
+            del self.types[event_type]
+        except KeyError:
+            pass
+
+    def dropped_events(self):
+        """Return the total number of dropped events.
+        """
+        n = 0
+        for c in self.dropped.values():
+            n = n + c
+        return n
+
+    def coalesce(self, events):
+        """Return a list of EVENTS with superseded events removed.
+        """
+
+        result = []
+        dropped = 0
+
+        # Map (type, window, event window, above sibling) to the index
+        # in result of the last event with that key
+        pending = {}
+
+        for e in events:
+            window = getattr(e, 'window', None)
+
+            if not self.types.has_key(e.type):
+                # Don't coalesce anything over this event
+                if window is not None and pending:
+                    for key in pending.keys():
+                        if key[1] == window or key[2] == window:
+                            del pending[key]
+
+                result.append(e)
+                continue
+
+            # ConfigureNotify can be reported both to the window and
+            # its parent, so also key on the event window
+            above = getattr(e, 'above_sibling', None)
+            key = (e.type, window, getattr(e, 'event', None), above)
+
+            # The position of the sibling matters for this event
+            if above and pending:
+                for k in pending.keys():
+                    if k[0] == X.ConfigureNotify and k[1] == above:
+                        del pending[k]
+
+            i = pending.get(key)
+            if i is not None:
+                if e.type == X.Expose:
+                    self.merge_expose(e, result[i])
+
+                result[i] = None
+                dropped = dropped + 1
+                self.dropped[e.type] = self.dropped.get(e.type, 0) + 1
+
+            pending[key] = len(result)
+            result.append(e)
+
+        if dropped:
+            return [e for e in result if e is not None]
+        else:
+            return result
+
+    def merge_expose(self, e, old):
+        """Extend the area of Expose event E to also cover the area of
+        the earlier Expose event OLD.
+        """
+
+        x1 = min(e.x, old.x)
+        y1 = min(e.y, old.y)
+        x2 = max(e.x + e.width, old.x + old.width)
+        y2 = max(e.y + e.height, old.y + old.height)
+
+        e.x = x1
+        e.y = y1
+        e.width = x2 - x1
+        e.height = y2 - y1
+
+
 class EventFetcher:
-    def __init__(self, display):
+    def __init__(self, display, multiplexer = None):
+        """Create an EventFetcher for DISPLAY.
+
+        MULTIPLEXER is the Multiplexer object used to wait for the
+        display and files.  If None, the best one available on this
+        system is used.
+        """
+
         self.display = display
-        self.timers = []
-        self.events = []
-        self.x_events = []
-        self.files = []
+        self.timers = TimerQueue()
+
+        # Synthetic events and read but unprocessed X events
+        self.events = collections.deque()
+        self.x_events = collections.deque()
+
+        # Map file descriptors to FileEvents
+        self.files = {}
+
+        if multiplexer is None:
+            multiplexer = default_multiplexer()
+        self.multiplexer = multiplexer
+
+        self.display_fd = display.fileno()
+        self.multiplexer.set(self.display_fd, FileEvent.READ)
+
+        # EventCoalescer for X event bursts, or None to pass all
+        # events through
+        self.coalescer = None
+
+        # Number of events dropped by latest_motion()
+        self.dropped_motion = 0
 
     def iter_events(self):
         """Return an iterator generating events indefinitely."""
@@ -507,21 +1147,21 @@ class EventFetcher:
         while 1:
             # First return synthetic events
             if self.events:
-                e = self.events[0]
-                del self.events[0]
+                e = self.events.popleft()
 
                 # If e is an FileEvent, move unhandled to event state
+                # and start watching it for all modes again
                 if isinstance(e, FileEvent):
                     e.state = e.unhandled
                     e.unhandled = 0
+                    if e._fetcher is self:
+                        self.update_file(e)
 
                 return e
 
             # Return any read but unprocessed X events
             if self.x_events:
-                xe = self.x_events[0]
-                del self.x_events[0]
-                return xe
+                return self.x_events.popleft()
 
             # Attempt to read any events, and if there are any return the first
             xe = self._read_x_events()
@@ -536,29 +1176,19 @@ class EventFetcher:
 
             to = None
             # See if we have to wait for a timer
-            while self.timers:
-                te = self.timers[0]
-
-                # Is this timer canceled?
-                if te.time is None:
-                    del self.timers[0]
-                    continue
-
+            te = self.timers.first()
+            if te is not None:
                 to = te.time
 
                 # This timer has already timed out, so return it
                 if to <= now:
-                    del self.timers[0]
-                    return te
+                    return self.timers.pop()
 
                 # Is the general event timeout earlier than this timer?
                 if timeout is not None and to > (timeout + now):
                     to = timeout + now
                     te = None
 
-                # Break the loop, as we have found a valid timer
-                break
-
 
             # Do we have a general event timeout?
             if to is None and timeout is not None:
@@ -567,76 +1197,28 @@ class EventFetcher:
 
             # Loop until we return an event
             while 1:
-                # Wait for X data or a timeout
-                read = [self.display]
-                write = []
-                exc = []
-
-                # Iterate over all files, removing closed and cancelled.
-                # The other are added to the corresponding lists
-
-                i = 0
-                while i < len(self.files):
-                    f = self.files[i]
-
-                    # FileEvent has been cancelled
-                    if f.file is None:
-                        del self.files[i]
-
-                    # Uncancelled file event
-                    else:
-
-                        # Try to get the fileno, in an attempt to
-                        # find closed but uncancelled files, so we
-                        # can remove them.
-                        try:
-                            f.fileno()
-                        except ValueError:
-                            del self.files[i]
-
-                        # Seems to be an open file, add it
-                        else:
-
-                            # Get the interested, as yet not recieved, modes
-                            m = f.mode & ~f.unhandled
-
-                            if m & FileEvent.READ:
-                                read.append(f)
-                            if m & FileEvent.WRITE:
-                                write.append(f)
-                            if m & FileEvent.EXCEPTION:
-                                exc.append(f)
-
-                            i = i + 1
-
-                # Wrap select() in a loop, so that EINTRS are ignored
-                # correctly
+                # Wait for X data or a timeout.  Wrap the wait in a
+                # loop, so that EINTRS are ignored correctly
 
                 while 1:
                     try:
                         if to is None:
-                            readable, writable, excable = select.select(read, write, exc)
+                            ready = self.multiplexer.wait()
                         else:
-                            wait = max(to - time.time(), 0)
-                            readable, writable, excable = select.select(read, write, exc, wait)
-                    except select.error, val:
+                            ready = self.multiplexer.wait(max(to - time.time(), 0))
+                    except (select.error, IOError, OSError), val:
                         if val[0] != errno.EINTR:
-                            raise val
+                            raise
                     else:
                         break
 
                 # We have timed out, return the timer event or None
-                if not readable and not writable and not excable:
-                    # Delete the timed out timer
+                if not ready:
+                    # A timer has expired, or been cancelled while
+                    # waiting.  Break the inner while loop to let the
+                    # timer queue sort it out.
                     if te is not None:
-                        del self.timers[0]
-                        # Don't return canceled timers
-                        if te.time is not None:
-                            return te
-
-                        # break the inner while loop to find another timer
-                        else:
-                            break
+                        break
                     else:
                         return None
 
@@ -646,27 +1228,29 @@ class EventFetcher:
 
                 xe = None
 
-                for f in readable:
+                for fd, mode in ready:
+                    if fd == self.display_fd:
+                        xe = self._read_x_events()
+                        continue
 
-                    # By treating the display first, we ensure
-                    # that X events are prioritized over file events
+                    f = self.files.get(fd)
+                    if f is None:
+                        continue
 
-                    if f is self.display:
-                        xe = self._read_x_events()
-                    else:
+                    # Closed but uncancelled file, forget it
+                    if mode & Multiplexer.INVALID:
+                        self.remove_file(f)
+                        continue
+
+                    mode = mode & f.mode & ~f.unhandled
+                    if mode:
                         if f.unhandled == 0:
                             self.events.append(f)
-                        f.unhandled = f.unhandled | FileEvent.READ
+                        f.unhandled = f.unhandled | mode
 
-                for f in writable:
-                    if f.unhandled == 0:
-                        self.events.append(f)
-                    f.unhandled = f.unhandled | FileEvent.WRITE
-
-                for f in excable:
-                    if f.unhandled == 0:
-                        self.events.append(f)
-                    f.unhandled = f.unhandled | FileEvent.EXCEPTION
+                        # Don't report the same mode again until
+                        # this event has been handled
+                        self.update_file(f)
 
                 # If there was an X event, return it immedieately
                 if xe is not None:
@@ -686,6 +1270,17 @@ class EventFetcher:
         # Store the rest in x_events
         i = self.display.pending_events()
         if i > 0:
+            # Drop superseded events in the burst before storing it
+            if self.coalescer is not None and i > 1:
+                burst = []
+                while i > 0:
+                    burst.append(self.display.next_event())
+                    i = i - 1
+
+                burst = self.coalescer.coalesce(burst)
+                self.x_events.extend(burst[1:])
+                return burst[0]
+
             # Store first event to be returned immediately,
             # and put remaining events on the events queue.
             xe = self.display.next_event()
@@ -696,33 +1291,65 @@ class EventFetcher:
         else:
             return None
 
+    def drain(self, max_events = None):
+        """Return a list of all events that are available without
+        blocking, but at most MAX_EVENTS of them if it is not None.
 
+        The list ends at the first MotionNotify event, so the motion
+        events after it are still queued for latest_motion().
 
+        The list is empty if no event is available.
+        """
 
-    def add_timer(self, timer):
-        """Add a TimerEvent TIMER to the event list.
+        events = []
+        while max_events is None or len(events) < max_events:
+            e = self.next_event(timeout = 0)
+            if e is None:
+                break
+            events.append(e)
+            if getattr(e, 'type', None) == X.MotionNotify:
+                break
+
+        return events
+
+    def latest_motion(self, evt):
+        """Return the last of the MotionNotify events queued directly
+        after the MotionNotify event EVT, for the same window and with
+        the same state, dropping all the earlier ones.  If there are
+        none, EVT is returned.
+
+        This lets motion handlers that only care about the current
+        pointer position skip the positions it has already passed.
         """
 
-        # We iterate over the entire timer list, to remove cancelled timers
+        # Fetch everything the server has sent us so far
+        i = self.display.pending_events()
+        while i > 0:
+            self.x_events.append(self.display.next_event())
+            i = i - 1
+
+        while self.x_events:
+            e = self.x_events[0]
+            if (e.type != X.MotionNotify or e.window != evt.window
+                or e.state != evt.state):
+                break
+
+            evt = self.x_events.popleft()
+            self.dropped_motion = self.dropped_motion + 1
 
-        i = 0
-        while i < len(self.timers):
-            t = self.timers[i]
+        return evt
 
-            # Remove cancelled timers
-            if t.time is None:
-                del self.timers[i]
-            else:
-                # If we haven't already inserted timer, perform checks
-                if timer and timer.time < t.time:
-                    self.timers.insert(i, timer)
-                    i = i + 1
-                    timer = None
 
-                i = i + 1
+    def add_timer(self, timer):
+        """Add a TimerEvent TIMER to the event list.
+        """
+        self.timers.add(timer)
 
-        if timer:
-            self.timers.append(timer)
+    def pending_timers(self):
+        """Return a list of all scheduled, uncancelled, TimerEvents,
+        sorted with the earliest first.
+        """
+        return self.timers.pending()
 
     def add_file(self, file):
         """Add the FileEvent FILE to the list of files to watch.
@@ -733,7 +1360,67 @@ class EventFetcher:
         Remove FILE from list of interesting events by calling
         FILE.cancel().
         """
-        self.files.append(file)
+
+        # Closed files can't be watched
+        try:
+            fd = file.fileno()
+        except (ValueError, AttributeError):
+            return
+
+        # Forget files closed without being cancelled, as their
+        # descriptors may since have been reused for this file
+        self.prune_files()
+
+        old = self.files.get(fd)
+        if old is not None and old is not file:
+            self.drop_file(old)
+
+        file._fd = fd
+        file._fetcher = self
+        self.files[fd] = file
+        self.update_file(file)
+
+    def update_file(self, file):
+        """Update the multiplexer registration of FILE after its mode
+        or state has changed.
+        """
+
+        # Watch for the interested, as yet not recieved, modes
+        self.multiplexer.set(file._fd, file.mode & ~file.unhandled)
+
+    def remove_file(self, file):
+        """Stop watching FILE.
+        """
+
+        if self.files.get(file._fd) is file:
+            del self.files[file._fd]
+            self.multiplexer.set(file._fd, 0)
+
+        file._fetcher = None
+
+    def prune_files(self):
+        """Stop watching all files that have been closed, or whose
+        descriptor has changed, without their FileEvent being
+        cancelled.
+        """
+
+        for fd, file in self.files.items():
+            try:
+                if file.fileno() == fd:
+                    continue
+            except (ValueError, AttributeError):
+                pass
+
+            self.drop_file(file)
+
+    def drop_file(self, file):
+        """Stop watching FILE and discard any pending event for it.
+        """
+        self.remove_file(file)
+        try:
+            self.events.remove(file)
+        except ValueError:
+            pass
 
     def put_event(self, event):
         """Add a synthesized EVENT.
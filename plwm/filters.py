@@ -55,8 +55,18 @@ It contains the following general filters:
 # to a normal function call.  Additionally, this avoids having to
 # traverse the class tree to find the method.
 
+# Event filters can declare which events they can possibly match, to
+# let event.Dispatcher avoid calling them for other events.
+# event_types is None if the filter can match any event type,
+# otherwise a tuple of the types it can match.  event_windows is
+# likewise None or a tuple of the event windows the filter can match.
+# The compound filters below combine the declarations of their
+# subfilters.
+
 class Filter(object):
     name = None
+    event_types = None
+    event_windows = None
 
     def __init__(self):
         if self.name is None:
@@ -78,6 +88,7 @@ all = true
 
 class _False(Filter):
     name = 'false'
+    event_types = ()
     def __call__(self, obj):
         return False
 
@@ -94,6 +105,10 @@ class And(Filter):
         super(And, self).__init__()
         self.filters = args
 
+        # Can only match what all declaring subfilters can match
+        self.event_types = _intersection([f.event_types for f in args])
+        self.event_windows = _intersection([f.event_windows for f in args])
+
     def __call__(self, obj):
         for f in self.filters:
             if not f(obj):
@@ -114,6 +129,10 @@ class Or(Filter):
         super(Or, self).__init__()
         self.filters = args
 
+        # Can match anything any subfilter can match
+        self.event_types = _union([f.event_types for f in args])
+        self.event_windows = _union([f.event_windows for f in args])
+
     def __call__(self, obj):
         for f in self.filters:
             if f(obj):
@@ -135,3 +154,38 @@ class Not(Filter):
     def __str__(self):
         return 'Not(%s)' % str(self.filter)
 
+
+def _intersection(declarations):
+    """Return the intersection of the non-None tuples in DECLARATIONS,
+    or None if all are None.
+    """
+
+    result = None
+    for d in declarations:
+        if d is not None:
+            if result is None:
+                result = list(d)
+            else:
+                result = [v for v in result if v in d]
+
+    if result is None:
+        return None
+    else:
+        return tuple(result)
+
+
+def _union(declarations):
+    """Return the union of the tuples in DECLARATIONS, or None if any
+    of them is None.
+    """
+
+    result = []
+    for d in declarations:
+        if d is None:
+            return None
+
+        for v in d:
+            if v not in result:
+                result.append(v)
+
+    return tuple(result)
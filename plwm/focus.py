@@ -45,7 +45,19 @@ class PointToFocus:
     # are set up for these events, and whenever a new client is
     # created the corresponding masks are set on it.
 
+    # The client containing the pointer is derived from the crossing
+    # events themselves.  Only when that is ambiguous is the pointer
+    # position queried from the server.  ptfocus_events counts the
+    # crossing events handled and ptfocus_fallbacks how many of them
+    # needed a query_pointer.
+
     def __wm_init__(self):
+        self.ptfocus_events = 0
+        self.ptfocus_fallbacks = 0
+
+        # The last LeaveNotify not yet followed by an EnterNotify
+        self.ptfocus_left = None
+
         # Handler to set up required X masks on client windows
         self.dispatch.add_handler(wmevents.AddClient,
                                   self.ptfocus_handle_new_client)
@@ -61,15 +73,22 @@ class PointToFocus:
     def ptfocus_handle_new_client(self, evt):
         evt.client.dispatch.set_masks((X.EnterWindowMask, X.LeaveWindowMask))
 
-    # We handle the event by finding the window that contains the
-    # pointer, since we get leave events when the pointer leaves the
-    # border and enters the window...
+    def ptfocus_select_client(self, client):
+        """Return the client that should be focused when the pointer
+        is in CLIENT, which may be None.
+
+        Override to implement some other focus policy
+        Default is that the pointer root is also the focus window.
+        """
+        return client
 
     def ptfocus_get_focused_client(self):
         """Return the focused client, or None.
+        """
+        return self.ptfocus_select_client(self.ptfocus_query_pointer())
 
-        Override to implement some other focus policy
-        Default is that the pointer root is also the focus window.
+    def ptfocus_query_pointer(self):
+        """Return the client containing the pointer, asking the server.
         """
 
         # Find the screen and window containing pointer
@@ -83,22 +102,82 @@ class PointToFocus:
 
         return None
 
+    def ptfocus_event_client(self, evt):
+        """Return the client containing the pointer after the
+        EnterNotify EVT.
+
+        Return the ptfocus_query_pointer() result if that can't be
+        determined from the event.
+        """
+
+        if evt.same_screen:
+            # Entering a client window, or one of its subwindows
+            client = self.get_client(evt.window)
+            if client:
+                return client
+
+            # Entering the root window itself, either from one of its
+            # children or from another screen
+            if self.screen_roots.has_key(evt.window) \
+               and evt.detail in (X.NotifyInferior, X.NotifyNonlinear,
+                                  X.NotifyAncestor):
+                return None
+
+        # Ambiguous: entering an inferior of the root from another
+        # screen, or some window we don't know about
+        wmanager.debug('focus', 'Ambiguous enter %s, querying pointer',
+                       evt.window)
+        self.ptfocus_fallbacks = self.ptfocus_fallbacks + 1
+        return self.ptfocus_query_pointer()
+
     def focus_enter(self, evt):
         wmanager.debug('focus', 'Pointer enter %s', evt.window)
-        self.set_current_client(self.ptfocus_get_focused_client(), evt.time)
+
+        # The pointer doesn't move when it is grabbed
+        if evt.mode == X.NotifyGrab:
+            return
+
+        self.ptfocus_events = self.ptfocus_events + 1
+        self.ptfocus_left = None
+        client = self.ptfocus_event_client(evt)
+        self.set_current_client(self.ptfocus_select_client(client), evt.time)
 
     def focus_leave(self, evt):
         wmanager.debug('focus', 'Pointer leave %s', evt.window)
-        self.set_current_client(self.ptfocus_get_focused_client(), evt.time)
+
+        # The pointer is still in the window when moving into a
+        # subwindow, and doesn't move when it is grabbed
+        if evt.mode == X.NotifyGrab or evt.detail == X.NotifyInferior:
+            return
+
+        # The window the pointer moves into gets an EnterNotify which
+        # decides the new focus if it is another client, or the root
+        # window which selects EnterWindowMask.  If none follows in
+        # this batch of events the pointer moved into a frame or an
+        # unmanaged window, e.g. an override-redirect popup, and the
+        # server is asked where it is.
+        self.ptfocus_events = self.ptfocus_events + 1
+        self.ptfocus_left = evt
+        self.after_batch(lambda self = self, evt = evt:
+                         self.ptfocus_check_leave(evt))
+
+    def ptfocus_check_leave(self, evt):
+        if self.ptfocus_left is not evt:
+            return
+
+        self.ptfocus_left = None
+        wmanager.debug('focus', 'No enter after leaving %s, querying pointer',
+                       evt.window)
+        self.ptfocus_fallbacks = self.ptfocus_fallbacks + 1
+        client = self.ptfocus_query_pointer()
+        self.set_current_client(self.ptfocus_select_client(client), evt.time)
 
 class SloppyFocus(PointToFocus):
 
     # Variety of PointToFocus, which does not drop focus when the
     # pointer moves to the root window
 
-    def ptfocus_get_focused_client(self):
-        client = PointToFocus.ptfocus_get_focused_client(self)
-
+    def ptfocus_select_client(self, client):
         if client:
             return client
         elif self.focus_client and self.focus_client.is_mapped():
@@ -110,6 +189,15 @@ class SloppyFocus(PointToFocus):
 class MoveFocus:
     move_focus_ignore_clients = cfilter.false
 
+    # The client edge to use in each direction, and whether the
+    # next client is found after the focused client's edge
+    move_focus_edges = {
+        MOVE_UP: ('bottom', 0),
+        MOVE_DOWN: ('top', 1),
+        MOVE_LEFT: ('right', 0),
+        MOVE_RIGHT: ('left', 1),
+        }
+
     def get_client_pos(self, client, dir):
         """Return the position of CLIENT to be used when moving
         focus in direction DIR.
@@ -130,76 +218,37 @@ class MoveFocus:
         DIR is either MOVE_UP, MOVE_DOWN, MOVE_LEFT or MOVE_RIGHT.
         """
 
-        # Get all the mapped clients, if any, sorted in stacking
-        # order.  Then inverse the list so the top-most client is
-        # first in it.
-
         if self.current_screen is None:
             return
 
-        clients = self.current_screen.query_clients(cfilter.mapped, stackorder = 1)
-        clients.reverse()
-
-        # No clients, meaningless to try to change focus
-        if len(clients) == 0:
-            return
+        # The screen's spatial index holds all the mapped clients
+        # with their edges sorted, so the closest client is found
+        # with a binary search.
+        index = self.current_screen.client_index
+        edge, after = self.move_focus_edges[dir]
+        ignore = cfilter.compiled(self.move_focus_ignore_clients)
 
-        # A client is focused, so find the closest client
+        # A client is focused, so find the closest client in the
+        # direction.  If several clients are equally close, use the
+        # top-most one.
         if self.focus_client:
             pos = self.get_client_pos(self.focus_client, dir)
-            best = None
-            bestdiff = None
-
-            for c in clients:
-                if c is self.focus_client \
-                   or self.move_focus_ignore_clients(c):
-                    continue
-
-                p = self.get_client_pos(c, dir)
-                if dir == MOVE_UP or dir == MOVE_LEFT:
-                    diff = pos - p
-                else:
-                    diff = p - pos
-
-                # Only use positive diffs, so the clients is on the right
-                # side of the focused client
-                # If no client has been found, or this diff is smaller
-                # than a previous, use this diff as the best
-                if diff > 0 and (bestdiff is None or diff < bestdiff):
-                    bestdiff = diff
-                    best = c
-
+            focused = self.focus_client
+            clients = index.nearest(
+                edge, pos, after,
+                lambda c, f = focused, i = ignore: c is not f and not i(c))
 
-            # Okay, have we found some clients?  Then just use the first found
-            # and return.
-            if bestdiff != None:
-                best.activate()
+            if clients:
+                self.current_screen.topmost_client(clients).activate()
                 return
 
         # We get here if no client is focused, or if it is the outermost
         # client which is focused.  Get the first client on the opposite
         # side
-        best = None
-        bestpos = None
-        for c in clients:
-            if self.move_focus_ignore_clients(c):
-                continue
-
-            pos = self.get_client_pos(c, dir)
-            if bestpos is None:
-                best = c
-                bestpos = pos
-            elif dir == MOVE_UP or dir == MOVE_LEFT:
-                if pos > bestpos:
-                    best = c
-                    bestpos = pos
-            else:
-                if pos < bestpos:
-                    best = c
-                    bestpost = pos
-
-        if best:
-            best.activate()
+        clients = index.nearest(edge, None, after,
+                                lambda c, i = ignore: not i(c))
+        if clients:
+            self.current_screen.topmost_client(clients).activate()
 
 
 # For backward compitability
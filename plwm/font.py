@@ -17,10 +17,185 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import types
+import collections
+
+from Xlib import error
+from Xlib.protocol import request
+from Xlib.xobject import fontable
+
 class FontError(Exception): pass
 
+
+class TextExtents:
+    """The result of CachedFont.query_text_extents(), with the same
+    attributes as a QueryTextExtents reply.
+    """
+
+    def __init__(self, draw_direction, font_ascent, font_descent,
+                 overall_ascent, overall_descent, overall_width,
+                 overall_left, overall_right):
+        self.draw_direction = draw_direction
+        self.font_ascent = font_ascent
+        self.font_descent = font_descent
+        self.overall_ascent = overall_ascent
+        self.overall_descent = overall_descent
+        self.overall_width = overall_width
+        self.overall_left = overall_left
+        self.overall_right = overall_right
+
+
+class CachedFont(fontable.Font):
+    """A font which measures text without asking the server.
+
+    The QueryFont reply is fetched once, the first time it is needed.
+    For single-byte fonts the text extents are then computed from the
+    per-character metrics in it.  Other fonts, and unicode strings,
+    are measured by the server, but the results for the
+    text_extents_cache_size most recently used strings are cached.
+    """
+
+    text_extents_cache_size = 256
+
+    def __init__(self, display, rid, owner = 0, name = None):
+        fontable.Font.__init__(self, display, rid, owner)
+        self.name = name
+        self.font_info = None
+
+        # Number of users of the font, see Font.get_font()
+        self.refcount = 0
+
+        # List of (left bearing, right bearing, width, ascent, descent)
+        # for each of the 256 characters, or None if the font isn't a
+        # single-byte font
+        self.char_metrics = None
+
+        self.extents_cache = collections.OrderedDict()
+        self.extents_cache_hits = 0
+        self.extents_cache_misses = 0
+
+    def query(self):
+        if self.font_info is None:
+            self.font_info = fontable.Font.query(self)
+            self.char_metrics = get_char_metrics(self.font_info)
+        return self.font_info
+
+    def query_text_extents(self, string):
+        self.query()
+
+        if self.char_metrics is not None and type(string) is types.StringType:
+            return self.compute_text_extents(string)
+
+        try:
+            ext = self.extents_cache.pop(string)
+            self.extents_cache_hits = self.extents_cache_hits + 1
+        except KeyError:
+            ext = fontable.Font.query_text_extents(self, string)
+            ext = TextExtents(ext.draw_direction,
+                              ext.font_ascent, ext.font_descent,
+                              ext.overall_ascent, ext.overall_descent,
+                              ext.overall_width,
+                              ext.overall_left, ext.overall_right)
+            self.extents_cache_misses = self.extents_cache_misses + 1
+
+            if len(self.extents_cache) >= self.text_extents_cache_size:
+                self.extents_cache.popitem(last = False)
+
+        self.extents_cache[string] = ext
+        return ext
+
+    def compute_text_extents(self, string):
+        """Return the TextExtents of the single-byte STRING, computed
+        from the character metrics of the font.
+        """
+        metrics = self.char_metrics
+        width = 0
+        ascent = descent = 0
+        left = right = 0
+        first = 1
+
+        for c in string:
+            m = metrics[ord(c)]
+            if m is None:
+                continue
+
+            lbearing, rbearing, cwidth, cascent, cdescent = m
+            if first:
+                ascent = cascent
+                descent = cdescent
+                left = width + lbearing
+                right = width + rbearing
+                first = 0
+            else:
+                ascent = max(ascent, cascent)
+                descent = max(descent, cdescent)
+                left = min(left, width + lbearing)
+                right = max(right, width + rbearing)
+
+            width = width + cwidth
+
+        info = self.font_info
+        return TextExtents(info.draw_direction,
+                           info.font_ascent, info.font_descent,
+                           ascent, descent, width, left, right)
+
+    def text_width(self, string):
+        """Return the width in pixels of STRING.
+        """
+        return self.query_text_extents(string).overall_width
+
+
+def get_char_metrics(info):
+    """Return a list of the metrics of each character in a font, from
+    its QueryFont reply INFO, with the default character substituted
+    for non-existing characters.
+
+    Returns None if INFO isn't for a single-byte font.
+    """
+
+    if info.min_byte1 != 0 or info.max_byte1 != 0:
+        return None
+
+    lo = info.min_char_or_byte2
+    hi = info.max_char_or_byte2
+
+    def char_metrics(c, info = info, lo = lo, hi = hi):
+        if c < lo or c > hi:
+            return None
+
+        # No per-character metrics means all characters have the
+        # maximum metrics
+        if info.char_infos:
+            ci = info.char_infos[c - lo]
+        else:
+            ci = info.max_bounds
+
+        m = (ci.left_side_bearing, ci.right_side_bearing,
+             ci.character_width, ci.ascent, ci.descent)
+        if m == (0, 0, 0, 0, 0):
+            return None
+        return m
+
+    default = char_metrics(info.default_char)
+
+    metrics = []
+    for c in range(0, 256):
+        m = char_metrics(c)
+        if m is None:
+            m = default
+        metrics.append(m)
+
+    return metrics
+
+
 # WindowManager mixin class
 class Font:
+    def __wm_screen_init__(self):
+        # Map font names to open CachedFonts, and remember the names
+        # that don't match any font
+        self.font_cache = {}
+        self.font_missing = {}
+
     def get_font(self, fontname, default = None):
         """Return the font object corresponding to FONTNAME.
 
@@ -28,20 +203,77 @@ class Font:
         the font named DEFAULT instead, if DEFAULT is provided.
 
         If no font can be found, FontError is raised
+
+        Fonts are shared by all users of the same font name.  Call
+        release_font() when the font isn't needed anymore.
         """
 
-        font = self.display.open_font(fontname)
+        font = self.open_font(fontname)
 
         if font is None:
             if default is None:
                 raise FontError("can't open font %s" % fontname)
 
-            font = self.display.open_font(default)
+            font = self.open_font(default)
             if font is None:
                 raise FontError("can't open font %s" % fontname)
 
+        font.refcount = font.refcount + 1
         return font
 
+    def release_font(self, font):
+        """Drop a reference to FONT, returned by get_font().  The font
+        is closed when it isn't used anymore.  Releasing a font that
+        already has been closed does nothing.
+        """
+        if font.refcount <= 0:
+            return
+
+        font.refcount = font.refcount - 1
+        if font.refcount == 0 and self.font_cache.get(font.name) is font:
+            del self.font_cache[font.name]
+            font.close()
+
+    def open_font(self, fontname):
+        """Return the cached font FONTNAME, opening it if necessary.
+        Returns None if there is no such font.
+        """
+
+        try:
+            return self.font_cache[fontname]
+        except KeyError:
+            pass
+
+        if self.font_missing.has_key(fontname):
+            return None
+
+        # Send the QueryFont for the metrics right after the OpenFont,
+        # so that a single round trip both tells us if the font
+        # exists and fetches the font info
+        d = self.display.display
+        fid = d.allocate_resource_id()
+        ec = error.CatchError(error.BadName)
+        request.OpenFont(display = d, onerror = ec, fid = fid, name = fontname)
+
+        info = request.QueryFont(display = d, defer = 1, font = fid)
+        try:
+            info.reply()
+        except (error.BadFont, error.BadName):
+            d.free_resource_id(fid)
+            self.font_missing[fontname] = 1
+            return None
+
+        font = CachedFont(d, fid, owner = 1, name = fontname)
+        font.font_info = info
+        font.char_metrics = get_char_metrics(info)
+        self.font_cache[fontname] = font
+        return font
+
+    def font_count(self):
+        """Return the number of fonts currently open.
+        """
+        return len(self.font_cache)
+
     def get_font_res(self, res_name, res_class, default = None):
         """Return the font object corresponding to the X
         resource RES_NAME, RES_CLASS.
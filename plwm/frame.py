@@ -42,10 +42,10 @@ class FrameProxy(wmanager.WindowProxyBase):
             FrameProxy._NET_WM_STATE_DEMANDS_ATTENTION = self._wm.display.intern_atom("_NET_WM_STATE_DEMANDS_ATTENTION")
 
         self._font = self._wm.get_font(self._title_font)
-        self._title_pixel = self._screen.get_color(self._title_color)
-        self._unfocused_pixel = self._screen.get_color(self._unfocused_color)
-        self._focused_pixel = self._screen.get_color(self._focused_color)
-        self._urgent_pixel = self._screen.get_color(self._urgent_color)
+        (self._title_pixel, self._unfocused_pixel,
+         self._focused_pixel, self._urgent_pixel) = self._screen.get_colors(
+            [self._title_color, self._unfocused_color,
+             self._focused_color, self._urgent_color])
 
         fq = self._font.query()
 
@@ -125,6 +125,7 @@ class FrameProxy(wmanager.WindowProxyBase):
 
         self._screen.remove_proxy_window(self._frame)
         self._frame.destroy()
+        self._wm.release_font(self._font)
 
 
     def _expose(self, e):
@@ -226,9 +227,11 @@ class FrameProxy(wmanager.WindowProxyBase):
 
 
     def get_wm_normal_hints(self):
+        return self._proxy_wm_normal_hints(self._window.get_wm_normal_hints())
+
+
+    def _proxy_wm_normal_hints(self, hints):
         # Must add in the frame to the size hints
-        hints = self._window.get_wm_normal_hints()
-        
         if hints:
             hints.min_width = hints.min_width + self._extra_width
             hints.min_height = hints.min_height + self._extra_height
@@ -177,9 +177,9 @@ class inputWindow:
         self.offset = len(self.prompt)
         self.length = length + self.offset
         self.start = 0
-        fg = screen.get_color(self.foreground)
-        bg = screen.get_color(self.background)
-        bc = screen.get_color(self.bordercolor)
+        self.wm = screen.wm
+        fg, bg, bc = screen.get_colors([self.foreground, self.background,
+                                        self.bordercolor])
         font = screen.wm.get_font(self.fontname, 'fixed')
         size = font.query()
         self.height = size.font_ascent + size.font_descent + 1
@@ -250,9 +250,11 @@ class inputWindow:
     def do(self, string):
         self.action(string)
         self.window.destroy()
+        self.wm.release_font(self.font)
 
     def abort(self):
         self.window.destroy()
+        self.wm.release_font(self.font)
 
 
 class modeInput:
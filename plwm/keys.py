@@ -24,6 +24,7 @@ import wmanager
 import event
 import time
 import sys
+import types
 
 error = 'keys.error'
 
@@ -49,6 +50,107 @@ modifiers = {
 def hash_keycode(code, modifiers):
     return modifiers << 8 | code;
 
+def parse_keymethod(name):
+    """Parse the KeyHandler method NAME into a (keysym, modifiers)
+    tuple.  Returns None if NAME isn't a key binding.
+    """
+    if name[0] == '_':
+        return None
+
+    # Find modifiers in name
+    mask = 0
+    parts = string.split(name, '_')
+    while len(parts) >= 2 and modifiers.has_key(parts[0]):
+        mask = mask | modifiers[parts[0]]
+        del parts[0]
+
+    # Find name keysym
+    rest = string.join(parts, '_')
+    keysym = XK.string_to_keysym(rest)
+    if keysym == X.NoSymbol:
+        return None
+
+    return keysym, mask
+
+# Map KeyHandler classes to their parsed bindings, a list of
+# (keysym, modifiers, method name) tuples
+_class_bindings = {}
+
+def class_bindings(cls):
+    """Return the parsed bindings of the KeyHandler class CLS.
+
+    The bindings are only parsed once per class.  If the methods of a
+    class are changed after it has been instantiated,
+    clear_binding_cache() must be called.
+    """
+    try:
+        return _class_bindings[cls]
+    except KeyError:
+        pass
+
+    # First collect all method names in this and it's base classes
+    names = {}
+    c = [cls]
+    while len(c):
+        names.update(c[0].__dict__)
+        c = c + list(c[0].__bases__)
+        del c[0]
+
+    # And now parse the names
+    binds = []
+    for name in names.keys():
+        b = parse_keymethod(name)
+        if b is not None:
+            binds.append((b[0], b[1], name))
+
+    _class_bindings[cls] = binds
+    return binds
+
+# Map KeySequenceHandler classes to their parsed sequences, a list of
+# (((keysym, modifiers), ...), method name) tuples
+_class_sequences = {}
+
+def class_sequences(cls):
+    """Return the parsed key_sequences of the KeySequenceHandler
+    class CLS.  The sequences are only parsed once per class.
+    """
+    try:
+        return _class_sequences[cls]
+    except KeyError:
+        pass
+
+    seqs = []
+    for keys, name in cls.key_sequences:
+        seq = []
+        for k in string.split(keys):
+            b = parse_keymethod(k)
+            if b is None:
+                raise ValueError('bad key %s in sequence %s' % (repr(k), repr(keys)))
+            seq.append(b)
+
+        if not seq:
+            raise ValueError('empty key sequence for %s' % name)
+
+        seqs.append((tuple(seq), name))
+
+    # A sequence can't be a prefix of another one, as the shorter
+    # would always be completed before the longer could be entered
+    seqs.sort()
+    for i in range(1, len(seqs)):
+        prev, prevname = seqs[i - 1]
+        if seqs[i][0][:len(prev)] == prev:
+            raise ValueError('key sequence for %s conflicts with %s'
+                             % (seqs[i][1], prevname))
+
+    _class_sequences[cls] = seqs
+    return seqs
+
+def clear_binding_cache():
+    """Forget all parsed KeyHandler class bindings.
+    """
+    _class_bindings.clear()
+    _class_sequences.clear()
+
 # Screen mixin, still here for backward compitability
 class KeyGrabber:
     """Keeps track of all grabbed keys on a window.
@@ -58,11 +160,32 @@ class KeyGrabber:
 
 # This is now the real grabbing class
 class KeygrabManager:
+    """Manage the passive key grabs on a window.
+
+    The grabs are reference counted.  The set of keys to grab is
+    reconciled with the keys actually grabbed, so only the changes are
+    sent to the server.  Between begin_update() and end_update() the
+    reconciliation is postponed, so e.g. rebuilding a key map doesn't
+    ungrab and regrab the unchanged keys.
+    """
+
     def __init__(self, wm, window):
         self.wm = wm
         self.window = window
+
+        # Map hash_keycode() to (keycode, modifiers, reference count)
         self.grabs = {}
 
+        # Map (keycode, modifiers) to 1 for the keys grabbed on the
+        # server.  The release modifier doesn't affect the grab.
+        self.grabbed = {}
+
+        self.updating = 0
+
+        # Number of GrabKey and UngrabKey requests sent
+        self.grab_requests = 0
+        self.ungrab_requests = 0
+
     def ungrab_keys(self, keylist):
         """Ungrab some keys.
 
@@ -70,13 +193,14 @@ class KeygrabManager:
         """
         for keycode, modifiers in keylist:
             h = hash_keycode(keycode, modifiers)
-            c = self.grabs.get(h, 0)
-            if c > 0:
-                if c == 1:
+            g = self.grabs.get(h)
+            if g is not None:
+                if g[2] == 1:
                     del self.grabs[h]
-                    self.window.ungrab_key(keycode, modifiers & ~ReleaseModifier)
                 else:
-                    self.grabs[h] = self.grabs[h] - 1
+                    self.grabs[h] = (keycode, modifiers, g[2] - 1)
+
+        self.reconcile()
 
     def grab_keys(self, keylist):
         """Grab some keys.
@@ -85,13 +209,54 @@ class KeygrabManager:
         """
         for keycode, modifiers in keylist:
             h = hash_keycode(keycode, modifiers)
-            c = self.grabs.get(h, 0)
-            if c == 0:
-                self.window.grab_key(keycode, modifiers & ~ReleaseModifier, 1,
-                                     X.GrabModeAsync, X.GrabModeAsync)
-                self.grabs[h] = 1
+            g = self.grabs.get(h)
+            if g is None:
+                self.grabs[h] = (keycode, modifiers, 1)
             else:
-                self.grabs[h] = self.grabs[h] + 1
+                self.grabs[h] = (keycode, modifiers, g[2] + 1)
+
+        self.reconcile()
+
+    def begin_update(self):
+        """Postpone sending grab changes until end_update().
+        """
+        self.updating = self.updating + 1
+
+    def end_update(self):
+        self.updating = self.updating - 1
+        self.reconcile()
+
+    def reconcile(self):
+        """Send the grab changes needed to make the grabbed keys match
+        the wanted keys.
+        """
+        if self.updating:
+            return
+
+        wanted = {}
+        for keycode, modifiers, count in self.grabs.values():
+            wanted[(keycode, modifiers & ~ReleaseModifier)] = 1
+
+        changes = 0
+        for key in self.grabbed.keys():
+            if not wanted.has_key(key):
+                self.window.ungrab_key(key[0], key[1])
+                del self.grabbed[key]
+                self.ungrab_requests = self.ungrab_requests + 1
+                changes = changes + 1
+
+        for key in wanted.keys():
+            if not self.grabbed.has_key(key):
+                self.window.grab_key(key[0], key[1], 1,
+                                     X.GrabModeAsync, X.GrabModeAsync)
+                self.grabbed[key] = 1
+                self.grab_requests = self.grab_requests + 1
+                changes = changes + 1
+
+        if changes:
+            wmanager.debug('keys', '%s: %d grab changes, %d keys grabbed',
+                           self.window, changes, len(self.grabbed))
+            self.wm.flush()
 
     def grab_keyboard(self, time):
         s = self.window.grab_keyboard(0, X.GrabModeAsync, X.GrabModeAsync, time)
@@ -172,35 +337,18 @@ class KeyHandler:
 
 
         # Dig through all names in this object, ignoring those beginning with
-        # an underscore.
-
-        # First collect all method names in this and it's base classes
-        names = {}
-        c = [self.__class__]
-        while len(c):
-            names.update(c[0].__dict__)
-            c = c + list(c[0].__bases__)
-            del c[0]
+        # an underscore.  The class names are only parsed once per
+        # class, so only names set on this instance need parsing here.
 
-        names.update (self.__dict__)
-
-        # And now parse the names
         rawbinds = []
-        for name in names.keys():
-            if name[0] != '_':
-
-                # Find modifiers in name
-                mask = 0
-                parts = string.split(name, '_')
-                while len(parts) >= 2 and modifiers.has_key(parts[0]):
-                    mask = mask | modifiers[parts[0]]
-                    del parts[0]
-
-                # Find name keysym
-                rest = string.join(parts, '_')
-                keysym = XK.string_to_keysym(rest)
-                if keysym != X.NoSymbol:
-                    rawbinds.append((keysym, mask, getattr(self, name)))
+        for keysym, mask, name in class_bindings(self.__class__):
+            if not self.__dict__.has_key(name):
+                rawbinds.append((keysym, mask, getattr(self, name)))
+
+        for name in self.__dict__.keys():
+            b = parse_keymethod(name)
+            if b is not None:
+                rawbinds.append((b[0], b[1], getattr(self, name)))
 
         self.wm = wm
         self.dispatch = obj.dispatch
@@ -216,9 +364,9 @@ class KeyHandler:
             self.dispatch.add_grab_handler(X.KeyPress, self._keyevent, handlerid = self)
             self.dispatch.add_grab_handler(X.KeyRelease, self._keyevent, handlerid = self)
 
-        # Okay, so we will remap and regrab once for every
-        # screen, but I'm not worried.  xmodmap isn't the most
-        # frequently used command...
+        # Rebuild the bindings when the keyboard mapping changes.
+        # The keycodes are only resolved once per mapping, in
+        # WindowManager.keysym_to_keycodes().
         self.dispatch.add_handler(X.MappingNotify, self._mappingnotify,
                                   handlerid = self)
 
@@ -266,41 +414,63 @@ class KeyHandler:
 
         Also sets passive grabs for the key bindings.
         """
+        # Only send the changed grabs when we're done
+        for g in self.grabmgrs:
+            g.begin_update()
+
+        try:
+            self._rebuild()
+        finally:
+            for g in self.grabmgrs:
+                g.end_update()
+
+    def _rebuild(self):
         # First ungrab the grabs we already have
         self._ungrab()
 
         # Build up new list of bindings
         self.bindings = {}
+        self.keymap_generation = self.wm.keymap_generation
         for keysym, modifiers, func in self.rawbindings:
-            keycodes = self.wm.display.keysym_to_keycodes(keysym)
-            for code, index in keycodes:
-                # Don't deal with modeswitching, not yet
-                if index > 1:
-                    continue
-
-                # If AnyModifier is set, we only grab to those keycodes which
-                # have keysym as their primary binding
-                if modifiers & X.AnyModifier:
-                    if index != 0:
-                        continue
-
-                # Add shift if necessary
-                if index == 1:
-                    mods = modifiers | X.ShiftMask
-                else:
-                    mods = modifiers
-
+            for code, mods in self._keycodes(keysym, modifiers):
                 self.bindings[hash_keycode(code, mods)] = func
                 self.grabs.append((code, mods))
 
         # Install the new grabs
         self._grab()
 
+    def _keycodes(self, keysym, modifiers):
+        """Return a list of the (keycode, modifiers) tuples that
+        generate KEYSYM with MODIFIERS.
+        """
+        keys = []
+        for code, index in self.wm.keysym_to_keycodes(keysym):
+            # Don't deal with modeswitching, not yet
+            if index > 1:
+                continue
+
+            # If AnyModifier is set, we only grab to those keycodes which
+            # have keysym as their primary binding
+            if modifiers & X.AnyModifier:
+                if index != 0:
+                    continue
+
+            # Add shift if necessary
+            if index == 1:
+                keys.append((code, modifiers | X.ShiftMask))
+            else:
+                keys.append((code, modifiers))
+
+        return keys
+
     def _mappingnotify(self, event):
         """Pass as handler for MappingNotify events to rebuild
         the key bindings.
         """
-        self._buildmap()
+        # Nothing to do if the keyboard mapping hasn't changed, or we
+        # already have rebuilt for it
+        if self.keymap_generation != self.wm.keymap_generation:
+            self._buildmap()
 
     def _internal_timeout(self, ev):
         """Called when the timer event times out.
@@ -379,6 +549,208 @@ class KeyGrabKeyboard(KeyHandler):
     def _timeout(self, evt):
         self._cleanup()
 
+# Keysyms of keys that only change modifiers, which are ignored while
+# in a key sequence
+XK.load_keysym_group('xkb')
+modifier_keysyms = {}
+for _k in ('Shift_L', 'Shift_R', 'Control_L', 'Control_R', 'Meta_L', 'Meta_R',
+           'Alt_L', 'Alt_R', 'Super_L', 'Super_R', 'Hyper_L', 'Hyper_R',
+           'Caps_Lock', 'Shift_Lock', 'Num_Lock', 'Mode_switch',
+           'ISO_Level3_Shift'):
+    _s = XK.string_to_keysym(_k)
+    if _s != X.NoSymbol:
+        modifier_keysyms[_s] = 1
+del _k, _s
+
+
+class _SequenceGrab:
+    """Identifies the grab handlers of an active key sequence."""
+    pass
+
+class KeySequenceHandler(KeyHandler):
+    """KeyHandler which also binds multi-key sequences.
+
+    The sequences are declared in key_sequences, a list of (keys,
+    method name) tuples.  KEYS is a string of key names separated by
+    whitespace, each with the same syntax as the KeyHandler method
+    names.  An Emacs-style binding could look like this:
+
+        key_sequences = (('C_x C_f', 'find_file'),
+                         ('C_x 4 f', 'find_file_other_window'))
+
+    No sequence may be a prefix of another one, that raises
+    ValueError.  The method is called with the event of the last key
+    in the sequence.  The sequences are compiled into a trie of
+    keycodes, so each key press in a sequence costs a single dict
+    lookup.
+
+    The first keys of the sequences are grabbed like ordinary
+    bindings, and override them.  When one is pressed the keyboard,
+    and the key events from other handlers, are grabbed until the
+    sequence is complete, a key not continuing the sequence is
+    pressed, or no key has been pressed for sequence_timeout seconds.
+    """
+
+    key_sequences = ()
+    sequence_timeout = 5
+
+    def __init__(self, obj, *args):
+        self.rawsequences = []
+        for keys, name in class_sequences(self.__class__):
+            self.rawsequences.append((keys, getattr(self, name)))
+
+        # The trie node of the sequence being entered, if any
+        self.sequence_node = None
+        self.sequence_timer = None
+        self.sequence_timer_id = event.new_event_type()
+        self.sequence_grab = _SequenceGrab()
+
+        apply(KeyHandler.__init__, (self, obj) + args)
+
+        self.dispatch.add_handler(self.sequence_timer_id,
+                                  self._sequence_timeout,
+                                  handlerid = self)
+
+    def _cleanup(self):
+        self._sequence_end()
+        KeyHandler._cleanup(self)
+        self.rawsequences = None
+        self.sequence_trie = None
+
+    def _rebuild(self):
+        # Compile the sequences into a trie, where each node maps
+        # hash_keycode() to the next node or to the method to call
+        self.sequence_trie = {}
+        for keys, func in self.rawsequences:
+            self._add_sequence([self.sequence_trie], keys, func)
+
+        KeyHandler._rebuild(self)
+
+    def _add_sequence(self, nodes, keys, func):
+        keysym, modifiers = keys[0]
+        last = len(keys) == 1
+
+        next = []
+        for node in nodes:
+            for code, mods in self._keycodes(keysym, modifiers):
+                h = hash_keycode(code, mods)
+                n = node.get(h)
+
+                # Keys mapped to the same keycodes can still make
+                # sequences conflict, keep the first one then
+                if n is not None and (last or type(n) is not types.DictType):
+                    sys.stderr.write('%s: warning: key sequence for %s conflicts with another sequence\n'
+                                     % (sys.argv[0], func.__name__))
+                elif last:
+                    node[h] = func
+                else:
+                    if n is None:
+                        n = node[h] = {}
+                    next.append(n)
+
+        if not last and next:
+            self._add_sequence(next, keys[1:], func)
+
+    def _grab(self):
+        # Bind and grab the first keys of the sequences
+        for h, n in self.sequence_trie.items():
+            if type(n) is types.DictType:
+                self.bindings[h] = lambda evt, self = self, n = n: \
+                                   self._sequence_start(evt, n)
+            else:
+                self.bindings[h] = n
+            self.grabs.append((h & 0xff, h >> 8))
+
+        KeyHandler._grab(self)
+
+    def _keyevent(self, evt):
+        if self.sequence_node is None:
+            KeyHandler._keyevent(self, evt)
+            return
+
+        self.last_key_time = time.time()
+
+        # Only key presses of non-modifier keys advance the sequence
+        if evt.type != X.KeyPress:
+            return
+
+        if modifier_keysyms.has_key(
+            self.wm.display.keycode_to_keysym(evt.detail, 0)):
+            return
+
+        node = self.sequence_node
+        n = node.get(hash_keycode(evt.detail, evt.state))
+        if n is None:
+            n = node.get(hash_keycode(evt.detail, X.AnyModifier))
+
+        if type(n) is types.DictType:
+            # A longer prefix, wait for the next key
+            self.sequence_node = n
+            self._sequence_timer_start()
+
+        else:
+            self._sequence_end()
+
+            if n is None:
+                wmanager.debug('keys', 'key sequence aborted')
+                self.wm.display.bell(0)
+            else:
+                n(evt)
+
+    def _sequence_start(self, evt, node):
+        wmanager.debug('keys', 'key sequence started')
+
+        for g in self.grabmgrs:
+            try:
+                g.grab_keyboard(evt.time)
+            except error:
+                wmanager.debug('keys', 'failed to grab keyboard for key sequence')
+                for g in self.grabmgrs:
+                    g.ungrab_keyboard()
+                return
+
+        # Keep the rest of the sequence from other key handlers
+        self.dispatch.add_grab_handler(X.KeyPress, self._keyevent,
+                                       handlerid = self.sequence_grab)
+        self.dispatch.add_grab_handler(X.KeyRelease, self._keyevent,
+                                       handlerid = self.sequence_grab)
+
+        self.sequence_node = node
+        self._sequence_timer_start()
+
+    def _sequence_end(self):
+        if self.sequence_node is None:
+            return
+
+        self.sequence_node = None
+        if self.sequence_timer is not None:
+            self.sequence_timer.cancel()
+            self.sequence_timer = None
+
+        self.dispatch.remove_handler(self.sequence_grab)
+
+        for g in self.grabmgrs:
+            g.ungrab_keyboard()
+
+    def _sequence_timer_start(self):
+        if self.sequence_timer is not None:
+            self.sequence_timer.cancel()
+
+        self.sequence_timer = event.TimerEvent(self.sequence_timer_id,
+                                               after = self.sequence_timeout)
+        self.wm.events.add_timer(self.sequence_timer)
+
+    def _sequence_timeout(self, evt):
+        # All timers of this handler share the event type, so ignore
+        # any timer cancelled when the sequence was restarted
+        if evt is not self.sequence_timer:
+            return
+
+        wmanager.debug('keys', 'key sequence timed out')
+        self.sequence_timer = None
+        self._sequence_end()
+
+
 def allmap(klass, method):
     """Map all printing keys to klass.method in keyhandler klass."""
 
@@ -386,3 +758,6 @@ def allmap(klass, method):
         if len(c) > 3 and c[:3] == 'XK_':
             setattr(klass, c[3:], method)
 
+    # The class might already have been parsed
+    clear_binding_cache()
+
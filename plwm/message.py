@@ -35,9 +35,7 @@ class Message:
         self.wm = screen.wm
         self.seconds = seconds
 
-        fg = screen.get_color(foreground)
-        bg = screen.get_color(background)
-        bc = screen.get_color(bordercolor)
+        fg, bg, bc = screen.get_colors([foreground, background, bordercolor])
 
         window = screen.root.create_window(0, 0, 1, 1, borderwidth,
                                            X.CopyFromParent, X.InputOutput,
@@ -107,6 +105,11 @@ class Message:
         self.hide()
         self.window.destroy()
 
+        # Both the timer and the user may close the message
+        if self.font is not None:
+            self.wm.release_font(self.font)
+            self.font = None
+
     def raisewindow(self, event = None):
         self.window.raisewindow()
 
@@ -93,6 +93,11 @@ class InhibitMozillaPopups:
 
     mozpopup_keymap = None
 
+    __client_prefetch__ = (
+        (Xatom.WM_TRANSIENT_FOR, Xatom.WINDOW, 1),
+        ('_MOTIF_WM_HINTS', '_MOTIF_WM_HINTS', 5),
+        )
+
     def __client_init__(self):
         assert self.mozpopup_keymap is not None
 
@@ -111,14 +116,11 @@ class InhibitMozillaPopups:
         if self.res_class != 'Mozilla-bin':
             return
 
-        MWM_HINTS = self.wm.display.intern_atom("_MOTIF_WM_HINTS")
-        WM_TRANSIENT_FOR = self.wm.display.intern_atom("WM_TRANSIENT_FOR")
-
-        r = self.window.get_property(WM_TRANSIENT_FOR, Xatom.WINDOW, 0, 1)
+        r = self.prefetch.get_property(Xatom.WM_TRANSIENT_FOR)
         if r is not None:
             return
 
-        r = self.window.get_property(MWM_HINTS, MWM_HINTS, 0, 5)
+        r = self.prefetch.get_property('_MOTIF_WM_HINTS')
         if r is None or r.format != 32 or len(r.value) != 5:
             return
 
@@ -55,8 +55,19 @@ class ModeWindowScreen:
         self.modewindow_mw.remove_message(message)
 
 class ModeWindow:
+
+    """A window displaying Messages along the top or bottom of a screen.
+
+    The messages are drawn into a backing pixmap, which is copied to
+    the window on Expose.  When messages change, the areas they cover
+    are marked as damaged, and all damage done while handling a batch
+    of events is repainted at once when the batch is finished.
+    """
+
     def __init__(self, screen, fg, bg, font, pos):
         self.messages = []
+        self.wm = screen.wm
+        self.font = font
 
         fq = font.query()
 
@@ -72,14 +83,25 @@ class ModeWindow:
 
         self.base = self.height / 2 + font_center
 
+        # No background, all painting is done from the pixmap
         window = screen.root.create_window(
             self.x, self.y, self.width, self.height, 0,
             X.CopyFromParent, X.InputOutput, X.CopyFromParent,
-            background_pixel = bg,
+            background_pixmap = X.NONE,
             event_mask = X.ExposureMask
             )
 
-        self.gc = window.create_gc(foreground = fg, font = font)
+        self.pixmap = window.create_pixmap(self.width, self.height,
+                                           screen.info.root_depth)
+        self.gc = self.pixmap.create_gc(foreground = fg, font = font)
+        self.bg_gc = self.pixmap.create_gc(foreground = bg)
+        self.pixmap.fill_rectangle(self.bg_gc, 0, 0, self.width, self.height)
+
+        # Horizontal (x, width) spans that must be repainted, and
+        # the messages that must be drawn in them
+        self.damaged = []
+        self.dirty = {}
+        self.render_pending = 0
 
         self.window = screen.add_internal_window(window)
         self.window.dispatch.add_handler(X.Expose, self.redraw)
@@ -100,9 +122,90 @@ class ModeWindow:
         except ValueError:
             pass
 
+    def damage(self, x, width, message = None):
+        """Mark the span from X with WIDTH pixels as needing a
+        repaint, because MESSAGE has changed or the area it covered
+        should be cleared.
+        """
+        if width > 0:
+            self.damaged.append((x, width))
+
+        if message is not None:
+            self.dirty[message] = 1
+
+        if not self.render_pending:
+            self.render_pending = 1
+            self.wm.after_batch(self.render)
+
+    def render(self):
+        """Repaint the damaged parts of the pixmap and copy them to
+        the window.
+        """
+        try:
+            spans = self.damaged
+            for m in self.dirty.keys():
+                if m.text and m.modewins.has_key(self):
+                    width, x = m.extent(self)
+                    spans.append((x, width))
+
+            self.damaged = []
+            self.dirty = {}
+
+            spans = merge_spans(spans, self.width)
+            if not spans:
+                return
+
+            for x, width in spans:
+                self.pixmap.fill_rectangle(self.bg_gc, x, 0,
+                                           width, self.height)
+
+            # Redraw all messages touching the cleared spans, not only
+            # the changed ones, as they may overlap
+            for m in self.messages:
+                if not m.text:
+                    continue
+
+                mwidth, mx = m.extent(self)
+                for x, width in spans:
+                    if mx < x + width and x < mx + mwidth:
+                        m.draw(self)
+                        break
+
+            for x, width in spans:
+                self.window.copy_area(self.gc, self.pixmap,
+                                      x, 0, width, self.height, x, 0)
+
+            self.wm.flush()
+        finally:
+            # Let the next damage schedule a render even if this
+            # one failed
+            self.render_pending = 0
+
     def redraw(self, event):
-        for m in self.messages:
-            m.draw(self)
+        self.window.copy_area(self.gc, self.pixmap,
+                              event.x, event.y, event.width, event.height,
+                              event.x, event.y)
+
+
+def merge_spans(spans, width):
+    """Return the list of (x, width) SPANS clipped to [0, WIDTH),
+    sorted and with overlapping spans merged.
+    """
+    spans.sort()
+    merged = []
+    for x, w in spans:
+        x2 = min(x + w, width)
+        x = max(x, 0)
+        if x >= x2:
+            continue
+
+        if merged and x <= merged[-1][1]:
+            if x2 > merged[-1][1]:
+                merged[-1][1] = x2
+        else:
+            merged.append([x, x2])
+
+    return [(x, x2 - x) for x, x2 in merged]
 
 
 class Message:
@@ -120,7 +223,7 @@ class Message:
 
     def add_to_mw(self, mw):
         self.modewins[mw] = None
-        self.draw(mw)
+        mw.damage(0, 0, self)
 
     def remove_from_mw(self, mw):
         self.undraw(mw)
@@ -135,24 +238,23 @@ class Message:
         for mw in self.modewins.keys():
             self.undraw(mw)
             self.modewins[mw] = None
-            self.draw(mw)
-
-    def draw(self, mw):
-        if not self.text:
-            return
+            mw.damage(0, 0, self)
 
+    def extent(self, mw):
+        """Return (width, x) of the area covered by the text in MW.
+        """
         pos = self.modewins[mw]
 
         if pos is None:
             # Get width
             if self.text:
-                f = mw.gc.query_text_extents(self.text)
+                f = mw.font.query_text_extents(self.text)
                 width = f.overall_width + 4
             else:
                 width = 0
 
             # Get x pos
-            x = (mw.width * self.position)
+            x = int(mw.width * self.position)
 
             if self.justification == CENTER:
                 x = x - width / 2
@@ -160,17 +262,24 @@ class Message:
             elif self.justification == RIGHT:
                 x = x - width
 
-            self.modewins[mw] = (width, x)
+            pos = self.modewins[mw] = (width, x)
 
-        else:
-            width, x = pos
+        return pos
 
-        mw.window.draw_text(mw.gc, x + 2, mw.base, self.text)
+    def draw(self, mw):
+        """Draw the text into the pixmap of MW.
+        """
+        if not self.text:
+            return
+
+        width, x = self.extent(mw)
+        mw.pixmap.draw_text(mw.gc, x + 2, mw.base, self.text)
 
     def undraw(self, mw):
+        """Clear the area covered by the text when MW is next rendered.
+        """
         pos = self.modewins[mw]
 
         if pos is not None:
             width, x = pos
-            mw.window.clear_area(x = x, width = width)
-
+            mw.damage(x, width)
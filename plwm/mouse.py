@@ -44,6 +44,7 @@ import string
 import wmanager
 import event
 import time
+import moveresize
 
 from keys import modifiers, ReleaseModifier
 
@@ -98,11 +99,27 @@ class MousegrabManager:
     # needs to ... depending on how you initialize it.  You  shouldn't
     # need to instantiate this guy.
 
+    # The grabs are reference counted, and reconciled with the buttons
+    # actually grabbed like keys.KeygrabManager does, so only the
+    # changes are sent to the server.
+
     def __init__(self, wm, window):
         self.wm = wm
         self.window = window
+
+        # Map hash_mousecode() to (buttonsym, modifiers, reference count)
         self.grabs = {}
 
+        # Map (button, modifiers) to the event mask of the button
+        # grabbed on the server
+        self.grabbed = {}
+
+        self.updating = 0
+
+        # Number of GrabButton and UngrabButton requests sent
+        self.grab_requests = 0
+        self.ungrab_requests = 0
+
     def ungrab_buttons(self, mouselist):
         """Ungrab some mouse buttons
 
@@ -110,54 +127,76 @@ class MousegrabManager:
         """
         for buttonsym, modifiers in mouselist:
             h = hash_mousecode(buttonsym, modifiers)
-            c = self.grabs.get(h, 0)
-            if c > 0:
-                if c == 1:
+            g = self.grabs.get(h)
+            if g is not None:
+                if g[2] == 1:
                     del self.grabs[h]
-                    self.window.ungrab_mouse(buttonsym,
-                                             modifiers & ~ReleaseModifier)
                 else:
-                    self.grabs[h] = self.grabs[h] - 1
+                    self.grabs[h] = (buttonsym, modifiers, g[2] - 1)
+
+        self.reconcile()
 
     def grab_buttons(self, mouselist):
         """Grab some mouse buttons
 
         MOUSELIST is a list of (mousecode, modifier) tuples.
         """
-
-        grabs = {}
-
         for buttonsym, modifiers in mouselist:
             h = hash_mousecode(buttonsym, modifiers)
-            c = self.grabs.get(h, 0)
-            if c == 0:
-                button = buttonsym%8
-                mask = buttonsym/8
-
-                if mask==0:
-                    mask = X.ButtonPressMask
-                elif mask==1:
-                    mask = X.ButtonReleaseMask
-                else:
-                    mask = X.ButtonMotionMask
+            g = self.grabs.get(h)
+            if g is None:
+                self.grabs[h] = (buttonsym, modifiers, 1)
+            else:
+                self.grabs[h] = (buttonsym, modifiers, g[2] + 1)
 
-                try:
-                    mask |= grabs[hash_mousecode(button,modifiers)][2]
-                except:
-                    pass
+        self.reconcile()
+
+    def begin_update(self):
+        """Postpone sending grab changes until end_update().
+        """
+        self.updating = self.updating + 1
 
-                grabs[hash_mousecode(button,modifiers)] = (button,
-                                                           modifiers,
-                                                           mask)
+    def end_update(self):
+        self.updating = self.updating - 1
+        self.reconcile()
 
-                self.grabs[h] = 1
+    def reconcile(self):
+        """Send the grab changes needed to make the grabbed buttons
+        match the wanted buttons.
+        """
+        if self.updating:
+            return
+
+        # Combine the event masks of all buttonsyms of a button
+        wanted = {}
+        for buttonsym, modifiers, count in self.grabs.values():
+            button = buttonsym%8
+            kind = buttonsym/8
+
+            if kind==0:
+                mask = X.ButtonPressMask
+            elif kind==1:
+                mask = X.ButtonReleaseMask
             else:
-                self.grabs[h] = self.grabs[h] + 1
-
-            for k in grabs.keys():
-                button,modifiers,mask = grabs[k]
-                self.window.grab_button(button,
-                                        modifiers,
+                mask = X.ButtonMotionMask
+
+            key = (button, modifiers & ~ReleaseModifier)
+            wanted[key] = wanted.get(key, 0) | mask
+
+        changes = 0
+        for key in self.grabbed.keys():
+            if not wanted.has_key(key):
+                self.window.ungrab_button(key[0], key[1])
+                del self.grabbed[key]
+                self.ungrab_requests = self.ungrab_requests + 1
+                changes = changes + 1
+
+        # Grabbing a button again replaces the previous grab, so
+        # changed masks can just be regrabbed
+        for key, mask in wanted.items():
+            if self.grabbed.get(key) != mask:
+                self.window.grab_button(key[0],
+                                        key[1],
                                         True,
                                         mask,
                                         X.GrabModeAsync,
@@ -165,7 +204,14 @@ class MousegrabManager:
                                         X.NONE,
                                         X.NONE,
                                         None)
+                self.grabbed[key] = mask
+                self.grab_requests = self.grab_requests + 1
+                changes = changes + 1
 
+        if changes:
+            wmanager.debug('mouse', '%s: %d grab changes, %d buttons grabbed',
+                           self.window, changes, len(self.grabbed))
+            self.wm.flush()
 
     def grab_pointer(self, time):
         s = self.window.grab_pointer(0, X.GrabModeAsync, X.GrabModeAsync, time)
@@ -342,6 +388,17 @@ class MouseHandler:
 
         Also sets passive grabs for the mouse bindings.
         """
+        # Only send the changed grabs when we're done
+        for g in self.grabmgrs:
+            g.begin_update()
+
+        try:
+            self._rebuild()
+        finally:
+            for g in self.grabmgrs:
+                g.end_update()
+
+    def _rebuild(self):
         self.bindings = {}
 
 
@@ -471,25 +528,53 @@ class MoveResize(MouseHandler):
     Alt+middle button will resize your window either horizontally or
                vertically.
 
+    Only the latest pointer position is used when several motion
+    events are queued, and the window is reconfigured at most
+    update_rate times per second.  The final geometry is always
+    applied when the button is released.
     """
 
+    update_rate = 30
+
     def __init__(self,wm):
         MouseHandler.__init__(self,wm)
+        self.client = None
+        self.throttle = moveresize.Throttle(self.wm, self._configure,
+                                            self.update_rate)
 
-    def C_M_LDown(self,evt):
+    def _start(self,evt):
         self.client = self.wm.current_client
         self.dir = None
         if self.client:
+            c = self.client
             self.mouse_x, self.mouse_y = evt.root_x, evt.root_y
+            self.geometry = (c.x, c.y, c.width, c.height)
+
+    def _finish(self):
+        # Apply the final geometry now
+        self.throttle.flush()
+        self.client = None
+
+    def _delta(self,evt):
+        # Return the pointer movement since the button was pressed
+        if evt.type == X.MotionNotify:
+            evt = self.wm.events.latest_motion(evt)
+        return evt.root_x-self.mouse_x, evt.root_y-self.mouse_y
+
+    def _configure(self,c,x,y,width,height):
+        c.configure(x=x,y=y,width=max(width,1),height=max(height,1))
+
+    def C_M_LDown(self,evt):
+        self._start(evt)
 
     def C_M_LUp(self,evt):
         self.C_M_LMove(evt)
-        self.client = None
+        self._finish()
 
     def C_M_LMove(self,evt):
         if self.client:
-            c = self.client
-            dx,dy = evt.root_x-self.mouse_x, evt.root_y-self.mouse_y
+            x,y,w,h = self.geometry
+            dx,dy = self._delta(evt)
             if self.dir==None:
                 if dx<0:
                     if dy<0: self.dir = 0 # left and up
@@ -499,51 +584,38 @@ class MoveResize(MouseHandler):
                     if dy>0: self.dir = 2 # right and down
 
             if self.dir==0:
-                c.configure(x=c.x+dx,y=c.y+dy,
-                            width=c.width-dx,height=c.height-dy)
+                self.throttle(self.client,x+dx,y+dy,w-dx,h-dy)
             elif self.dir==1:
-                c.configure(x=c.x,y=c.y+dy,
-                            width=c.width+dx,height=c.height-dy)
+                self.throttle(self.client,x,y+dy,w+dx,h-dy)
             elif self.dir==2:
-                c.configure(x=c.x,y=c.y,
-                            width=c.width+dx,height=c.height+dy)
+                self.throttle(self.client,x,y,w+dx,h+dy)
             elif self.dir==3:
-                c.configure(x=c.x+dx,y=c.y,
-                            width=c.width-dx,height=c.height+dy)
-            self.mouse_x = evt.root_x
-            self.mouse_y = evt.root_y
+                self.throttle(self.client,x+dx,y,w-dx,h+dy)
 
     def M_LDown(self,evt):
-        self.client = self.wm.current_client
-        if self.client:
-            self.mouse_x, self.mouse_y = evt.root_x, evt.root_y
+        self._start(evt)
 
     def M_LUp(self,evt):
         self.M_LMove(evt)
-        self.client = None
+        self._finish()
 
     def M_LMove(self,evt):
         if self.client:
-            c = self.client
-            dx,dy = evt.root_x-self.mouse_x, evt.root_y-self.mouse_y
-            c.configure(x=c.x+dx,y=c.y+dy,width=c.width,height=c.height)
-            self.mouse_x = evt.root_x
-            self.mouse_y = evt.root_y
+            x,y,w,h = self.geometry
+            dx,dy = self._delta(evt)
+            self.throttle(self.client,x+dx,y+dy,w,h)
 
     def M_MDown(self,evt):
-        self.client = self.wm.current_client
-        self.dir = None
-        if self.client:
-            self.mouse_x, self.mouse_y = evt.root_x, evt.root_y
+        self._start(evt)
 
     def M_MUp(self,evt):
         self.M_MMove(evt)
-        self.client = None
+        self._finish()
 
     def M_MMove(self,evt):
         if self.client:
-            c = self.client
-            dx,dy = evt.root_x-self.mouse_x, evt.root_y-self.mouse_y
+            x,y,w,h = self.geometry
+            dx,dy = self._delta(evt)
             if self.dir==None:
                 if abs(dx)>abs(dy):
                     if dx<0: self.dir = 3
@@ -554,16 +626,10 @@ class MoveResize(MouseHandler):
 
             if self.dir!=None:
                 if self.dir==0:
-                    c.configure(x=c.x,y=c.y+dy,
-                                width=c.width,height=c.height-dy)
+                    self.throttle(self.client,x,y+dy,w,h-dy)
                 elif self.dir==1:
-                    c.configure(x=c.x,y=c.y,
-                                width=c.width+dx,height=c.height)
+                    self.throttle(self.client,x,y,w+dx,h)
                 elif self.dir==2:
-                    c.configure(x=c.x,y=c.y,
-                                width=c.width,height=c.height+dy)
+                    self.throttle(self.client,x,y,w,h+dy)
                 elif self.dir==3:
-                    c.configure(x=c.x+dx,y=c.y,
-                                width=c.width-dx,height=c.height)
-            self.mouse_x = evt.root_x
-            self.mouse_y = evt.root_y
+                    self.throttle(self.client,x+dx,y,w-dx,h)
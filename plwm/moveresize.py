@@ -19,11 +19,103 @@
 
 
 from Xlib import X
+import time
 import keys
 import deltamove
 import wmanager
+import event
+
+class Throttle:
+    """Call a function at most RATE times per second.
+
+    Calls that come too soon after the previous one are postponed
+    with a timer, and only the arguments of the last of them are
+    used.  This is meant for functions where each call supersedes the
+    earlier ones, e.g. reconfiguring a window.
+    """
+
+    def __init__(self, wm, func, rate):
+        """Throttle calls to FUNC to RATE per second.  If RATE is 0
+        FUNC is always called immediately.
+        """
+        self.wm = wm
+        self.func = func
+        if rate:
+            self.interval = 1.0 / rate
+        else:
+            self.interval = 0
+
+        self.last_call = 0
+        self.pending = None
+        self.timer = None
+        self.timer_id = event.new_event_type()
+        self.wm.dispatch.add_handler(self.timer_id, self._timeout,
+                                     handlerid = self)
+
+        self.calls = 0
+        self.postponed = 0
+
+    def __call__(self, *args):
+        if self.timer is not None:
+            self.pending = args
+            self.postponed = self.postponed + 1
+            return
+
+        next_call = self.last_call + self.interval
+        if self.interval and time.time() < next_call:
+            self.pending = args
+            self.postponed = self.postponed + 1
+            self.timer = event.TimerEvent(self.timer_id, at = next_call)
+            self.wm.events.add_timer(self.timer)
+            return
+
+        self._call(args)
+
+    def _call(self, args):
+        self.last_call = time.time()
+        self.calls = self.calls + 1
+        apply(self.func, args)
+
+    def _timeout(self, evt):
+        self.timer = None
+        args = self.pending
+        self.pending = None
+        if args is not None:
+            self._call(args)
+
+    def flush(self):
+        """Make any postponed call now.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        args = self.pending
+        self.pending = None
+        if args is not None:
+            self._call(args)
+
+    def close(self):
+        """Drop any postponed call and stop the throttle.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self.pending = None
+        if self.func is not None:
+            self.wm.dispatch.remove_handler(self)
+            self.func = None
+            wmanager.debug('moveresize', '%d calls made, %d postponed',
+                           self.calls, self.postponed)
+
 
 class MoveResize:
+
+    # The most geometry updates to do per second, or 0 to update on
+    # every step.  The final geometry is always applied when finished.
+    update_rate = 30
+
     def __init__(self, client, delta = deltamove.DeltaMove()):
         """Start to move/resize CLIENT.
 
@@ -52,6 +144,8 @@ class MoveResize:
         else:
             self.ptrx, self.ptry = None, None
 
+        self.throttle = Throttle(self.client.wm, self.update, self.update_rate)
+
         self.client.wm.events.put_event(MoveResizeStart(self.client))
 
     def setposition(self,x,y):
@@ -107,10 +201,22 @@ class MoveResize:
                                            self.width, self.height)
 
     def do(self):
+        """Update the client geometry, or postpone it if the last
+        update was too recent.
+        """
+        self.throttle()
+
+    def update(self):
+        """Update the client to the current geometry.  Subclasses
+        should extend this method rather than do().
+        """
         self.client.wm.events.put_event(MoveResizeDo(self.client, self.x, self.y,
                                                      self.width, self.height))
 
     def end(self):
+        self.throttle.flush()
+        self.throttle.close()
+
         if self.ptrx is not None and self.ptrx < self.width + self.borderwidth \
            and self.ptry < self.height + self.borderwidth:
             self.client.warppointer(self.ptrx, self.ptry)
@@ -119,12 +225,13 @@ class MoveResize:
         self.client = None
 
     def abort(self):
+        self.throttle.close()
         self.client.wm.events.put_event(MoveResizeAbort(self.client))
         self.client = None
 
 class MoveResizeOpaque(MoveResize):
-    def do(self):
-        MoveResize.do(self)
+    def update(self):
+        MoveResize.update(self)
         self.client.moveresize(self.x, self.y, self.width, self.height)
 
 class MoveResizeOutline(MoveResize):
@@ -137,11 +244,16 @@ class MoveResizeOutline(MoveResize):
         h = self.height + 2 * self.borderwidth
         self.client.outline_show(self.x, self.y, w, h)
 
-    def do(self):
-        MoveResize.do(self)
+    def update(self):
+        MoveResize.update(self)
         self.outline_show()
 
     def end(self):
+        # No point in drawing a postponed outline just to hide it,
+        # but do report the final geometry
+        if self.throttle.pending is not None:
+            MoveResize.update(self)
+        self.throttle.close()
         self.client.outline_hide()
         self.client.moveresize(self.x, self.y, self.width, self.height)
         MoveResize.end(self)
@@ -51,16 +51,16 @@ class TransparentClient:
 			'_NET_WM_WINDOW_OPACITY'
 		)
 
-		if not self.opacity_ignore_clients(self):
+		if not cfilter.compiled(self.opacity_ignore_clients)(self):
 			for filter, opacity in self.opacity_focused_clients:
-				if filter(self):
+				if cfilter.compiled(filter)(self):
 					self.opacity_focused = opacity
 					break
 			else:
 				self.opacity_focused = self.opacity_focused_default
 
 			for filter, opacity in self.opacity_unfocused_clients:
-				if filter(self):
+				if cfilter.compiled(filter)(self):
 					self.opacity_unfocused = opacity
 					break
 			else:
@@ -107,5 +107,5 @@ class TransparentClient:
 			X.PropModeReplace
 		)
 
-		self.wm.display.sync()
+		self.wm.flush()
 
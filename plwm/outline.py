@@ -50,6 +50,10 @@ class XorOutlineClient:
         self.outline_segments = None
         self.outline_name = None
 
+    def __client_del__(self):
+        self.outline_gc.free()
+        self.wm.release_font(self.outline_font)
+
     def outline_show(self, x = None, y = None, w = None, h = None, name = None):
 
         # Undraw a possible existing outline
@@ -86,6 +90,41 @@ class WindowOutlineClient:
     messiness of windows changing their contents under an XorOutline,
     and it also works on all varieties of screen depth and color maps.
 
+    The windows are shared by all clients on a screen, see
+    WindowOutline.  Only one client at a time can show an outline
+    this way, showing another one hides the previous outline.
+    """
+
+    def __client_init__(self):
+        self.outline = get_window_outline(self.screen)
+        self.outline_font = self.outline.font
+
+    def __client_del__(self):
+        # Don't leave the outline of a removed client on the screen
+        self.outline.hide(self)
+
+    def outline_show(self, x = None, y = None, w = None, h = None, name = None):
+        coords, segments, namepos = \
+                calculate_parts(self, x, y, w, h, name)
+
+        self.outline.show(self, segments, name, namepos)
+
+    def outline_hide(self):
+        self.outline.hide(self)
+
+
+def get_window_outline(screen):
+    """Return the WindowOutline of SCREEN, creating it if necessary.
+    """
+    if not hasattr(screen, 'window_outline'):
+        screen.window_outline = WindowOutline(screen)
+    return screen.window_outline
+
+
+class WindowOutline:
+
+    """The outline windows of a screen, used by WindowOutlineClient.
+
     The windows in the grid will simulate lines, by being one pixel
     wide and having a border width of one pixel.  The border is set to
     black and the window background is set to white, thus relying on
@@ -96,75 +135,105 @@ class WindowOutlineClient:
     background and white foreground.  No tracking of Exposure is done,
     since the outline is always on top, at least when it is first shown.
 
+    The windows are allocated the first time an outline is shown, and
+    then reused by all clients.  Only the bars whose segment has
+    changed since the last outline are reconfigured.
+
     TODO: add X resources for the colours used by the outline.
     """
 
-    def __client_init__(self):
-        self.outline_font = self.wm.get_font_res('.outline.font',
-                                                 '.Outline.Font',
-                                                 'fixed')
+    def __init__(self, screen):
+        self.screen = screen
+        self.font = screen.wm.get_font_res('.outline.font',
+                                           '.Outline.Font',
+                                           'fixed')
 
-        # Postpone allocattion of outline windows until
+        # Postpone allocation of outline windows until
         # they are needed
-        self.outline_windows = None
-        self.outline_name_window = None
-        self.outline_name_gc = None
-        self.outline_mapped = 0
-
-    def __client_del__(self):
-        if self.outline_windows is None:
-            return
-
-        # Drop the resources held by the outline windows
-        wmanager.debug('outline', 'freeing windows')
-        for w in self.outline_windows:
-            w.destroy()
-        self.outline_name_gc.free()
-        self.outline_name_window.destroy()
-
-    def outline_show(self, x = None, y = None, w = None, h = None, name = None):
-        coords, segments, namepos = \
-                calculate_parts(self, x, y, w, h, name)
-
-        if self.outline_windows is None:
+        self.windows = None
+        self.name_window = None
+        self.name_gc = None
+
+        # The client currently showing the outline, and what is
+        # currently displayed by the windows
+        self.owner = None
+        self.segments = [None] * 8
+        self.name = None
+        self.namepos = None
+        self.mapped = 0
+        self.name_mapped = 0
+
+    def show(self, owner, segments, name, namepos):
+        """Show the outline SEGMENTS and NAME at NAMEPOS, as computed
+        by calculate_parts(), on behalf of the client OWNER.
+        """
+
+        if self.windows is None:
             self.allocate_windows()
 
+        self.owner = owner
+
         for i in range(0, 8):
-            w = self.outline_windows[i]
             s = segments[i]
-            w.configure(x = s[0] - 1, y = s[1] - 1,
-                        width = s[2] - s[0] + 1,
-                        height = s[3] - s[1] + 1)
+            if s != self.segments[i]:
+                self.windows[i].configure(x = s[0] - 1, y = s[1] - 1,
+                                          width = s[2] - s[0] + 1,
+                                          height = s[3] - s[1] + 1)
+                self.segments[i] = s
 
+        redraw = 0
         if name:
-            sx, sy, sw, sh, asc = namepos
-            self.outline_name_window.configure(x = sx, y = sy - asc,
-                                               width = sw, height = sh)
-
-        if not self.outline_mapped:
-            for w in self.outline_windows:
+            if namepos != self.namepos:
+                sx, sy, sw, sh, asc = namepos
+                self.name_window.configure(x = sx, y = sy - asc,
+                                           width = sw, height = sh)
+                self.namepos = namepos
+                redraw = 1
+
+            if name != self.name:
+                self.name = name
+                redraw = 1
+
+        elif self.name_mapped:
+            self.name_window.unmap()
+            self.name_mapped = 0
+
+        if not self.mapped:
+            for w in self.windows:
                 w.configure(stack_mode = X.Above)
                 w.map()
-            if name:
-                self.outline_name_window.configure(stack_mode = X.Above)
-                self.outline_name_window.map()
-            self.outline_mapped = 1
+            self.mapped = 1
+
+        if name and not self.name_mapped:
+            self.name_window.configure(stack_mode = X.Above)
+            self.name_window.map()
+            self.name_mapped = 1
+            redraw = 1
 
         # draw text first after having mapped the window, as it will
         # disappear otherwise...
-        if name:
-            self.outline_name_window.image_text(self.outline_name_gc,
-                                                0, asc, name)
+        if redraw:
+            asc = namepos[4]
+            self.name_window.image_text(self.name_gc, 0, asc, name)
+
+    def hide(self, owner):
+        """Hide the outline, if it is currently shown by OWNER.
+        """
+        if owner is not self.owner:
+            return
 
-    def outline_hide(self):
-        if self.outline_mapped:
-            for w in self.outline_windows:
+        self.owner = None
+        if self.mapped:
+            for w in self.windows:
                 w.unmap()
-            self.outline_name_window.unmap()
-            self.outline_mapped = 0
+            self.mapped = 0
+
+        if self.name_mapped:
+            self.name_window.unmap()
+            self.name_mapped = 0
 
     def allocate_windows(self):
-        self.outline_windows = []
+        self.windows = []
 
         # Allocate horizontal and vertical bars
         for i in range(0, 8):
@@ -174,7 +243,7 @@ class WindowOutlineClient:
                 background_pixel = self.screen.info.white_pixel,
                 save_under = 1
                 )
-            self.outline_windows.append(w)
+            self.windows.append(w)
 
         # Allocate text window
         w = self.screen.root.create_window(
@@ -183,12 +252,14 @@ class WindowOutlineClient:
             background_pixel = self.screen.info.black_pixel,
             save_under = 1
             )
-        self.outline_name_window = w
-        self.outline_name_gc = w.create_gc(
+        self.name_window = w
+        self.name_gc = w.create_gc(
             foreground = self.screen.info.white_pixel,
             background = self.screen.info.black_pixel,
-            font = self.outline_font
+            font = self.font
             )
+        wmanager.debug('outline', 'allocated windows for screen %d',
+                       self.screen.number)
 
 
 def calculate_parts(client, x, y, w, h, name):
@@ -181,12 +181,14 @@ class panesClient:
     Note that this needs to be mixed in *after* any mixins that affect window
     geometry, such as border."""
 
+    __client_prefetch__ = ((Xatom.WM_TRANSIENT_FOR, Xatom.WINDOW, 1),)
+
     def __client_init__(self):
         "Arrange to open in the current pane."
 
         wmanager.debug('Pane', 'Initing client %s', self)
         # Set this clients gravity
-        if self.window.get_property(WM_TRANSIENT_FOR, Xatom.WINDOW, 0, 1) is not None:
+        if self.prefetch.get_property(Xatom.WM_TRANSIENT_FOR) is not None:
             self.panes_gravity = self.wm.panes_transient_gravity
         elif self.sizehints and self.sizehints.flags & Xutil.PMaxSize:
             self.panes_gravity = self.wm.panes_maxsize_gravity
@@ -296,7 +298,7 @@ class Pane:
 
         if not self.window: return
         self.window.resize(self.width / 2, self.height / 2)
-        self.wm.display.flush()
+        self.wm.flush()
         self.place_window()
 
     def next_window(self):
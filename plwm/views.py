@@ -567,13 +567,14 @@ class View:
 
         # Find all the current windows
         clients = self.screen.query_clients(stackorder = 1)
+        always_visible = cfilter.compiled(self.screen.view_always_visible_clients)
         self.winconf = []
         for c in clients:
             x, y, w, h = c.geometry()[0:4]
             self.winconf.append(WinConf(c, x, y, w, h, c.is_mapped()))
 
             if c.is_mapped() \
-               and not self.screen.view_always_visible_clients(c):
+               and not always_visible(c):
                 empty = 0
 
         # Find the pointer positon
@@ -611,8 +612,9 @@ class View:
         mapc = {}
         for w in self.winconf:
             mapc[w.client] = w.mapped
+        always_visible = cfilter.compiled(self.screen.view_always_visible_clients)
         for w in winconf:
-            if not mapc.get(w.client, 0) and not self.screen.view_always_visible_clients(w.client):
+            if not mapc.get(w.client, 0) and not always_visible(w.client):
                 w.client.iconify()
 
         # Move the pointer, if that has been stored previously
@@ -28,15 +28,23 @@ import re
 import string
 import types
 import time
+import collections
+import bisect
 
 from Xlib import display, X, Xutil, Xatom, rdb, error
+from Xlib.xobject import icccm
 import Xlib.protocol.event
+import Xlib.protocol.request
 
 import plwm
 import event
+from event import TimerEvent
 import wmevents
 import filters
 
+# cfilter imports this module, but only uses it in function bodies
+import cfilter
+
 # Minimum Xlib version
 required_xlib_version = (0, 14)
 
@@ -157,6 +165,7 @@ class Window:
             setattr(self, i, keys.get(i, getattr(self, i)))
 
         apply(self.window.configure, (), keys)
+        self.screen.client_index.update(self)
 
 
     def is_mapped(self):
@@ -183,6 +192,7 @@ class Window:
         self.window.configure(width = width, height = height)
         self.width = width
         self.height = height
+        self.screen.client_index.update(self)
 
 
     def move(self, x, y):
@@ -191,6 +201,7 @@ class Window:
         self.window.configure(x = x, y = y)
         self.x = x
         self.y = y
+        self.screen.client_index.update(self)
 
 
     def moveresize(self, x, y, width, height, delayed = 0):
@@ -209,6 +220,7 @@ class Window:
         self.y = y
         self.width = width
         self.height = height
+        self.screen.client_index.update(self)
 
 
     def setborderwidth(self, width):
@@ -216,6 +228,7 @@ class Window:
             return
         self.window.configure(border_width = width)
         self.border_width = width
+        self.screen.client_index.update(self)
 
 
     def set_border_color(self, color):
@@ -362,11 +375,13 @@ class Window:
         if self.withdrawn:
             return
         self.window.configure(stack_mode = X.Above)
+        self.screen.stacking.raise_window(self.screen.top_level_window(self.window))
 
     def lowerwindow(self):
         if self.withdrawn:
             return
         self.window.configure(stack_mode = X.Below)
+        self.screen.stacking.lower_window(self.screen.top_level_window(self.window))
 
     def raiselower(self):
         if self.withdrawn:
@@ -377,6 +392,359 @@ class Window:
 class InternalWindow(Window):
     pass
 
+
+class StackingOrder:
+    """Track the stacking order of the children of a root window.
+
+    The order is updated from the SubstructureNotify events of the
+    root window, so it can be queried without any round trips.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+        # The children, lowest window first
+        self.windows = []
+
+        # Number of times reconcile() found the order out of date
+        self.drift = 0
+
+    def reset(self, windows):
+        self.windows = list(windows)
+
+    def reconcile(self):
+        """Fetch the real stacking order from the server.
+        Returns true if the tracked order was out of date.
+        """
+        wins = self.root.query_tree().children
+        if wins != self.windows:
+            debug('stacking', 'stacking order drifted, resetting')
+            self.drift = self.drift + 1
+            self.windows = list(wins)
+            return 1
+        return 0
+
+    def remove(self, window):
+        try:
+            self.windows.remove(window)
+        except ValueError:
+            pass
+
+    def raise_window(self, window):
+        self.remove(window)
+        self.windows.append(window)
+
+    def lower_window(self, window):
+        self.remove(window)
+        self.windows.insert(0, window)
+
+    def place_above(self, window, sibling):
+        """Place WINDOW directly above SIBLING, or lowest if SIBLING is
+        X.NONE.
+        """
+        self.remove(window)
+        if not sibling:
+            self.windows.insert(0, window)
+        else:
+            try:
+                i = self.windows.index(sibling)
+            except ValueError:
+                self.windows.append(window)
+            else:
+                self.windows.insert(i + 1, window)
+
+    def handle_event(self, event):
+        """Update the order from EVENT, which must have been
+        reported on the root window.
+        """
+        if event.type == X.CreateNotify:
+            self.raise_window(event.window)
+
+        elif event.type == X.DestroyNotify:
+            self.remove(event.window)
+
+        elif event.type == X.ReparentNotify:
+            if event.parent == self.root:
+                self.raise_window(event.window)
+            else:
+                self.remove(event.window)
+
+        elif event.type == X.ConfigureNotify:
+            self.place_above(event.window, event.above_sibling)
+
+        elif event.type == X.CirculateNotify:
+            if event.place == X.PlaceOnTop:
+                self.raise_window(event.window)
+            else:
+                self.lower_window(event.window)
+
+
+class ClientIndex:
+    """Spatial index of the mapped clients on a screen.
+
+    The clients are kept in a grid of cell_size square cells, to find
+    the clients at a point, and in sorted lists of their edges, to
+    find the closest client in some direction.  The index is updated
+    by the clients whenever they move, resize, map or unmap.
+    """
+
+    cell_size = 128
+
+    # Edge names, as in the Window.get_*_edge() methods
+    edge_names = ('top', 'bottom', 'left', 'right')
+
+    def __init__(self):
+        # Map indexed clients to their rectangle (x0, y0, x1, y1), or
+        # None if they aren't mapped
+        self.rects = {}
+
+        # Map (column, row) to dicts of the clients overlapping
+        # that cell
+        self.cells = {}
+
+        # Map edge names to sorted lists of (position, id(client))
+        self.edges = {}
+        for e in self.edge_names:
+            self.edges[e] = []
+
+        # Map id(client) to client
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.rects)
+
+    def add(self, client):
+        self.rects[client] = None
+        self.ids[id(client)] = client
+        self.update(client)
+
+    def remove(self, client):
+        if self.rects.has_key(client):
+            self._unindex(client)
+            del self.rects[client]
+            del self.ids[id(client)]
+
+    def update(self, client):
+        """Reindex CLIENT after a change of geometry or mapped state.
+        Does nothing if CLIENT isn't in the index.
+        """
+        if not self.rects.has_key(client):
+            return
+
+        if client.mapped and not client.withdrawn:
+            rect = (client.get_left_edge(), client.get_top_edge(),
+                    client.get_right_edge(), client.get_bottom_edge())
+        else:
+            rect = None
+
+        if rect != self.rects[client]:
+            self._unindex(client)
+            self.rects[client] = rect
+            if rect is not None:
+                self._index(client)
+
+    def _cell_range(self, rect):
+        x0, y0, x1, y1 = rect
+        s = self.cell_size
+        for col in range(x0 / s, (max(x1, x0 + 1) - 1) / s + 1):
+            for row in range(y0 / s, (max(y1, y0 + 1) - 1) / s + 1):
+                yield col, row
+
+    def _edge_positions(self, rect):
+        x0, y0, x1, y1 = rect
+        return (('top', y0), ('bottom', y1), ('left', x0), ('right', x1))
+
+    def _index(self, client):
+        rect = self.rects[client]
+        for cell in self._cell_range(rect):
+            self.cells.setdefault(cell, {})[client] = 1
+
+        key = id(client)
+        for e, pos in self._edge_positions(rect):
+            bisect.insort(self.edges[e], (pos, key))
+
+    def _unindex(self, client):
+        rect = self.rects[client]
+        if rect is None:
+            return
+
+        for cell in self._cell_range(rect):
+            clients = self.cells[cell]
+            del clients[client]
+            if not clients:
+                del self.cells[cell]
+
+        key = id(client)
+        for e, pos in self._edge_positions(rect):
+            edges = self.edges[e]
+            del edges[bisect.bisect_left(edges, (pos, key))]
+
+    def clients_at(self, x, y):
+        """Return the mapped clients containing the point X, Y,
+        including their borders.
+        """
+        s = self.cell_size
+        clients = []
+        for c in self.cells.get((x / s, y / s), {}).keys():
+            x0, y0, x1, y1 = self.rects[c]
+            if x0 <= x < x1 and y0 <= y < y1:
+                clients.append(c)
+        return clients
+
+    def nearest(self, edge, pos, after, accept):
+        """Return the clients whose EDGE is closest to POS.
+
+        If AFTER is true, only edges greater than POS are considered,
+        otherwise only edges less than POS.  If POS is None, the
+        clients with the smallest or greatest edge are returned
+        instead.  Clients for which ACCEPT(client) is false are
+        ignored.
+
+        All clients at the closest position are returned, in no
+        particular order.  The list is empty if no client was found.
+        """
+
+        edges = self.edges[edge]
+        if after:
+            if pos is None:
+                i = 0
+            else:
+                i = bisect.bisect_left(edges, (pos + 1, ))
+            indices = xrange(i, len(edges))
+        else:
+            if pos is None:
+                i = len(edges)
+            else:
+                i = bisect.bisect_left(edges, (pos, ))
+            indices = xrange(i - 1, -1, -1)
+
+        found = []
+        found_pos = None
+        for i in indices:
+            p, key = edges[i]
+            if found and p != found_pos:
+                break
+
+            c = self.ids[key]
+            if accept(c):
+                found.append(c)
+                found_pos = p
+
+        return found
+
+
+class PropertyPrefetch:
+    """Fetch several properties of a window with pipelined requests.
+
+    The GetProperty requests for all the properties are sent when the
+    object is created, but the replies are only read when a property
+    is retrieved.  Fetching N properties thus costs a single round
+    trip instead of N.
+    """
+
+    def __init__(self, disp, window, properties):
+        """Fetch PROPERTIES of WINDOW on the display DISP.
+
+        PROPERTIES is a sequence of (property, type, length) tuples.
+        The property and type can be atoms or atom names, and length
+        is the number of 32-bit units to fetch.
+        """
+
+        self.display = disp
+        self.window = window
+
+        # Map property atoms to (type, length, request), and after
+        # the reply has been read to (type, length, result)
+        self.requests = {}
+        self.results = {}
+
+        for prop, ptype, length in properties:
+            prop = self.atom(prop)
+            if self.requests.has_key(prop):
+                continue
+
+            ptype = self.atom(ptype)
+            r = Xlib.protocol.request.GetProperty(display = window.display,
+                                                  defer = 1,
+                                                  delete = 0,
+                                                  window = window.id,
+                                                  property = prop,
+                                                  type = ptype,
+                                                  long_offset = 0,
+                                                  long_length = length)
+            self.requests[prop] = (ptype, length, r)
+
+    def atom(self, atom):
+        if type(atom) is types.StringType:
+            return self.display.get_atom(atom)
+        else:
+            return atom
+
+    def get_property(self, prop):
+        """Return PROP like Window.get_property() would, that is the
+        reply with format and value set, or None if the property
+        isn't set or has another type.
+
+        PROP must be one of the prefetched properties.
+        """
+
+        prop = self.atom(prop)
+        try:
+            return self.results[prop]
+        except KeyError:
+            pass
+
+        ptype, length, r = self.requests[prop]
+        r.reply()
+
+        if r.property_type:
+            fmt, value = r.value
+            r.format = fmt
+            r.value = value
+        else:
+            r = None
+
+        self.results[prop] = r
+        return r
+
+    def get_struct(self, prop, pstruct):
+        """Return PROP parsed as the Struct PSTRUCT, or None.
+        """
+        r = self.get_property(prop)
+        if r and r.format == 32:
+            value = r.value.tostring()
+            if len(value) == pstruct.static_size:
+                return pstruct.parse_binary(value, self.display.display)[0]
+
+        return None
+
+    def get_text(self, prop):
+        """Return the full value of the text property PROP, or None.
+        """
+        r = self.get_property(prop)
+        if r is None or r.format != 8:
+            return None
+
+        # Didn't fetch enough, get the rest synchronously
+        if r.bytes_after:
+            ptype, length, req = self.requests[self.atom(prop)]
+            r2 = self.window.get_property(self.atom(prop), ptype, length,
+                                          r.bytes_after / 4 + 1)
+            if r2 is None:
+                return None
+            return r.value + r2.value
+
+        return r.value
+
+    def get_atoms(self, prop):
+        """Return the property PROP as a list of atoms.
+        """
+        r = self.get_property(prop)
+        if r is None or r.format != 32:
+            return []
+        else:
+            return list(r.value)
+
 class Client(Window):
     "Container for clients of the window manager."
 
@@ -384,25 +752,41 @@ class Client(Window):
     default_pointer_pos = {}
     client_maxsize = {}
 
+    # Properties fetched with a single round trip when a client is
+    # created, as (property, type, length) tuples.  Mixins can add
+    # to this by defining a __client_prefetch__ attribute with more
+    # properties, which can then be retrieved during
+    # __client_init__ with self.prefetch.get_property().
+    __client_prefetch__ = (
+        (Xatom.WM_HINTS, Xatom.WM_HINTS, icccm.WMHints.static_size / 4),
+        (Xatom.WM_NORMAL_HINTS, Xatom.WM_SIZE_HINTS,
+         icccm.WMNormalHints.static_size / 4),
+        ('WM_PROTOCOLS', Xatom.ATOM, 32),
+        (Xatom.WM_CLASS, Xatom.STRING, 64),
+        ('WM_STATE', 'WM_STATE', icccm.WMState.static_size / 4),
+        (Xatom.WM_NAME, Xatom.STRING, 64),
+        )
+
+
     # set below to avoid circular imports
     needs_reparent_clients = None
 
     window_proxy_class = None
     
-    def __init__(self, screen, window, maprequest):
+    def __init__(self, screen, window, maprequest, prefetch = None):
         """Create a client object managing WINDOW.
 
         If MAPPED is true, this client has been created
         because of a MapRequest event.  If false, it was created
         when the window manager started and scanned available
         windows.
+
+        PREFETCH is an optional PropertyPrefetch for the properties
+        returned by client_prefetch_properties().
         """
 
         if Client.needs_reparent_clients is None:
-            # now we can import cfilter safely
-            import cfilter
             Client.needs_reparent_clients = cfilter.name('AWTapp')
-            del cfilter
 
         # Let any window proxy in on the fun
         if self.window_proxy_class is not None:
@@ -424,17 +808,41 @@ class Client(Window):
         self.dispatch.add_system_handler(X.UnmapNotify, self.handle_unmap_notify)
         self.dispatch.add_system_handler(X.PropertyNotify, self.handle_property_notify)
 
-        # Fetch WM hints
-        self.wmhints = self.window.get_wm_hints()
-        self.sizehints = self.window.get_wm_normal_hints()
-        self.protocols = self.window.get_wm_protocols()
+        # Fetch WM hints, and any properties needed by mixins
+        if prefetch is None:
+            prefetch = PropertyPrefetch(self.wm.display, self.window,
+                                        self.prefetch_properties())
+        self.prefetch = prefetch
+
+        self.wmhints = self.prefetch.get_struct(Xatom.WM_HINTS, icccm.WMHints)
+        self.sizehints = self.prefetch.get_struct(Xatom.WM_NORMAL_HINTS,
+                                                  icccm.WMNormalHints)
+        if self.window_proxy_class is not None:
+            self.sizehints = self.window._proxy_wm_normal_hints(self.sizehints)
+
+        self.protocols = self.prefetch.get_atoms('WM_PROTOCOLS')
 
-        hint = self.window.get_wm_class()
-        if hint:
-            self.res_name, self.res_class = hint
+        hint = self.prefetch.get_text(Xatom.WM_CLASS)
+        if hint and len(hint.split('\0')) >= 2:
+            self.res_name, self.res_class = hint.split('\0')[:2]
         else:
             self.res_name = self.res_class = None
 
+        # Cache of property values, mapping atoms to values.  Entries
+        # are dropped when a PropertyNotify is received for them.
+        self.property_cache = {}
+
+        # Memoized results of compiled client filters, see
+        # cfilter.compile()
+        self.filter_cache = {}
+        self.property_cache[self.wm.WM_STATE] = self.prefetched_wm_state()
+
+        name = self.prefetch.get_text(Xatom.WM_NAME)
+        encoding = getattr(self.window, '_STRING_ENCODING', None)
+        if name is not None and encoding:
+            name = name.decode(encoding)
+        self.property_cache[Xatom.WM_NAME] = name
+
 
         # Some broken widget sets (e.g. Java AWT) checks whether a
         # window manager is running, and if so, will do nothing until
@@ -448,12 +856,13 @@ class Client(Window):
         # ReparentNotify.  It can also generates an UnmapNotify, so
         # block that event.
 
-        if self.needs_reparent_clients(self):
+        if cfilter.compiled(self.needs_reparent_clients)(self):
             debug('client', 'reparenting incompetent window')
             self.event_mask.block(X.StructureNotifyMask)
             self.screen.event_mask.block(X.SubstructureNotifyMask)
 
             self.window.reparent(self.screen.root, self.x, self.y)
+            self.screen.stacking.raise_window(self.window)
 
             self.screen.event_mask.unblock(X.SubstructureNotifyMask)
             self.event_mask.unblock(X.StructureNotifyMask)
@@ -493,12 +902,12 @@ class Client(Window):
             self.start_iconified = 1
 
         # Second: start iconified if the client already is iconic
-        elif self.get_wm_state() == Xutil.IconicState:
+        elif self.property_cache[self.wm.WM_STATE] == Xutil.IconicState:
             self.start_iconified = 1
 
         # Third : start iconified if the clients matches
         # start_iconified_clients
-        elif self.start_iconified_clients(self):
+        elif cfilter.compiled(self.start_iconified_clients)(self):
             self.start_iconified = 1
 
         # Otherwise start mapped, although this can be overridden
@@ -508,11 +917,27 @@ class Client(Window):
         # Now find and call all __client_init__ methods
         call_inits(self.__class__, '__client_init__', self)
 
+        # Drop any unused replies
+        self.prefetch = None
+
 
     def __del__(self):
         # Just call all __client_del__ methods
         call_inits(self.__class__, '__client_del__', self)
 
+    def prefetch_properties(self):
+        """Return the properties to prefetch for this client class,
+        collected from all __client_prefetch__ attributes.
+        """
+        return client_prefetch_properties(self.__class__)
+
+    def prefetched_wm_state(self):
+        s = self.prefetch.get_struct('WM_STATE', icccm.WMState)
+        if s:
+            return s.state
+        else:
+            return None
+
     #
     # Internal methods
     #
@@ -525,9 +950,11 @@ class Client(Window):
             return
 
         Window.withdraw(self, destroyed)
+        self.filter_cache.clear()
         if not destroyed:
             self.window.change_save_set(X.SetModeDelete)
             self.window.delete_property(self.wm.WM_STATE)
+            self.property_cache[self.wm.WM_STATE] = None
 
         # Pass note to proxy, if any, that the window is gone
         if self.window_proxy_class is not None:
@@ -541,6 +968,18 @@ class Client(Window):
         if self.withdrawn:
             return
 
+        # The cached value is now stale.  WM_STATE is only written
+        # by the window manager, which keeps the cache up to date
+        # itself.
+        if event.atom != self.wm.WM_STATE:
+            try:
+                del self.property_cache[event.atom]
+            except KeyError:
+                pass
+
+        if event.atom == Xatom.WM_NAME:
+            self.invalidate_filter_cache(cfilter.DEPENDS_TITLE)
+
         # The only ICCCM property we should follow is WM_NORMAL_HINTS,
         # as that one can change e.g. when changing font in an Emacs.
         # The other properties should be set before the window is
@@ -625,7 +1064,10 @@ class Client(Window):
         self.event_mask.unblock(X.StructureNotifyMask)
 
         self.mapped = 0
+        self.screen.client_index.update(self)
+        self.invalidate_filter_cache(cfilter.DEPENDS_MAPPED)
         self.window.set_wm_state(state = Xutil.IconicState, icon = 0)
+        self.property_cache[self.wm.WM_STATE] = Xutil.IconicState
         self.wm.events.put_event(wmevents.ClientIconified(self))
 
 
@@ -643,7 +1085,10 @@ class Client(Window):
         
         self.map()
         self.mapped = 1
+        self.screen.client_index.update(self)
+        self.invalidate_filter_cache(cfilter.DEPENDS_MAPPED)
         self.window.set_wm_state(state = Xutil.NormalState, icon = 0)
+        self.property_cache[self.wm.WM_STATE] = Xutil.NormalState
         self.wm.events.put_event(wmevents.ClientDeiconified(self))
 
 
@@ -836,6 +1281,32 @@ class Client(Window):
         self.window.warp_pointer(x, y)
 
 
+    def invalidate_filter_cache(self, depends):
+        """Forget the memoized results of filters depending on the
+        client state DEPENDS, one of the cfilter.DEPENDS_* constants.
+        """
+        for f in self.filter_cache.keys():
+            if depends in f.depends:
+                del self.filter_cache[f]
+
+
+    def get_cached_property(self, atom, fetch):
+        """Return the value of the property ATOM from the property
+        cache.  If it isn't cached, FETCH is called to get it from the
+        server.
+        """
+        try:
+            value = self.property_cache[atom]
+        except KeyError:
+            self.wm.property_cache_misses = self.wm.property_cache_misses + 1
+            value = fetch()
+            self.property_cache[atom] = value
+        else:
+            self.wm.property_cache_hits = self.wm.property_cache_hits + 1
+
+        return value
+
+
     def fetch_name(self):
         if self.withdrawn:
             return None
@@ -843,7 +1314,8 @@ class Client(Window):
         # Handle destroyed windows gracefully, registering the error
         # so the window is withdrawn from managing.
         try:
-            return self.window.get_wm_name()
+            return self.get_cached_property(Xatom.WM_NAME,
+                                            self.window.get_wm_name)
         except error.BadWindow, e:
             self.wm.events.put_event(e)
             return None
@@ -866,11 +1338,14 @@ class Client(Window):
             return Xutil.WithdrawnState
 
         try:
-            r = self.window.get_wm_state()
+            return self.get_cached_property(self.wm.WM_STATE,
+                                            self.fetch_wm_state)
         except error.BadWindow, e:
             self.wm.events.put_event(e)
             return None
 
+    def fetch_wm_state(self):
+        r = self.window.get_wm_state()
         if r:
             return r.state
         else:
@@ -880,6 +1355,10 @@ class Client(Window):
 class Screen:
     allow_self_changes = filters.all
 
+    # If set, reconcile the tracked stacking order with the server
+    # this often, in seconds
+    stacking_reconcile_interval = None
+
     def __init__(self, wm, screenno):
         self.wm = wm
         self.number = screenno
@@ -897,8 +1376,9 @@ class Screen:
 
         self.windows = {}
 
-        # Map proxy windows to actual windows
+        # Map proxy windows to actual windows, and back
         self.proxy_windows = {}
+        self.proxied_windows = {}
         
         self.event_mask = event.EventMask(self.root)
 
@@ -917,6 +1397,14 @@ class Screen:
             # Another wm already manages this screen: cancel
             raise UnavailableScreenError(err)
 
+        # Track the stacking order of the top-level windows.  The
+        # events are handled by WindowManager.handle_stacking_event().
+        self.stacking = StackingOrder(self.root)
+
+        # Spatial index of the mapped clients
+        self.client_index = ClientIndex()
+        self.event_mask.set(X.SubstructureNotifyMask)
+
         # Fix a DISPLAY string for this screen by replacing the
         # screen number in the DISPLAY with this screen's number
         
@@ -951,52 +1439,128 @@ class Screen:
 
         call_inits(self.__class__, '__screen_client_init__', self)
 
+        self.scan_clients()
+
+        if self.stacking_reconcile_interval:
+            self.stacking_timer_type = event.new_event_type()
+            self.dispatch.add_system_handler(self.stacking_timer_type,
+                                             self.handle_stacking_timer)
+            self.start_stacking_timer()
+
+        call_inits(self.__class__, '__screen_init__', self)
+
+    def __del__(self):
+        # Just call all __screen_del__ methods
+        call_inits(self.__class__, '__screen_del__', self)
+
+    def scan_clients(self):
+        """Find and add clients for all existing windows on the screen.
+
+        The properties and attributes of all windows are fetched with
+        pipelined requests, so the scan only costs a few round trips
+        regardless of the number of windows.
+        """
+
+        start = phase = time.time()
+
         # Find all clients, ignoring transient windows (override_redirect).
-        r = self.root.query_tree()
-        wins = r.children
+        wins = self.root.query_tree().children
+        self.stacking.reset(wins)
+
+        now = time.time()
+        debug('startup', 'screen %d: query_tree: %d windows in %.3f s',
+              self.number, len(wins), now - phase)
+        phase = now
+
+        # Request everything needed to find the clients before reading
+        # any replies
+        wm_state = self.wm.display.get_atom('WM_STATE')
+        requests = []
+        for w in wins:
+            props = PropertyPrefetch(self.wm.display, w,
+                                     ((Xatom.WM_HINTS, Xatom.WM_HINTS,
+                                       icccm.WMHints.static_size / 4),
+                                      (wm_state, wm_state,
+                                       icccm.WMState.static_size / 4)))
+            attrs = Xlib.protocol.request.GetWindowAttributes(
+                display = self.wm.display.display,
+                defer = 1,
+                window = w.id)
+            requests.append((w, props, attrs))
+
+        # Weed out icon windows (thanks to ctwm for the idea...).
+        # Windows that disappeared during the scan are also dropped.
+        icons = {}
+        found = []
+        for w, props, attrs in requests:
+            try:
+                wmh = props.get_struct(Xatom.WM_HINTS, icccm.WMHints)
+                r = props.get_struct(wm_state, icccm.WMState)
+                attrs.reply()
+            except (error.BadWindow, error.BadDrawable):
+                continue
 
-        # Weed out icon windows (thanks to ctwm for the idea...)
-        for w in wins[:]:
-            wmh = w.get_wm_hints()
             if wmh and wmh.flags & Xutil.IconWindowHint:
-                try:
-                    wins.remove(wmh.icon_window)
-                except ValueError:
-                    pass
+                icons[wmh.icon_window] = 1
+
+            found.append((w, attrs, r))
+
+        now = time.time()
+        debug('startup', 'screen %d: fetched attributes and hints in %.3f s',
+              self.number, now - phase)
+        phase = now
 
         # Then add any mapped window, or windows with non-withdrawn
         # WM_STATE property, unless it has override_redirect set.
         # Skip internal windows.
 
-        for w in wins:
-            a = w.get_attributes()
-            r = w.get_wm_state()
+        adopt = []
+        for w, a, r in found:
             if (a.map_state != X.IsUnmapped
                 or (r and r.state in (Xutil.NormalState, Xutil.IconicState))) \
                 and not a.override_redirect \
+                and not icons.has_key(w) \
                 and not self.is_internal_window(w):
 
-                self.add_client(w, 0)
+                adopt.append(w)
 
-        call_inits(self.__class__, '__screen_init__', self)
+        # Prefetch the client properties of all the new clients in one go
+        props = client_prefetch_properties(self.wm.client_class)
+        prefetches = []
+        for w in adopt:
+            prefetches.append(PropertyPrefetch(self.wm.display, w, props))
 
-    def __del__(self):
-        # Just call all __screen_del__ methods
-        call_inits(self.__class__, '__screen_del__', self)
+        count = 0
+        for w, prefetch in zip(adopt, prefetches):
+            try:
+                count = count + self.add_client(w, 0, prefetch)
+            except (error.BadWindow, error.BadDrawable):
+                debug('startup', 'window %s disappeared during scan', w)
 
-    def add_client(self, window, maprequest):
+        now = time.time()
+        debug('startup', 'screen %d: adopted %d clients in %.3f s',
+              self.number, count, now - phase)
+        debug('startup', 'screen %d: scan finished in %.3f s',
+              self.number, now - start)
+
+    def add_client(self, window, maprequest, prefetch = None):
         """Add a client managing WINDOW.
 
+        PREFETCH can be a PropertyPrefetch already fetching the client
+        properties of WINDOW.
+
         Returns 1 if a client was added, 0 if it was already managed.
         """
         if self.is_client(window):
             return 0
         else:
             debug('clients', 'Adding client for %s', window)
-            client = self.wm.client_class(self, window, maprequest)
+            client = self.wm.client_class(self, window, maprequest, prefetch)
 
             # Use what client think its window is, to handle proxy windows
             self.windows[client.window] = client
+            self.wm.register_window(client.window, self)
+            self.client_index.add(client)
 
             client.initial_map()
             self.wm.events.put_event(wmevents.AddClient(client))
@@ -1027,9 +1591,12 @@ class Screen:
         wobj.withdraw(destroyed)
 
         del self.windows[window]
+        self.wm.unregister_window(window)
+        self.client_index.remove(wobj)
 
     def add_internal_window(self, window):
         self.windows[window] = InternalWindow(self, window)
+        self.wm.register_window(window, self)
         return self.windows[window]
 
     def get_client(self, window):
@@ -1070,13 +1637,23 @@ class Screen:
         """
     
         self.proxy_windows[proxy] = window
+        self.proxied_windows[window] = proxy
+        self.wm.register_window(proxy, self)
+
+        # WINDOW has been reparented into PROXY, typically while
+        # blocking SubstructureNotify
+        self.stacking.remove(window)
 
 
     def remove_proxy_window(self, proxy):
         """Remove a proxy window previously registered with add_proxy_window().
         """
     
+        window = self.proxy_windows[proxy]
         del self.proxy_windows[proxy]
+        if self.proxied_windows.get(window) == proxy:
+            del self.proxied_windows[window]
+        self.wm.unregister_window(proxy)
         
 
     def query_clients(self, client_filter = filters.all, stackorder = 0):
@@ -1087,23 +1664,71 @@ class Screen:
         current stacking order, lowest client first.
         """
 
+        # Query filters are often built for a single call, so don't
+        # fill the client caches with their results
+        client_filter = cfilter.compiled(client_filter, memoize = 0)
+
         if stackorder:
-            wins = self.root.query_tree().children
             clients = []
-            for w in wins:
+            seen = {}
+            for w in self.stacking.windows:
                 c = self.get_client(w)
-                if c and client_filter(c):
+                if c and not seen.has_key(c) and client_filter(c):
+                    seen[c] = 1
                     clients.append(c)
 
             return clients
         else:
-            # Use the internal filter function, but filter
-            # out non-client windows by augmenting the client
-            # filter
-            import cfilter
-            return filter(filters.And(cfilter.is_client,
-                                      client_filter),
-                          self.windows.values())
+            # Filter out non-client windows before calling the
+            # client filter
+            return [w for w in self.windows.values()
+                    if isinstance(w, Client) and client_filter(w)]
+
+    def topmost_client(self, clients):
+        """Return the client highest in the stacking order among
+        CLIENTS, or None if CLIENTS is empty.
+        """
+        if len(clients) <= 1:
+            if clients:
+                return clients[0]
+            else:
+                return None
+
+        candidates = {}
+        for c in clients:
+            candidates[c] = 1
+
+        clients = self.query_clients(candidates.has_key, stackorder = 1)
+        if clients:
+            return clients[-1]
+        else:
+            return None
+
+    def client_at(self, x, y):
+        """Return the topmost mapped client containing the point X, Y
+        of the root window, or None.
+        """
+        return self.topmost_client(self.client_index.clients_at(x, y))
+
+    def top_level_window(self, window):
+        """Return the child of the root window containing WINDOW,
+        translating a proxied window into its proxy.
+        """
+        proxy = self.proxied_windows.get(window)
+        while proxy is not None:
+            window = proxy
+            proxy = self.proxied_windows.get(window)
+        return window
+
+    def start_stacking_timer(self):
+        timer = event.TimerEvent(self.stacking_timer_type,
+                                 after = self.stacking_reconcile_interval)
+        timer.screen = self
+        self.wm.events.add_timer(timer)
+
+    def handle_stacking_timer(self, evt):
+        self.stacking.reconcile()
+        self.start_stacking_timer()
 
     def alloc_border(self, edge, size):
         """Allocate a part of the outmost area of the root to display
@@ -1402,12 +2027,40 @@ class Screen:
             self.remove_client(c.window, 1)
 
 
+# The event types the root windows' SubstructureNotify reports for
+# their children
+root_copy_events = {
+    X.CreateNotify: 1,
+    X.DestroyNotify: 1,
+    X.UnmapNotify: 1,
+    X.MapNotify: 1,
+    X.ReparentNotify: 1,
+    X.ConfigureNotify: 1,
+    X.GravityNotify: 1,
+    X.CirculateNotify: 1,
+    }
+
 class WindowManager:
     client_class = Client
     screen_class = Screen
 
     appclass = 'Plwm'
 
+    # Maximum number of events to handle before flushing the display
+    event_batch_size = 100
+
+    # If true, WindowManager.flush() calls made while handling a batch
+    # of events are deferred until the batch is done, so all requests
+    # caused by it are sent in a single write
+    batch_requests = 1
+
+    # X event types to coalesce when read in bursts, see
+    # event.EventCoalescer.  Empty to disable coalescing.
+    coalesce_event_types = ()
+
+    # Maximum number of unknown windows to remember the screen of
+    unknown_window_cache_size = 512
+
     def __init__(self, disp, appname, db):
         """WindowManager(display, appname, rdb)
 
@@ -1418,6 +2071,24 @@ class WindowManager:
         self.appname = appname
         self.rdb = db
 
+        # Client property cache statistics
+        self.property_cache_hits = 0
+        self.property_cache_misses = 0
+
+        # Keysym to keycode resolutions for the current keyboard
+        # mapping.  keymap_generation is increased each time the
+        # mapping changes.
+        self.keymap_generation = 0
+        self.keycode_cache = {}
+
+        # Request batching state and statistics, see begin_batch()
+        self.in_batch = 0
+        self.batch_start_serial = 0
+        self.batch_count = 0
+        self.batch_request_count = 0
+        self.batch_flush_count = 0
+        self.batch_callbacks = []
+
         # Set up some atoms not defined in Xatom
         self.WM_DELETE_WINDOW = self.display.intern_atom('WM_DELETE_WINDOW')
         self.WM_PROTOCOLS = self.display.intern_atom('WM_PROTOCOLS')
@@ -1434,6 +2105,8 @@ class WindowManager:
 
         # Set up the event handling.
         self.events = event.EventFetcher(self.display)
+        if self.coalesce_event_types:
+            self.events.coalescer = event.EventCoalescer(self.coalesce_event_types)
 
         # Install handlers for child processes
         self.child_events = {}
@@ -1459,6 +2132,15 @@ class WindowManager:
         # Set up a screen-indepentend event handler
         self.dispatch = event.SlaveDispatcher([])
 
+        # Map all windows known by any screen, including proxy
+        # windows, to their screen
+        self.window_screens = {}
+
+        # Map windows not known by any screen to the screen of their
+        # root window, to avoid asking the server for it on every
+        # event for e.g. override-redirect windows.
+        self.unknown_windows = {}
+
         # Call mixin initialisation needed before adding screens
         call_inits(self.__class__, '__wm_screen_init__', self)
 
@@ -1499,6 +2181,23 @@ class WindowManager:
         self.dispatch.add_system_handler(X.MappingNotify,
                                          self.handle_mapping_notify)
 
+        # Forget about unknown windows when they are created or
+        # destroyed, as their window ids might be reused.  Don't set
+        # any masks, the screens select SubstructureNotify on the
+        # root windows.
+        self.dispatch.add_system_handler(X.CreateNotify,
+                                         self.handle_window_lifecycle,
+                                         masks = ())
+        self.dispatch.add_system_handler(X.DestroyNotify,
+                                         self.handle_window_lifecycle,
+                                         masks = ())
+
+        # Keep the stacking order of the screens up to date
+        for t in (X.CreateNotify, X.DestroyNotify, X.ReparentNotify,
+                  X.ConfigureNotify, X.CirculateNotify):
+            self.dispatch.add_system_handler(t, self.handle_stacking_event,
+                                             masks = ())
+
         # Handle errors caused by destroyed windows
         self.display.set_error_handler(self.x_error_handler)
 
@@ -1513,11 +2212,16 @@ class WindowManager:
         """Loop indefinitely, handling events.
         """
         while 1:
-            event = self.events.next_event()
-            self.handle_event(event)
-            if event.type == wmevents.QuitWindowManager:
-                self.display.sync()
-                return
+            events = self.next_event_batch()
+            self.begin_batch()
+            try:
+                for event in events:
+                    self.handle_event(event)
+                    if event.type == wmevents.QuitWindowManager:
+                        self.display.sync()
+                        return
+            finally:
+                self.end_batch()
 
     def brave_loop(self, max_exc = 10):
         """Loop indefinitely, handling events.
@@ -1527,13 +2231,24 @@ class WindowManager:
         has occured.
         """
         exc = 0
+        batch = collections.deque()
         while 1:
             try:
-                event = self.events.next_event()
-                self.handle_event(event)
-                if event.type == wmevents.QuitWindowManager:
-                    self.display.sync()
-                    return
+                if not batch:
+                    batch.extend(self.next_event_batch())
+
+                # If an event handler fails the batch is ended, and
+                # the rest of the events are handled in a new one
+                self.begin_batch()
+                try:
+                    while batch:
+                        event = batch.popleft()
+                        self.handle_event(event)
+                        if event.type == wmevents.QuitWindowManager:
+                            self.display.sync()
+                            return
+                finally:
+                    self.end_batch()
 
             # Pass on keyboardinterrupt, exiting loop
             except KeyboardInterrupt:
@@ -1547,6 +2262,101 @@ class WindowManager:
                 else:
                     raise sys.exc_info()[0], sys.exc_info()[1]
 
+    def next_event_batch(self):
+        """Wait for the next event, and return a list of it followed
+        by any other events available without blocking.  At most
+        event_batch_size events are returned.
+
+        A batch ends at a MotionNotify event, as its handler may skip
+        to the latest motion with EventFetcher.latest_motion().
+        """
+        evt = self.events.next_event()
+        if evt.type == X.MotionNotify:
+            return [evt]
+        return [evt] + self.events.drain(self.event_batch_size - 1)
+
+    def begin_batch(self):
+        """Start handling a batch of events.
+
+        Until end_batch() is called, flush() will not send any
+        requests.  Requests needing a reply are still sent immediately
+        by Xlib.
+        """
+        self.in_batch = self.batch_requests
+        self.batch_start_serial = self.display.display.request_serial
+
+    def end_batch(self):
+        """Finish a batch of events, sending all requests caused by it
+        at once.
+
+        Any functions registered with after_batch() are called first.
+        If any of them raises an exception, the rest are still called
+        and the first exception is then reraised.
+        """
+        exc = None
+        try:
+            # Callbacks may register new callbacks
+            while self.batch_callbacks:
+                callbacks = self.batch_callbacks
+                self.batch_callbacks = []
+                for func in callbacks:
+                    try:
+                        func()
+                    except:
+                        if exc is None:
+                            exc = sys.exc_info()
+        finally:
+            self.in_batch = 0
+            self.batch_count = self.batch_count + 1
+            self.batch_request_count = (self.batch_request_count
+                                        + (self.display.display.request_serial
+                                           - self.batch_start_serial) % 65536)
+            self.flush_now()
+
+        if exc is not None:
+            raise exc[0], exc[1], exc[2]
+
+    def after_batch(self, func):
+        """Call FUNC without arguments when the current batch of
+        events has been handled, or immediately if not handling a
+        batch.
+
+        This allows several changes made while handling the events to
+        be applied with a single update.
+        """
+        if self.in_batch:
+            self.batch_callbacks.append(func)
+        else:
+            func()
+
+    def flush(self):
+        """Send all buffered requests to the server.
+
+        When called while handling a batch of events, the requests are
+        instead sent when the batch is done.  Use flush_now(), or
+        display.sync() if a round trip is needed, when the requests
+        must reach the server immediately.
+        """
+        if not self.in_batch:
+            self.flush_now()
+
+    def flush_now(self):
+        """Send all buffered requests to the server immediately.
+        """
+        self.batch_flush_count = self.batch_flush_count + 1
+        self.display.flush()
+
+    def batch_stats(self):
+        """Return a tuple (batches, requests per batch, flushes per
+        batch) describing the request batching so far.
+        """
+        if self.batch_count:
+            return (self.batch_count,
+                    float(self.batch_request_count) / self.batch_count,
+                    float(self.batch_flush_count) / self.batch_count)
+        else:
+            return (0, 0.0, 0.0)
+
     def quit(self):
         """Quit PLWM, or at least return to caller of loop()
         or brave_loop().
@@ -1559,10 +2369,16 @@ class WindowManager:
         """Handle all the events on the queue.
         """
         while 1:
-            event = self.events.next_event(timeout = 0)
-            if event is None:
+            events = self.events.drain(self.event_batch_size)
+            if not events:
                 return
-            self.handle_event(event)
+
+            self.begin_batch()
+            try:
+                for event in events:
+                    self.handle_event(event)
+            finally:
+                self.end_batch()
 
 
     def remove_window(self, window, destroyed = 0):
@@ -1573,33 +2389,48 @@ class WindowManager:
         if w is not None:
             w.screen.remove_window(window, destroyed)
 
-    def get_client(self, window):
-        for s in self.screens:
-            c = s.get_client(window)
-            if c:
-                return c
+    def register_window(self, window, screen):
+        """Called by SCREEN when it starts to handle WINDOW, to route
+        events for WINDOW directly to SCREEN.
+        """
+        self.window_screens[window] = screen
+        self.unknown_windows.pop(window, None)
 
-        return None
+    def unregister_window(self, window):
+        """Called by a screen when it no longer handles WINDOW.
+        """
+        self.window_screens.pop(window, None)
 
-    def get_window(self, window):
-        for s in self.screens:
-            w = s.get_window(window)
-            if w:
-                return w
+    def get_client(self, window):
+        w = self.get_window(window)
+        if isinstance(w, Client):
+            return w
+        else:
+            return None
 
-        return None
+    def get_window(self, window):
+        s = self.window_screens.get(window)
+        if s is None:
+            return None
+        else:
+            return s.get_window(window)
 
     def is_client(self, window):
-        for s in self.screens:
-            if s.is_client(window):
-                return 1
-        return 0
+        return isinstance(self.get_window(window), Client)
 
     def is_internal_window(self, window):
-        for s in self.screens:
-            if s.is_internal_window(window):
-                return 1
-        return 0
+        return isinstance(self.get_window(window), InternalWindow)
+
+    def client_at(self, x, y, screen = None):
+        """Return the topmost mapped client containing the point X, Y
+        on SCREEN, by default the current screen.  Returns None if
+        there is no such client.
+        """
+        if screen is None:
+            screen = self.current_screen
+            if screen is None:
+                return None
+        return screen.client_at(x, y)
 
     def query_clients(self, client_filter = filters.all, stackorder = 0):
         """Return a list of clients on all screens, matching CLIENT_FILTER.
@@ -1656,9 +2487,28 @@ class WindowManager:
             self.remove_window(event.resource_id, 1)
             return
 
+        # An expired timer is fetched together with the other events
+        # of its batch, so the handler of an earlier event in it may
+        # have cancelled the timer since
+        if isinstance(event, TimerEvent) and event.time is None:
+            return
 
         grabbed = self.dispatch.handle_event(event)
 
+        # The root windows select SubstructureNotify to track the
+        # stacking order, so the structure events of their children
+        # are reported a second time.  The system handlers have seen
+        # the copies, but only the events reported on the windows
+        # themselves are routed further.  Synthetic events sent to
+        # the root, e.g. ICCCM withdrawal, are routed as usual.
+        if root_copy_events.has_key(event.type) and not event.send_event:
+            if event.type == X.CreateNotify:
+                root = event.parent
+            else:
+                root = event.event
+            if root != event.window and self.screen_roots.has_key(root):
+                return
+
         if hasattr(event, 'client') and event.client:
             event.client.screen.handle_event(event, event.client, grabbed)
             return
@@ -1670,26 +2520,41 @@ class WindowManager:
             # First check if the event window is
             # the root window or is an already handled client for
             # some screen
-            for s in self.screens:
-                if window == s.root:
-                    s.handle_event(event, None, grabbed)
-                    return
+            s = self.screen_roots.get(window)
+            if s is not None:
+                s.handle_event(event, None, grabbed)
+                return
 
+            s = self.window_screens.get(window)
+            if s is not None:
                 w = s.get_window(window)
                 if w:
                     s.handle_event(event, w, grabbed)
                     return
 
-            # Unknown window, ask for it's root window
+            # Unknown window, use the root the event was reported on,
+            # or ask for it's root window unless we already know it
             if window:
-                try:
-                    root = window.get_geometry().root
-                    s = self.screen_roots[root]
-                # Bad window, or unmanaged screen, just abort
-                except (error.BadDrawable, KeyError):
-                    pass
-                else:
-                    s.handle_event(event, None, grabbed)
+                s = self.unknown_windows.get(window)
+                if s is None:
+                    s = self.reported_screen(event)
+                if s is None:
+                    # A destroyed window can't be asked
+                    if event.type == X.DestroyNotify:
+                        return
+
+                    try:
+                        root = window.get_geometry().root
+                        s = self.screen_roots[root]
+                    # Bad window, or unmanaged screen, just abort
+                    except (error.BadDrawable, KeyError):
+                        return
+
+                    if len(self.unknown_windows) >= self.unknown_window_cache_size:
+                        self.unknown_windows.clear()
+                    self.unknown_windows[window] = s
+
+                s.handle_event(event, None, grabbed)
 
             return
 
@@ -1701,10 +2566,57 @@ class WindowManager:
         return
 
 
+    def reported_screen(self, event):
+        """Return the screen whose root window EVENT was reported
+        on or relative to, or None if the event doesn't tell.
+        """
+        for attr in ('event', 'parent', 'root'):
+            s = self.screen_roots.get(getattr(event, attr, None))
+            if s is not None:
+                return s
+        return None
+
+
+    def handle_window_lifecycle(self, event):
+        self.unknown_windows.pop(event.window, None)
+
+
+    def handle_stacking_event(self, event):
+        # Only the events reported on a root window concern the
+        # stacking order.  CreateNotify is reported to the parent.
+        if event.type == X.CreateNotify:
+            root = event.parent
+        else:
+            root = event.event
+
+        s = self.screen_roots.get(root)
+        if s is not None and event.window != root:
+            s.stacking.handle_event(event)
+
+
     def handle_mapping_notify(self, event):
         debug('keys', 'MappingNotify event')
         self.display.refresh_keyboard_mapping(event)
 
+        # Only a new keyboard mapping changes the keycodes
+        if event.request == X.MappingKeyboard:
+            self.keycode_cache.clear()
+            self.keymap_generation = self.keymap_generation + 1
+
+
+    def keysym_to_keycodes(self, keysym):
+        """Return a list of (keycode, index) tuples for KEYSYM, like
+        display.keysym_to_keycodes().
+
+        The result is cached until the keyboard mapping changes.
+        """
+        try:
+            return self.keycode_cache[keysym]
+        except KeyError:
+            keycodes = list(self.display.keysym_to_keycodes(keysym))
+            self.keycode_cache[keysym] = keycodes
+            return keycodes
+
 
     def handle_screen_resize(self, event):
         # The default window manager does nada; but let mixins know
@@ -1834,7 +2746,7 @@ class WindowManager:
     def fake_button_click(self, button):
         self.display.xtest_fake_input(X.ButtonPress, button, 0)
         self.display.xtest_fake_input(X.ButtonRelease, button, 5)
-        self.display.flush()
+        self.flush()
 
 
 
@@ -1866,6 +2778,45 @@ class WindowManager:
             s._cleanup_cycle_roots()
 
 
+# Map client classes to the properties to prefetch
+_client_prefetch_properties = {}
+
+def client_prefetch_properties(cls):
+    """Return the properties that the client class CLS prefetches,
+    collected from all __client_prefetch__ attributes.
+    """
+    try:
+        return _client_prefetch_properties[cls]
+    except KeyError:
+        props = []
+        for p in collect_class_attrs(cls, '__client_prefetch__'):
+            props.extend(p)
+        _client_prefetch_properties[cls] = props
+        return props
+
+
+def collect_class_attrs(cls, attr):
+    """Return a list of the values of ATTR in CLS and all its base
+    classes which define it themselves, most derived classes first.
+    Each class is only included once.
+    """
+
+    values = []
+    seen = {}
+    todo = [cls]
+    while todo:
+        c = todo.pop(0)
+        if seen.has_key(c):
+            continue
+        seen[c] = 1
+
+        if c.__dict__.has_key(attr):
+            values.append(c.__dict__[attr])
+        todo.extend(c.__bases__)
+
+    return values
+
+
 def call_inits(cls, method, obj):
     """Call constructors for all mixin classes.
 
@@ -1924,6 +2875,14 @@ class WindowProxyBase:
         """Called by Client when the proxied window is gone, to allow any cleanup.
         """
         pass
+
+
+    def _proxy_wm_normal_hints(self, hints):
+        """Called by Client with the prefetched WM_NORMAL_HINTS of the
+        proxied window.  Return them modified as get_wm_normal_hints()
+        on the proxy would.
+        """
+        return hints
         
 
     def __str__(self):
@@ -0,0 +1,227 @@
+import sys
+import os
+import random
+import re
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from plwm import cfilter, filters, wmanager
+
+
+# Helper dummy client, only providing what the filters look at
+
+class ClientDummy(wmanager.Client):
+    def __init__(self, res_name, res_class, title, mapped):
+        self.res_name = res_name
+        self.res_class = res_class
+        self.title = title
+        self.mapped = mapped
+        self.filter_cache = {}
+
+    def get_title(self):
+        return self.title
+
+    def is_mapped(self):
+        return self.mapped
+
+class EmacsTitle(filters.Filter):
+    """A filter unknown to the compiler."""
+    def __call__(self, c):
+        return c.get_title() == 'emacs'
+
+class NotClient(object):
+    res_name = res_class = title = 'xterm'
+
+    def get_title(self):
+        return self.title
+
+    def is_mapped(self):
+        return 1
+
+
+names = ['xterm', 'XTerm', 'emacs', 'Emacs', 'aterm', 'term', 'Xaw', None]
+
+patterns = ['term', '^x', 'xterm$', 'ma', 'e.*s', '(?i)xterm', '(a)\\1',
+            '(?P<t>t)erm', 'T(?=erm)', '^$']
+
+globs = ['*term', 'X*', 'e?acs', '[ae]*', '*']
+
+def random_filter(rand, depth = 0):
+    r = rand.randrange(12)
+    if depth > 3:
+        r = r % 8
+
+    if r == 0:
+        return rand.choice([cfilter.true, cfilter.false, cfilter.is_client,
+                            cfilter.mapped, cfilter.iconified])
+    elif r == 1:
+        return cfilter.name(rand.choice(names))
+    elif r == 2:
+        return cfilter.title(rand.choice(names))
+    elif r == 3:
+        return cfilter.re_name(rand.choice(patterns))
+    elif r == 4:
+        return cfilter.re_title(rand.choice(patterns))
+    elif r == 5:
+        return cfilter.glob_name(rand.choice(globs))
+    elif r == 6:
+        return cfilter.glob_title(rand.choice(globs))
+    elif r == 7:
+        return EmacsTitle()
+    elif r == 8:
+        return cfilter.Not(random_filter(rand, depth + 1))
+    elif r == 9:
+        return cfilter.And(*[random_filter(rand, depth + 1)
+                             for i in range(rand.randrange(1, 4))])
+    else:
+        return cfilter.Or(*[random_filter(rand, depth + 1)
+                            for i in range(rand.randrange(1, 5))])
+
+def all_clients():
+    clients = [NotClient()]
+    for n in names:
+        for c in ('XTerm', 'Emacs', None):
+            for t in ('xterm', 'emacs', 'aa', '', None):
+                for m in (0, 1):
+                    clients.append(ClientDummy(n, c, t, m))
+    return clients
+
+
+class TestCompile(unittest.TestCase):
+    def assertEquivalent(self, f, clients):
+        c = cfilter.compile(f)
+        for client in clients:
+            self.assertEqual(bool(c(client)), bool(f(client)),
+                             '%s differs for %s/%s/%s' % (
+                                 f, client.res_name, client.res_class,
+                                 client.get_title()))
+
+    def test_00_simple(self):
+        clients = all_clients()
+        for f in [cfilter.true, cfilter.false, cfilter.is_client,
+                  cfilter.mapped, cfilter.iconified,
+                  cfilter.name('xterm'), cfilter.title('aa'),
+                  cfilter.glob_name('X*'), cfilter.re_title('^a')]:
+            self.assertEquivalent(f, clients)
+
+    def test_01_or_merged(self):
+        f = cfilter.Or(cfilter.name('emacs'), cfilter.re_name('^x'),
+                       cfilter.glob_name('*Term'))
+        self.assertEquivalent(f, all_clients())
+
+    def test_02_regexp_flags_not_merged(self):
+        # An inline flag would apply to all merged patterns
+        f = cfilter.Or(cfilter.re_name('(?i)EMACS'), cfilter.re_name('XTERM'))
+        self.assertEquivalent(f, all_clients())
+        self.assertEqual(cfilter.compile(f)(ClientDummy('x', 'XTerm', '', 1)),
+                         False)
+
+    def test_03_regexp_groups_not_merged(self):
+        # Group numbers change when merged
+        f = cfilter.Or(cfilter.re_title('(e)m'), cfilter.re_title('(a)\\1'))
+        self.assertEquivalent(f, all_clients())
+        self.assertEqual(cfilter.compile(f)(ClientDummy('', '', 'aa', 1)), True)
+
+    def test_04_and_or_not(self):
+        f = cfilter.And(cfilter.Not(cfilter.iconified),
+                        cfilter.Or(cfilter.title('xterm'),
+                                   cfilter.Not(cfilter.re_name('term$'))),
+                        cfilter.Or(cfilter.And(), cfilter.false))
+        self.assertEquivalent(f, all_clients())
+
+    def test_05_precompiled_flags_not_merged(self):
+        # The flags of a precompiled regexp aren't in its pattern
+        icase = cfilter.re_name(re.compile('EMACS', re.I))
+        self.assertEquivalent(icase, all_clients())
+        self.assertEqual(cfilter.compile(icase)(ClientDummy('emacs', '', '', 1)),
+                         True)
+
+        f = cfilter.Or(icase, cfilter.re_name('XTERM'),
+                       cfilter.re_title(re.compile('^A', re.I)),
+                       cfilter.re_title('x'))
+        self.assertEquivalent(f, all_clients())
+        self.assertEqual(cfilter.compile(f)(ClientDummy('', '', 'aa', 1)), True)
+
+        # Precompiled regexps without flags are still merged
+        f = cfilter.Or(cfilter.re_name(re.compile('emacs')),
+                       cfilter.re_name('xterm'))
+        self.assertEquivalent(f, all_clients())
+        self.assertEqual(len(cfilter._optimize(f).search), 2)
+
+    def test_10_random(self):
+        rand = random.Random(4711)
+        clients = all_clients()
+        for i in range(300):
+            self.assertEquivalent(random_filter(rand), clients)
+
+    def test_20_compiled_cache(self):
+        f = cfilter.name('xterm')
+        self.assert_(cfilter.compiled(f) is cfilter.compiled(f))
+
+        func = lambda c: 1
+        self.assert_(cfilter.compiled(func) is func)
+
+
+class ScreenDummy(wmanager.Screen):
+    def __init__(self, clients):
+        self.windows = {}
+        for i in range(len(clients)):
+            self.windows[i] = clients[i]
+
+
+class TestMemoize(unittest.TestCase):
+    def test_00_memoized(self):
+        c = ClientDummy('xterm', 'XTerm', 'emacs', 1)
+        f = cfilter.compile(cfilter.And(cfilter.mapped, cfilter.name('xterm')))
+        self.assertEqual(f.depends, (cfilter.DEPENDS_MAPPED, ))
+        self.assertEqual(f(c), True)
+        self.assertEqual(c.filter_cache, {f: True})
+
+        c.mapped = 0
+        self.assertEqual(f(c), True)
+        c.invalidate_filter_cache(cfilter.DEPENDS_MAPPED)
+        self.assertEqual(f(c), False)
+
+    def test_01_title_invalidated(self):
+        c = ClientDummy('xterm', 'XTerm', 'emacs', 1)
+        f = cfilter.compile(cfilter.title('emacs'))
+        self.assertEqual(f(c), True)
+        c.title = 'vi'
+        c.invalidate_filter_cache(cfilter.DEPENDS_MAPPED)
+        self.assertEqual(f(c), True)
+        c.invalidate_filter_cache(cfilter.DEPENDS_TITLE)
+        self.assertEqual(f(c), False)
+
+    def test_02_unknown_not_memoized(self):
+        c = ClientDummy('xterm', 'XTerm', 'emacs', 1)
+        f = cfilter.compile(cfilter.Or(cfilter.name('emacs'), EmacsTitle()))
+        self.assertEqual(f.depends, None)
+        self.assertEqual(f(c), True)
+        self.assertEqual(c.filter_cache, {})
+
+    def test_03_query_not_memoized(self):
+        clients = [ClientDummy('xterm', 'XTerm', 'emacs', 1),
+                   ClientDummy('emacs', 'Emacs', 'xterm', 1)]
+        s = ScreenDummy(clients)
+
+        # Queries with filters built for each call leave nothing behind
+        for i in range(100):
+            r = s.query_clients(cfilter.re_title('^e'))
+            self.assertEqual(r, clients[:1])
+
+        for c in clients:
+            self.assertEqual(c.filter_cache, {})
+
+    def test_04_cache_bounded(self):
+        c = ClientDummy('xterm', 'XTerm', 'emacs', 1)
+        for i in range(cfilter.filter_cache_size * 3):
+            cfilter.compiled(cfilter.name('xterm'))(c)
+            self.assert_(len(c.filter_cache) <= cfilter.filter_cache_size)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_cfilter.py"
+# End:
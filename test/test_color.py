@@ -0,0 +1,104 @@
+import sys
+import os
+import struct
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from Xlib import error
+from Xlib.protocol import request
+from plwm import color
+
+
+# Helper dummy classes, answering the color allocation requests
+# without any server
+
+class BadNameDummy(error.BadName):
+    def __init__(self):
+        pass
+
+class DisplayDummy:
+    named_colors = {'black': 0, 'white': 1, 'red': 2}
+
+    def __init__(self):
+        self.requests = []
+
+    def send_request(self, req, wait_for_response):
+        self.requests.append(req)
+        data = req._binary
+
+        if isinstance(req, request.AllocNamedColor):
+            n = struct.unpack('=H', data[8:10])[0]
+            name = data[12:12 + n]
+            try:
+                req._data = {'pixel': self.named_colors[name]}
+            except KeyError:
+                req._error = BadNameDummy()
+        else:
+            r, g, b = struct.unpack('=HHH', data[8:14])
+            req._data = {'pixel': (r >> 8) << 16 | (g >> 8) << 8 | b >> 8}
+
+class ColormapDummy:
+    id = 1
+
+    def __init__(self):
+        self.display = DisplayDummy()
+
+class ColorScreen(color.Color):
+    def __init__(self):
+        self.color_map = ColormapDummy()
+        self.color_alloced = {}
+
+
+class TestParseColor(unittest.TestCase):
+    def test_00_rgb(self):
+        self.assertEqual(color.parse_color('#fff'), (0xf000, 0xf000, 0xf000))
+        self.assertEqual(color.parse_color('#ff0080'), (0xff00, 0, 0x8000))
+        self.assertEqual(color.parse_color('rgb:ffff/0/80'),
+                         (0xffff, 0, 0x8000))
+        self.assertEqual(color.parse_color((1, 2, 3)), (1, 2, 3))
+
+    def test_01_name(self):
+        self.assertEqual(color.parse_color('black'), None)
+        self.assertEqual(color.parse_color('#ggg'), None)
+
+    def test_02_bad_type(self):
+        self.assertRaises(TypeError, color.parse_color, 4711)
+        self.assertRaises(TypeError, color.parse_color, (1, 2))
+
+
+class TestGetColors(unittest.TestCase):
+    def setUp(self):
+        self.screen = ColorScreen()
+        self.display = self.screen.color_map.display
+
+    def test_00_bulk(self):
+        pixels = self.screen.get_colors(['white', '#ff0080', 'white', 'red'])
+        self.assertEqual(pixels, [1, 0xff0080, 1, 2])
+        self.assertEqual(len(self.display.requests), 3)
+        self.assertEqual(self.screen.color_count(), 3)
+
+        # Allocated colors are cached
+        self.assertEqual(self.screen.get_color('red'), 2)
+        self.assertEqual(self.screen.get_colors(['white', 'red']), [1, 2])
+        self.assertEqual(len(self.display.requests), 3)
+
+    def test_01_default(self):
+        pixels = self.screen.get_colors(['nosuch', 'red'], 'white')
+        self.assertEqual(pixels, [1, 2])
+        self.assertEqual(self.screen.get_color('nosuch', 'black'), 0)
+
+        # Missing colors aren't cached
+        self.assert_(not self.screen.color_alloced.has_key('nosuch'))
+
+    def test_02_missing(self):
+        self.assertRaises(color.ColorError,
+                          self.screen.get_colors, ['red', 'nosuch'])
+        self.assertRaises(color.ColorError, self.screen.get_color, 'nosuch')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_color.py"
+# End:
@@ -1,11 +1,13 @@
 
 import sys
 import os
+import random
 import unittest
 
 sys.path[1:1] = [os.path.join(sys.path[0], '..')]
 
-from plwm import event
+from plwm import event, efilter, wmanager
+from Xlib import X
 
 
 # Helper objects for the dispatcher test
@@ -193,6 +195,43 @@ class TestDispatcher(unittest.TestCase):
         self.assertEqual(len(self.d.groups['foo']), 1)
         
 
+    def test_14_remove_handler_while_dispatching(self):
+        class Remover(Handler):
+            def __init__(self, d, h):
+                super(Remover, self).__init__()
+                self.d = d
+                self.h = h
+
+            def __call__(self, evt):
+                super(Remover, self).__call__(evt)
+                self.d.remove_handler(self.h)
+
+        rm = Remover(self.d, self.h2b)
+        self.d.add_handler(rm, self.f2)
+        self.d.add_handler(self.h2b, self.f2)
+
+        r = self.d.dispatch_event(2)
+        self.assertEqual(r, self.d.HANDLED)
+        self.assertEqual(rm.called, 1)
+        self.assertEqual(self.h2b.called, 0)
+
+    def test_15_remove_large_group(self):
+        hs = [Handler() for i in range(100)]
+        for h in hs:
+            self.d.add_handler(h, self.f1, 'foo')
+        self.d.add_handler(self.h1, self.f1, 'bar')
+
+        self.d.remove_group('foo')
+
+        self.assertEqual(len(self.d.handlers), 1)
+        self.assertEqual(self.d.item_groups.keys(), [(self.f1, self.h1)])
+
+        r = self.d.dispatch_event(1)
+        self.assertEqual(r, self.d.HANDLED)
+        self.assertEqual(self.h1.called, 1)
+        self.assertEqual([h.called for h in hs], [0] * 100)
+
+
     def test_20_exceptions_in_handler(self):
         self.d.add_handler(self.r1, self.f1)
         self.assertRaises(TestException1, self.d.dispatch_event, 1)
@@ -404,6 +443,112 @@ class TestDispatcher(unittest.TestCase):
         self.assertEqual(self.h2b.called, 0)
 
 
+class TypedEvent(object):
+    def __init__(self, type, window = None):
+        self.type = type
+        self.window = window
+
+class CountingFilter(object):
+    def __init__(self, filter):
+        self.filter = filter
+        self.event_types = filter.event_types
+        self.event_windows = filter.event_windows
+        self.called = 0
+
+    def __call__(self, evt):
+        self.called += 1
+        return self.filter(evt)
+
+class OrderHandler(object):
+    def __init__(self, log, name):
+        self.log = log
+        self.name = name
+
+    def __call__(self, evt):
+        self.log.append(self.name)
+
+class TestIndexedDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.d = event.BottomDispatcher()
+
+    def test_00_only_relevant_predicates(self):
+        f1 = CountingFilter(efilter.event_type(1))
+        f2 = CountingFilter(efilter.event_type(2))
+        h1 = Handler()
+        h2 = Handler()
+        self.d.add_handler(h1, f1)
+        self.d.add_handler(h2, f2)
+
+        e = TypedEvent(1)
+        r = self.d.dispatch_event(e)
+        self.assertEqual(r, self.d.HANDLED)
+        self.assertEqual(f1.called, 1)
+        self.assertEqual(f2.called, 0)
+        self.assertEqual(h1.event, e)
+        self.assertEqual(h2.called, 0)
+
+    def test_01_window_index(self):
+        f1 = CountingFilter(efilter.And(efilter.event_type(1),
+                                        efilter.window('w1')))
+        f2 = CountingFilter(efilter.And(efilter.event_type(1),
+                                        efilter.window('w2')))
+        h1 = Handler()
+        self.d.add_handler(h1, f1)
+        self.d.add_handler(h1, f2)
+
+        self.d.dispatch_event(TypedEvent(1, 'w2'))
+        self.assertEqual(f1.called, 0)
+        self.assertEqual(f2.called, 1)
+        self.assertEqual(h1.called, 1)
+
+    def test_02_order_kept(self):
+        log = []
+        f1 = efilter.event_type(1)
+        f12 = efilter.Or(efilter.event_type(1), efilter.event_type(2))
+        fw = efilter.And(efilter.event_type(1), efilter.window('w'))
+        fany = Filter(TypedEvent)   # opaque predicate, never true
+        fnot = efilter.Not(efilter.event_type(2))
+
+        self.d.add_handler(OrderHandler(log, 'a'), fw)
+        self.d.add_handler(OrderHandler(log, 'b'), f12)
+        self.d.add_handler(OrderHandler(log, 'c'), fany)
+        self.d.add_handler(OrderHandler(log, 'd'), fnot)
+        self.d.add_handler(OrderHandler(log, 'e'), f1)
+
+        self.d.dispatch_event(TypedEvent(1, 'w'))
+        self.assertEqual(log, ['a', 'b', 'd', 'e'])
+
+    def test_03_declarations(self):
+        self.assertEqual(efilter.And(efilter.event_type(1, 2),
+                                     efilter.event_type(2, 3),
+                                     efilter.true).event_types, (2, ))
+        self.assertEqual(efilter.Or(efilter.event_type(1, 2),
+                                    efilter.event_type(2, 3)).event_types,
+                         (1, 2, 3))
+        self.assertEqual(efilter.Or(efilter.event_type(1),
+                                    efilter.true).event_types, None)
+        self.assertEqual(efilter.Not(efilter.event_type(1)).event_types, None)
+        self.assertEqual(efilter.false.event_types, ())
+
+    def test_04_remove(self):
+        f1 = efilter.event_type(1)
+        h1 = Handler()
+        h2 = Handler()
+        self.d.add_handler(h1, f1, 'foo')
+        self.d.add_handler(h2, f1)
+        self.d.add_handler(h2, efilter.true, 'foo')
+
+        self.d.remove_group('foo')
+        self.d.dispatch_event(TypedEvent(1))
+        self.assertEqual(h1.called, 0)
+        self.assertEqual(h2.called, 1)
+
+        self.d.remove_handler(h2)
+        self.assertEqual(self.d.index, {})
+        self.assertEqual(len(self.d.fallback), 0)
+        self.assertEqual(self.d.handler_items, {})
+
+
 # Helper dummy object for EventMask test
 class EventMaskWindowDummy(object):
     def __init__(self):
@@ -453,6 +598,407 @@ class TestEventMask(unittest.TestCase):
 
         
 
+# Helper dummy objects for EventFetcher tests
+class DisplayDummy(object):
+    def __init__(self):
+        self.pipe = os.pipe()
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def pending_events(self):
+        return 0
+
+class FileDummy(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+class TestTimerQueue(unittest.TestCase):
+    def test_00_order(self):
+        q = event.TimerQueue()
+        t3 = event.TimerEvent(1, at = 300)
+        t1 = event.TimerEvent(1, at = 100)
+        t2 = event.TimerEvent(1, at = 200)
+        q.add(t3); q.add(t1); q.add(t2)
+
+        self.assertEqual(len(q), 3)
+        self.assert_(q.first() is t1)
+        self.assert_(q.pop() is t1)
+        self.assert_(q.pop() is t2)
+        self.assert_(q.pop() is t3)
+        self.assertEqual(q.pop(), None)
+        self.assertEqual(len(q), 0)
+
+    def test_01_equal_times_keep_order(self):
+        q = event.TimerQueue()
+        ts = [event.TimerEvent(1, at = 100) for i in range(5)]
+        for t in ts:
+            q.add(t)
+
+        for t in ts:
+            self.assert_(q.pop() is t)
+
+    def test_10_cancel(self):
+        q = event.TimerQueue()
+        t1 = event.TimerEvent(1, at = 100)
+        t2 = event.TimerEvent(1, at = 200)
+        q.add(t1); q.add(t2)
+
+        t1.cancel()
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q.pending(), [t2])
+        self.assert_(q.pop() is t2)
+
+        # Cancelling a popped timer doesn't affect the queue
+        t2.cancel()
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.cancelled, 0)
+
+    def test_11_compact(self):
+        q = event.TimerQueue()
+        ts = [event.TimerEvent(1, at = 100 + i)
+              for i in range(2 * q.compact_threshold)]
+        for t in ts:
+            q.add(t)
+
+        for t in ts[:q.compact_threshold]:
+            t.cancel()
+
+        # Not yet more than half of the heap is cancelled
+        self.assertEqual(q.compactions, 0)
+
+        ts[-1].cancel()
+        self.assertEqual(q.compactions, 1)
+        self.assertEqual(len(q.heap), q.compact_threshold - 1)
+        self.assertEqual(q.pending(), ts[q.compact_threshold:-1])
+
+
+class TestEventFetcherTimers(unittest.TestCase):
+    def test_00_expired_timer(self):
+        f = event.EventFetcher(DisplayDummy())
+        t1 = event.TimerEvent(1, after = -2)
+        t2 = event.TimerEvent(2, after = -1)
+        t3 = event.TimerEvent(3, after = 1000)
+        f.add_timer(t3); f.add_timer(t2); f.add_timer(t1)
+
+        self.assertEqual(f.pending_timers(), [t1, t2, t3])
+
+        t2.cancel()
+        self.assert_(f.next_event() is t1)
+        self.assertEqual(f.pending_timers(), [t3])
+
+
+class MultiplexerTests(object):
+    def setUp(self):
+        self.r, self.w = os.pipe()
+        self.m = self.multiplexer_class()
+
+    def tearDown(self):
+        os.close(self.r)
+        os.close(self.w)
+
+    def test_00_timeout(self):
+        self.m.set(self.r, event.FileEvent.READ)
+        self.assertEqual(list(self.m.wait(0)), [])
+
+    def test_01_readable(self):
+        self.m.set(self.r, event.FileEvent.READ)
+        os.write(self.w, 'x')
+        self.assertEqual(list(self.m.wait(0)), [(self.r, event.FileEvent.READ)])
+
+    def test_02_writable(self):
+        self.m.set(self.w, event.FileEvent.WRITE)
+        self.assertEqual(list(self.m.wait(0)), [(self.w, event.FileEvent.WRITE)])
+
+    def test_03_unregister(self):
+        self.m.set(self.w, event.FileEvent.WRITE)
+        self.m.set(self.w, 0)
+        self.assertEqual(list(self.m.wait(0)), [])
+
+    def test_04_modify(self):
+        self.m.set(self.w, event.FileEvent.READ)
+        self.assertEqual(list(self.m.wait(0)), [])
+        self.m.set(self.w, event.FileEvent.WRITE)
+        self.assertEqual(list(self.m.wait(0)), [(self.w, event.FileEvent.WRITE)])
+
+class TestSelectMultiplexer(MultiplexerTests, unittest.TestCase):
+    multiplexer_class = event.SelectMultiplexer
+
+if hasattr(event.select, 'poll'):
+    class TestPollMultiplexer(MultiplexerTests, unittest.TestCase):
+        multiplexer_class = event.PollMultiplexer
+
+if hasattr(event.select, 'epoll'):
+    class TestEpollMultiplexer(MultiplexerTests, unittest.TestCase):
+        multiplexer_class = event.EpollMultiplexer
+
+
+class TestEventFetcherFiles(unittest.TestCase):
+    def setUp(self):
+        self.r, self.w = os.pipe()
+        self.f = event.EventFetcher(DisplayDummy())
+
+    def tearDown(self):
+        os.close(self.r)
+        os.close(self.w)
+
+    def test_00_file_event(self):
+        fe = event.FileEvent(1, FileDummy(self.r), event.FileEvent.READ)
+        self.f.add_file(fe)
+        self.assertEqual(self.f.next_event(timeout = 0), None)
+
+        os.write(self.w, 'x')
+        self.assert_(self.f.next_event(timeout = 0) is fe)
+        self.assertEqual(fe.state, event.FileEvent.READ)
+
+        # Still readable, so reported again
+        self.assert_(self.f.next_event(timeout = 0) is fe)
+
+    def test_01_set_mode(self):
+        fe = event.FileEvent(1, FileDummy(self.w), event.FileEvent.READ)
+        self.f.add_file(fe)
+        self.assertEqual(self.f.next_event(timeout = 0), None)
+
+        fe.set_mode(set = event.FileEvent.WRITE)
+        self.assert_(self.f.next_event(timeout = 0) is fe)
+        self.assertEqual(fe.state, event.FileEvent.WRITE)
+
+    def test_02_cancel(self):
+        fe = event.FileEvent(1, FileDummy(self.w), event.FileEvent.WRITE)
+        self.f.add_file(fe)
+        fe.cancel()
+        self.assertEqual(self.f.files, {})
+        self.assertEqual(self.f.next_event(timeout = 0), None)
+
+    def test_03_reused_fd(self):
+        r, w = os.pipe()
+        old = event.FileEvent(1, os.fdopen(r), event.FileEvent.READ)
+        self.f.add_file(old)
+
+        # Close without cancelling, and reopen onto the same fd
+        old.file.close()
+        os.close(w)
+        r2, w2 = os.pipe()
+        try:
+            self.assertEqual(r2, r)
+            new = event.FileEvent(2, os.fdopen(r2), event.FileEvent.READ)
+            self.f.add_file(new)
+            self.assertEqual(self.f.files, {r2: new})
+
+            os.write(w2, 'x')
+            self.assert_(self.f.next_event(timeout = 0) is new)
+        finally:
+            new.file.close()
+            os.close(w2)
+
+if hasattr(event.select, 'epoll'):
+    class TestEventFetcherFilesEpoll(TestEventFetcherFiles):
+        def setUp(self):
+            self.r, self.w = os.pipe()
+            self.f = event.EventFetcher(DisplayDummy(),
+                                        event.EpollMultiplexer())
+
+        def test_04_epoll_reregister(self):
+            m = self.f.multiplexer
+            r, w = os.pipe()
+            m.set(r, event.FileEvent.READ)
+            os.close(r)
+            os.close(w)
+
+            # Same fd number, but epoll has forgotten it
+            r2, w2 = os.pipe()
+            try:
+                self.assertEqual(r2, r)
+                m.set(r2, event.FileEvent.READ)
+                os.write(w2, 'x')
+                self.assertEqual(list(m.wait(0)),
+                                 [(r2, event.FileEvent.READ)])
+            finally:
+                os.close(r2)
+                os.close(w2)
+
+
+class TestEventFetcherDrain(unittest.TestCase):
+    def setUp(self):
+        self.f = event.EventFetcher(DisplayDummy())
+
+    def test_00_drain_all(self):
+        for i in range(5):
+            self.f.put_event(i)
+
+        self.assertEqual(self.f.drain(), [0, 1, 2, 3, 4])
+        self.assertEqual(self.f.drain(), [])
+
+    def test_01_drain_max(self):
+        for i in range(5):
+            self.f.put_event(i)
+
+        self.assertEqual(self.f.drain(2), [0, 1])
+        self.assertEqual(self.f.drain(2), [2, 3])
+        self.assertEqual(self.f.drain(2), [4])
+
+    def test_02_drain_x_events(self):
+        self.f.x_events.extend(['x1', 'x2'])
+        self.f.put_event(1)
+
+        # Synthetic events come first
+        self.assertEqual(self.f.drain(), [1, 'x1', 'x2'])
+
+    def test_03_latest_motion(self):
+        m1 = XEventDummy(X.MotionNotify, 1, state = 0)
+        m2 = XEventDummy(X.MotionNotify, 1, state = 0)
+        m3 = XEventDummy(X.MotionNotify, 1, state = 0)
+        b1 = XEventDummy(X.ButtonRelease, 1, state = 0)
+        m4 = XEventDummy(X.MotionNotify, 1, state = 0)
+        self.f.x_events.extend([m2, m3, b1, m4])
+
+        # Motion is only skipped up to the release
+        self.assertEqual(self.f.latest_motion(m1), m3)
+        self.assertEqual(self.f.dropped_motion, 2)
+        self.assertEqual(self.f.drain(), [b1, m4])
+        self.assertEqual(self.f.latest_motion(m4), m4)
+
+    def test_04_motion_ends_batch(self):
+        k = XEventDummy(X.KeyPress, 1, state = 0)
+        motions = []
+        for i in range(10):
+            motions.append(XEventDummy(X.MotionNotify, 1, state = 0, x = i))
+        self.f.x_events.extend([k] + motions)
+
+        # The motion events following the batch are left queued, so
+        # handling the batch only moves forward
+        wm = BatchWindowManager(self.f)
+        handled = []
+        while self.f.x_events:
+            for e in wm.next_event_batch():
+                if e.type == X.MotionNotify:
+                    e = self.f.latest_motion(e)
+                    handled.append(e.x)
+
+        self.assertEqual(handled, [9])
+        self.assertEqual(self.f.dropped_motion, 9)
+
+        m1 = XEventDummy(X.MotionNotify, 1, state = 0)
+        m2 = XEventDummy(X.MotionNotify, 1, state = 0)
+        self.f.x_events.extend([m1, m2, k])
+        self.assertEqual(wm.next_event_batch(), [m1])
+        self.assertEqual(self.f.drain(), [m2])
+        self.assertEqual(self.f.drain(), [k])
+
+
+class BatchWindowManager(wmanager.WindowManager):
+    event_batch_size = 4
+
+    def __init__(self, events):
+        self.events = events
+
+
+# Helper dummy object for the EventCoalescer test
+class XEventDummy(object):
+    def __init__(self, type, window, **keys):
+        self.type = type
+        self.window = window
+        self.__dict__.update(keys)
+
+class TestEventCoalescer(unittest.TestCase):
+    def test_00_motion(self):
+        c = event.EventCoalescer()
+        m1 = XEventDummy(X.MotionNotify, 1)
+        m2 = XEventDummy(X.MotionNotify, 2)
+        m3 = XEventDummy(X.MotionNotify, 1)
+
+        self.assertEqual(c.coalesce([m1, m2, m3]), [m2, m3])
+        self.assertEqual(c.dropped, {X.MotionNotify: 1})
+        self.assertEqual(c.dropped_events(), 1)
+
+    def test_01_barrier(self):
+        c = event.EventCoalescer()
+        m1 = XEventDummy(X.MotionNotify, 1)
+        b1 = XEventDummy(X.ButtonRelease, 1)
+        m2 = XEventDummy(X.MotionNotify, 1)
+        p2 = XEventDummy(X.PropertyNotify, 2)
+        m3 = XEventDummy(X.MotionNotify, 1)
+
+        # The release for window 1 keeps m1, but the property change
+        # on window 2 doesn't keep m2
+        self.assertEqual(c.coalesce([m1, b1, m2, p2, m3]), [m1, b1, p2, m3])
+        self.assertEqual(c.dropped_events(), 1)
+
+    def test_02_configure(self):
+        c = event.EventCoalescer()
+        c1 = XEventDummy(X.ConfigureNotify, 1, event = 1)
+        c2 = XEventDummy(X.ConfigureNotify, 1, event = 0)
+        c3 = XEventDummy(X.ConfigureNotify, 1, event = 1)
+        c4 = XEventDummy(X.ConfigureNotify, 1, event = 0)
+
+        self.assertEqual(c.coalesce([c1, c2, c3, c4]), [c3, c4])
+
+    def test_03_expose(self):
+        c = event.EventCoalescer()
+        e1 = XEventDummy(X.Expose, 1, x = 10, y = 10, width = 10, height = 10,
+                         count = 1)
+        e2 = XEventDummy(X.Expose, 1, x = 0, y = 15, width = 5, height = 20,
+                         count = 0)
+
+        self.assertEqual(c.coalesce([e1, e2]), [e2])
+        self.assertEqual((e2.x, e2.y, e2.width, e2.height, e2.count),
+                         (0, 10, 20, 25, 0))
+
+    def test_04_disable(self):
+        c = event.EventCoalescer()
+        c.disable(X.MotionNotify)
+        m1 = XEventDummy(X.MotionNotify, 1)
+        m2 = XEventDummy(X.MotionNotify, 1)
+
+        self.assertEqual(c.coalesce([m1, m2]), [m1, m2])
+        self.assertRaises(ValueError, c.enable, X.KeyPress)
+
+    def test_05_configure_stacking(self):
+        c = event.EventCoalescer()
+
+        # A restack is not merged with a move
+        c1 = XEventDummy(X.ConfigureNotify, 1, event = 0, above_sibling = 2)
+        c2 = XEventDummy(X.ConfigureNotify, 1, event = 0, above_sibling = 3)
+        c3 = XEventDummy(X.ConfigureNotify, 1, event = 0, above_sibling = 3)
+        self.assertEqual(c.coalesce([c1, c2, c3]), [c1, c3])
+
+        # Window 3 is placed above window 1 in its position after c1
+        c1 = XEventDummy(X.ConfigureNotify, 1, event = 0, above_sibling = 2)
+        c2 = XEventDummy(X.ConfigureNotify, 3, event = 0, above_sibling = 1)
+        c3 = XEventDummy(X.ConfigureNotify, 1, event = 0, above_sibling = 2)
+        c4 = XEventDummy(X.ConfigureNotify, 3, event = 0, above_sibling = 1)
+        self.assertEqual(c.coalesce([c1, c2, c3, c4]), [c1, c3, c4])
+
+    def test_06_configure_stacking_order(self):
+        # The stacking order tracked from coalesced events is the
+        # same as from all events
+        rand = random.Random(4711)
+        for i in range(200):
+            events = []
+            for j in range(rand.randrange(1, 12)):
+                w = rand.randrange(1, 6)
+                above = rand.choice([0, 1, 2, 3, 4, 5])
+                if above == w:
+                    above = 0
+                events.append(XEventDummy(X.ConfigureNotify, w, event = 0,
+                                          above_sibling = above))
+
+            s1 = wmanager.StackingOrder(0)
+            s1.reset([1, 2, 3, 4, 5])
+            for e in events:
+                s1.handle_event(e)
+
+            s2 = wmanager.StackingOrder(0)
+            s2.reset([1, 2, 3, 4, 5])
+            for e in event.EventCoalescer().coalesce(events):
+                s2.handle_event(e)
+
+            self.assertEqual(s1.windows, s2.windows)
+
+
 if __name__ == '__main__':
     try:
         os.unlink('caught_exceptions.txt')
@@ -0,0 +1,258 @@
+import sys
+import os
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from Xlib import X
+from plwm import focus, wmanager
+
+
+# Helper dummy classes, only providing what the focus code uses.
+# Windows are represented by integers, the root window is 1.
+
+ROOT = 1
+
+class CrossingEventDummy:
+    same_screen = 1
+    time = X.CurrentTime
+
+    def __init__(self, type, window, detail = X.NotifyNonlinear,
+                 mode = X.NotifyNormal):
+        self.type = type
+        self.window = window
+        self.detail = detail
+        self.mode = mode
+
+class PointerDummy:
+    same_screen = 1
+
+    def __init__(self, child):
+        self.child = child
+
+class RootDummy:
+    def __init__(self):
+        self.child = None
+        self.queries = 0
+
+    def query_pointer(self):
+        self.queries = self.queries + 1
+        return PointerDummy(self.child)
+
+class ClientDummy:
+    def __init__(self, window):
+        self.window = window
+
+    def is_mapped(self):
+        return 1
+
+class ScreenDummy:
+    def __init__(self, wm):
+        self.wm = wm
+        self.root = RootDummy()
+
+    def get_client(self, window):
+        return self.wm.get_client(window)
+
+class FocusWM(focus.PointToFocus):
+    """A window manager, handling batches of events like
+    WindowManager.loop() does.
+    """
+
+    def __init__(self, windows):
+        self.clients = {}
+        for w in windows:
+            self.clients[w] = ClientDummy(w)
+
+        self.screens = [ScreenDummy(self)]
+        self.screen_roots = {ROOT: self.screens[0]}
+        self.focus_client = None
+        self.batch_callbacks = None
+
+        self.ptfocus_events = 0
+        self.ptfocus_fallbacks = 0
+        self.ptfocus_left = None
+
+    def get_client(self, window):
+        return self.clients.get(window)
+
+    def set_current_client(self, client, time = X.CurrentTime):
+        self.focus_client = client
+
+    def after_batch(self, func):
+        if self.batch_callbacks is None:
+            func()
+        else:
+            self.batch_callbacks.append(func)
+
+    def handle_batch(self, events):
+        self.batch_callbacks = []
+        for evt in events:
+            if evt.type == X.EnterNotify:
+                self.focus_enter(evt)
+            else:
+                self.focus_leave(evt)
+
+        callbacks = self.batch_callbacks
+        self.batch_callbacks = None
+        for func in callbacks:
+            func()
+
+class SloppyFocusWM(focus.SloppyFocus, FocusWM):
+    pass
+
+
+class TestPointToFocus(unittest.TestCase):
+    wmclass = FocusWM
+
+    def setUp(self):
+        self.wm = self.wmclass([10, 11])
+        self.root = self.wm.screens[0].root
+
+    def test_00_client_to_client(self):
+        self.wm.handle_batch([CrossingEventDummy(X.EnterNotify, 10)])
+        self.assertEqual(self.wm.focus_client.window, 10)
+
+        self.wm.handle_batch([CrossingEventDummy(X.LeaveNotify, 10),
+                              CrossingEventDummy(X.EnterNotify, 11)])
+        self.assertEqual(self.wm.focus_client.window, 11)
+        self.assertEqual(self.root.queries, 0)
+        self.assertEqual(self.wm.ptfocus_events, 3)
+
+    def test_01_client_to_root(self):
+        self.wm.handle_batch([CrossingEventDummy(X.EnterNotify, 10)])
+        self.wm.handle_batch([CrossingEventDummy(X.LeaveNotify, 10,
+                                                 X.NotifyAncestor),
+                              CrossingEventDummy(X.EnterNotify, ROOT,
+                                                 X.NotifyInferior)])
+        self.assertEqual(self.wm.focus_client, None)
+        self.assertEqual(self.root.queries, 0)
+
+    def test_02_client_to_unmanaged(self):
+        self.wm.handle_batch([CrossingEventDummy(X.EnterNotify, 10)])
+
+        # No EnterNotify is reported for an unmanaged window, so
+        # the server is asked
+        self.root.child = 99
+        self.wm.handle_batch([CrossingEventDummy(X.LeaveNotify, 10)])
+        self.assertEqual(self.wm.focus_client, None)
+        self.assertEqual(self.root.queries, 1)
+        self.assertEqual(self.wm.ptfocus_fallbacks, 1)
+
+    def test_03_inferior(self):
+        self.wm.handle_batch([CrossingEventDummy(X.EnterNotify, 10)])
+        self.wm.handle_batch([CrossingEventDummy(X.LeaveNotify, 10,
+                                                 X.NotifyInferior)])
+        self.assertEqual(self.wm.focus_client.window, 10)
+        self.assertEqual(self.root.queries, 0)
+
+    def test_04_grab(self):
+        self.wm.handle_batch([CrossingEventDummy(X.EnterNotify, 10)])
+        self.wm.handle_batch([CrossingEventDummy(X.LeaveNotify, 10,
+                                                 mode = X.NotifyGrab)])
+        self.assertEqual(self.wm.focus_client.window, 10)
+        self.assertEqual(self.root.queries, 0)
+
+class TestSloppyFocus(TestPointToFocus):
+    wmclass = SloppyFocusWM
+
+    def test_01_client_to_root(self):
+        self.wm.handle_batch([CrossingEventDummy(X.EnterNotify, 10)])
+        self.wm.handle_batch([CrossingEventDummy(X.LeaveNotify, 10,
+                                                 X.NotifyAncestor),
+                              CrossingEventDummy(X.EnterNotify, ROOT,
+                                                 X.NotifyInferior)])
+        self.assertEqual(self.wm.focus_client.window, 10)
+
+    def test_02_client_to_unmanaged(self):
+        self.wm.handle_batch([CrossingEventDummy(X.EnterNotify, 10)])
+        self.root.child = 99
+        self.wm.handle_batch([CrossingEventDummy(X.LeaveNotify, 10)])
+        self.assertEqual(self.wm.focus_client.window, 10)
+        self.assertEqual(self.root.queries, 1)
+
+
+class MoveClient(wmanager.Client):
+    def __init__(self, wm, name, x, y):
+        self.wm = wm
+        self.window = name
+        self.x = x
+        self.y = y
+        self.width = self.height = 100
+        self.border_width = 0
+        self.mapped = 1
+        self.withdrawn = 0
+        self.filter_cache = {}
+
+    def activate(self):
+        self.wm.focus_client = self
+
+class MoveScreen:
+    def __init__(self, clients):
+        # Clients are given in stacking order, bottom-most first
+        self.clients = clients
+        self.client_index = wmanager.ClientIndex()
+        for c in clients:
+            self.client_index.add(c)
+
+    def topmost_client(self, clients):
+        for c in self.clients[::-1]:
+            if c in clients:
+                return c
+        return None
+
+class MoveFocusWM(focus.MoveFocus):
+    def __init__(self):
+        self.focus_client = None
+        self.left = MoveClient(self, 'left', 0, 0)
+        self.upper = MoveClient(self, 'upper', 200, 0)
+        self.lower = MoveClient(self, 'lower', 200, 200)
+        self.far = MoveClient(self, 'far', 500, 0)
+        self.current_screen = MoveScreen([self.left, self.upper,
+                                          self.lower, self.far])
+
+
+class TestMoveFocus(unittest.TestCase):
+    def setUp(self):
+        self.wm = MoveFocusWM()
+
+    def move(self, dir):
+        self.wm.move_focus(dir)
+        return self.wm.focus_client.window
+
+    def test_00_closest(self):
+        self.wm.focus_client = self.wm.left
+
+        # Equally close clients are chosen by stacking order
+        self.assertEqual(self.move(focus.MOVE_RIGHT), 'lower')
+        self.assertEqual(self.move(focus.MOVE_RIGHT), 'far')
+        self.assertEqual(self.move(focus.MOVE_LEFT), 'lower')
+        self.assertEqual(self.move(focus.MOVE_UP), 'far')
+        self.assertEqual(self.move(focus.MOVE_DOWN), 'lower')
+
+    def test_01_wrap(self):
+        # From the outermost client, or without a focused client, the
+        # outermost client on the opposite side is chosen
+        self.assertEqual(self.move(focus.MOVE_RIGHT), 'left')
+        self.wm.focus_client = self.wm.far
+        self.assertEqual(self.move(focus.MOVE_RIGHT), 'left')
+        self.assertEqual(self.move(focus.MOVE_LEFT), 'far')
+        self.wm.focus_client = self.wm.lower
+        self.assertEqual(self.move(focus.MOVE_DOWN), 'far')
+
+    def test_02_ignored(self):
+        self.wm.move_focus_ignore_clients = lambda c: c.window == 'lower'
+        self.wm.focus_client = self.wm.left
+        self.assertEqual(self.move(focus.MOVE_RIGHT), 'upper')
+
+        self.wm.left.mapped = 0
+        self.wm.current_screen.client_index.update(self.wm.left)
+        self.assertEqual(self.move(focus.MOVE_LEFT), 'far')
+        self.assertEqual(self.move(focus.MOVE_RIGHT), 'upper')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_focus.py"
+# End:
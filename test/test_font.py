@@ -0,0 +1,225 @@
+import sys
+import os
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from Xlib.protocol import request
+from plwm import font, message
+
+
+# Helper dummy classes, only providing what the font cache uses
+
+class CharInfoDummy:
+    def __init__(self, left_side_bearing, right_side_bearing,
+                 character_width, ascent, descent):
+        self.left_side_bearing = left_side_bearing
+        self.right_side_bearing = right_side_bearing
+        self.character_width = character_width
+        self.ascent = ascent
+        self.descent = descent
+
+NOCHAR = CharInfoDummy(0, 0, 0, 0, 0)
+
+def font_info(char_infos, min_char = 97, default_char = 97, max_byte1 = 0,
+              max_bounds = NOCHAR):
+    """Return the QueryFont reply of a font with CHAR_INFOS for
+    the characters starting with MIN_CHAR.
+    """
+    return {'draw_direction': 0, 'font_ascent': 11, 'font_descent': 3,
+            'min_byte1': 0, 'max_byte1': max_byte1,
+            'min_char_or_byte2': min_char,
+            'max_char_or_byte2': min_char + max(len(char_infos), 1) - 1,
+            'default_char': default_char,
+            'char_infos': char_infos, 'max_bounds': max_bounds}
+
+class DisplayDummy:
+    # Characters are 10 pixels wide in fonts measured by the server
+    font_info = font_info([])
+
+    def __init__(self):
+        self.requests = []
+        self.freed = []
+
+    def send_request(self, req, wait_for_response):
+        self.requests.append(req)
+
+        if isinstance(req, request.QueryFont):
+            req._data = self.font_info
+        elif isinstance(req, request.QueryTextExtents):
+            n = (len(req._binary) - 8) / 2 - ord(req._binary[1])
+            req._data = {'draw_direction': 0,
+                         'font_ascent': 11, 'font_descent': 3,
+                         'overall_ascent': 10, 'overall_descent': 2,
+                         'overall_width': 10 * n,
+                         'overall_left': 0, 'overall_right': 10 * n}
+
+    def count(self, reqclass):
+        return len(filter(lambda r, c = reqclass: isinstance(r, c),
+                          self.requests))
+
+    def free_resource_id(self, rid):
+        self.freed.append(rid)
+
+class FontWM(font.Font):
+    """A window manager with the fonts 'fixed' and '6x13' already
+    open, and no font 'nosuch'.
+    """
+
+    def __init__(self):
+        self.display = DisplayDummy()
+        self.__wm_screen_init__()
+
+        for rid, name in ((1, 'fixed'), (2, '6x13')):
+            self.font_cache[name] = font.CachedFont(self.display, rid,
+                                                    owner = 1, name = name)
+        self.font_missing['nosuch'] = 1
+
+class WindowDummy:
+    def unmap(self):
+        pass
+
+    def destroy(self):
+        pass
+
+class MessageDummy(message.Message):
+    timeout = None
+
+    def __init__(self, wm, fontname):
+        self.wm = wm
+        self.window = WindowDummy()
+        self.font = wm.get_font(fontname, 'fixed')
+
+
+class TestFontRefcount(unittest.TestCase):
+    def setUp(self):
+        self.wm = FontWM()
+
+    def test_00_shared(self):
+        f1 = self.wm.get_font('fixed')
+        f2 = self.wm.get_font('fixed')
+        self.assert_(f1 is f2)
+        self.assertEqual(f1.refcount, 2)
+        self.assertEqual(self.wm.font_count(), 2)
+
+        # The font is closed when the last user releases it
+        self.wm.release_font(f1)
+        self.assertEqual(self.wm.display.freed, [])
+        self.wm.release_font(f2)
+        self.assertEqual(self.wm.display.freed, [1])
+        self.assertEqual(self.wm.font_count(), 1)
+
+    def test_01_default(self):
+        f = self.wm.get_font('nosuch', '6x13')
+        self.assertEqual(f.name, '6x13')
+        self.assertEqual(f.refcount, 1)
+        self.assertRaises(font.FontError, self.wm.get_font, 'nosuch')
+        self.assertRaises(font.FontError, self.wm.get_font, 'nosuch', 'nosuch')
+
+    def test_02_release_twice(self):
+        f = self.wm.get_font('fixed')
+        self.wm.release_font(f)
+        self.wm.release_font(f)
+        self.assertEqual(f.refcount, 0)
+        self.assertEqual(self.wm.display.freed, [1])
+
+    def test_03_message_close(self):
+        m1 = MessageDummy(self.wm, 'nosuch')
+        m2 = MessageDummy(self.wm, 'fixed')
+        self.assert_(m1.font is m2.font)
+
+        # Closing a message twice only releases its font once
+        m1.close()
+        m1.close()
+        self.assertEqual(m2.font.refcount, 1)
+        self.assertEqual(self.wm.display.freed, [])
+
+        m2.close()
+        self.assertEqual(self.wm.display.freed, [1])
+
+
+# a has the default metrics, b is missing and c extends to the left
+CHAR_A = CharInfoDummy(0, 5, 6, 8, 2)
+CHAR_C = CharInfoDummy(-1, 7, 6, 10, 0)
+ABC = [CHAR_A, NOCHAR, CHAR_C]
+
+class InfoDummy:
+    def __init__(self, info):
+        self.__dict__.update(info)
+
+def extents(e):
+    return (e.font_ascent, e.font_descent, e.overall_ascent,
+            e.overall_descent, e.overall_width, e.overall_left,
+            e.overall_right)
+
+class TestTextExtents(unittest.TestCase):
+    def setUp(self):
+        self.display = DisplayDummy()
+        self.font = font.CachedFont(self.display, 5)
+
+    def test_00_char_metrics(self):
+        metrics = font.get_char_metrics(InfoDummy(font_info(ABC)))
+        self.assertEqual(len(metrics), 256)
+        self.assertEqual(metrics[ord('a')], (0, 5, 6, 8, 2))
+        self.assertEqual(metrics[ord('c')], (-1, 7, 6, 10, 0))
+
+        # Missing characters get the default character's metrics
+        self.assertEqual(metrics[ord('b')], metrics[ord('a')])
+        self.assertEqual(metrics[0], metrics[ord('a')])
+
+        # Without a default character missing characters are ignored
+        metrics = font.get_char_metrics(InfoDummy(font_info(ABC,
+                                                            default_char = 0)))
+        self.assertEqual(metrics[ord('b')], None)
+
+    def test_01_max_bounds(self):
+        # Fonts without per-character metrics use the max bounds
+        metrics = font.get_char_metrics(InfoDummy(font_info([],
+                                                            max_bounds = CHAR_C)))
+        self.assertEqual(metrics[ord('a')], (-1, 7, 6, 10, 0))
+
+        # Only single-byte fonts are measured locally
+        self.assertEqual(
+            font.get_char_metrics(InfoDummy(font_info(ABC, max_byte1 = 1))),
+            None)
+
+    def test_02_compute(self):
+        self.display.font_info = font_info(ABC)
+        self.assertEqual(extents(self.font.query_text_extents('ac')),
+                         (11, 3, 10, 2, 12, 0, 13))
+        self.assertEqual(extents(self.font.query_text_extents('cb')),
+                         (11, 3, 10, 2, 12, -1, 11))
+        self.assertEqual(extents(self.font.query_text_extents('')),
+                         (11, 3, 0, 0, 0, 0, 0))
+        self.assertEqual(self.font.text_width('abc'), 18)
+
+        # The font is only queried once, and the text is measured
+        # without asking the server
+        self.assertEqual(self.display.count(request.QueryFont), 1)
+        self.assertEqual(self.display.count(request.QueryTextExtents), 0)
+
+    def test_03_server_extents(self):
+        self.display.font_info = font_info(ABC, max_byte1 = 1)
+        self.assertEqual(self.font.text_width('ab'), 20)
+        self.assertEqual(self.font.text_width('ab'), 20)
+        self.assertEqual(self.display.count(request.QueryTextExtents), 1)
+        self.assertEqual(self.font.extents_cache_hits, 1)
+        self.assertEqual(self.font.extents_cache_misses, 1)
+
+    def test_04_lru(self):
+        self.display.font_info = font_info(ABC, max_byte1 = 1)
+        self.font.text_extents_cache_size = 2
+        for s in 'a', 'b', 'a', 'c', 'a', 'b':
+            self.font.query_text_extents(s)
+
+        # b was the least recently used string when c was measured
+        self.assertEqual(self.font.extents_cache_hits, 2)
+        self.assertEqual(self.font.extents_cache_misses, 4)
+        self.assertEqual(self.font.extents_cache.keys(), ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_font.py"
+# End:
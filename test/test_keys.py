@@ -0,0 +1,495 @@
+import sys
+import os
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from Xlib import X, XK
+from plwm import keys, event, wmanager
+
+
+# Helper dummy classes, only providing what the key handlers use
+
+keycodes = {XK.XK_x: 10, XK.XK_f: 11, XK.XK_c: 12, XK.XK_4: 13, XK.XK_g: 14,
+            XK.XK_Control_L: 37}
+
+keysyms = {}
+for sym, code in keycodes.items():
+    keysyms[code] = sym
+
+class EventsDummy:
+    def __init__(self):
+        self.timers = []
+
+    def add_timer(self, timer):
+        self.timers.append(timer)
+
+class DisplayDummy:
+    def __init__(self):
+        self.bells = 0
+        self.ungrabs = 0
+
+    def bell(self, percent):
+        self.bells = self.bells + 1
+
+    def keycode_to_keysym(self, code, index):
+        return keysyms.get(code, X.NoSymbol)
+
+    def ungrab_keyboard(self, time):
+        self.ungrabs = self.ungrabs + 1
+
+class WindowManagerDummy:
+    keymap_generation = 1
+
+    def __init__(self):
+        self.events = EventsDummy()
+        self.display = DisplayDummy()
+        self.flushes = 0
+
+    def keysym_to_keycodes(self, keysym):
+        return [(keycodes[keysym], 0)]
+
+    def flush(self):
+        self.flushes = self.flushes + 1
+
+class WindowDummy:
+    def __init__(self):
+        self.grabbed = {}
+        self.keyboard_grabs = 0
+
+    def grab_key(self, code, mods, owner_events, pointer_mode, keyboard_mode):
+        self.grabbed[(code, mods)] = 1
+
+    def ungrab_key(self, code, mods):
+        del self.grabbed[(code, mods)]
+
+    def grab_keyboard(self, owner_events, pointer_mode, keyboard_mode, time):
+        self.keyboard_grabs = self.keyboard_grabs + 1
+        return X.GrabSuccess
+
+class ScreenDummy(wmanager.Screen):
+    def __init__(self):
+        self.wm = WindowManagerDummy()
+        self.root = WindowDummy()
+        self.dispatch = event.EventDispatcher()
+
+class KeyEventDummy:
+    def __init__(self, type, keysym, state = 0):
+        self.type = type
+        self.detail = keycodes[keysym]
+        self.state = state
+        self.time = X.CurrentTime
+
+
+class Sequences(keys.KeySequenceHandler):
+    key_sequences = (('C_x C_f', 'find_file'),
+                     ('C_x 4 f', 'find_file_other_window'),
+                     ('C_c', 'mode'))
+
+    def __init__(self, obj):
+        self.called = []
+        keys.KeySequenceHandler.__init__(self, obj)
+
+    def find_file(self, evt):
+        self.called.append('find_file')
+
+    def find_file_other_window(self, evt):
+        self.called.append('find_file_other_window')
+
+    def mode(self, evt):
+        self.called.append('mode')
+
+    def C_f(self, evt):
+        self.called.append('C_f')
+
+class Other(keys.KeyHandler):
+    def __init__(self, obj):
+        self.called = []
+        keys.KeyHandler.__init__(self, obj)
+
+    def f(self, evt):
+        self.called.append('f')
+
+
+def press(screen, keysym, state = 0):
+    screen.dispatch.handle_event(KeyEventDummy(X.KeyPress, keysym, state))
+    screen.dispatch.handle_event(KeyEventDummy(X.KeyRelease, keysym, state))
+
+C_x = XK.XK_x, X.ControlMask
+C_f = XK.XK_f, X.ControlMask
+
+
+class Bindings(keys.KeyHandler):
+    def C_x(self, evt):
+        pass
+
+    def f(self, evt):
+        pass
+
+    def _private(self, evt):
+        pass
+
+    def not_a_key(self, evt):
+        pass
+
+class MoreBindings(Bindings):
+    def f(self, evt):
+        pass
+
+    def R_c(self, evt):
+        pass
+
+class InstanceBindings(MoreBindings):
+    def __init__(self, obj):
+        self.called = []
+        self.f = lambda evt, called = self.called: called.append('instance f')
+        self.C_c = lambda evt, called = self.called: called.append('C_c')
+        MoreBindings.__init__(self, obj)
+
+def binding_names(cls):
+    binds = keys.class_bindings(cls)[:]
+    binds.sort()
+    return binds
+
+
+class TestBindings(unittest.TestCase):
+    def setUp(self):
+        self.screen = ScreenDummy()
+
+    def test_00_parse(self):
+        self.assertEqual(keys.parse_keymethod('C_M_F1'),
+                         (XK.XK_F1, X.ControlMask | X.Mod1Mask))
+        self.assertEqual(keys.parse_keymethod('Any_x'),
+                         (XK.XK_x, X.AnyModifier))
+        self.assertEqual(keys.parse_keymethod('x'), (XK.XK_x, 0))
+        self.assertEqual(keys.parse_keymethod('_x'), None)
+        self.assertEqual(keys.parse_keymethod('not_a_key'), None)
+
+    def test_01_class_bindings(self):
+        self.assertEqual(binding_names(Bindings),
+                         [(XK.XK_f, 0, 'f'), (XK.XK_x, X.ControlMask, 'C_x')])
+
+        # Subclasses include the bindings of the base classes
+        self.assertEqual(binding_names(MoreBindings),
+                         [(XK.XK_c, keys.ReleaseModifier, 'R_c'),
+                          (XK.XK_f, 0, 'f'), (XK.XK_x, X.ControlMask, 'C_x')])
+
+        # The names are only parsed once per class
+        self.assert_(keys.class_bindings(Bindings)
+                     is keys.class_bindings(Bindings))
+
+    def test_02_instance_bindings(self):
+        h = InstanceBindings(self.screen)
+        try:
+            self.assertEqual(len(h.bindings), 4)
+            press(self.screen, XK.XK_f)
+            press(self.screen, XK.XK_c, X.ControlMask)
+            self.assertEqual(h.called, ['instance f', 'C_c'])
+
+            # Instance names don't leak into the class bindings
+            self.assertEqual(len(keys.class_bindings(InstanceBindings)), 3)
+        finally:
+            h._cleanup()
+
+    def test_03_allmap(self):
+        class AllMapped(keys.KeyHandler):
+            def insert(self, evt):
+                pass
+
+        self.assertEqual(keys.class_bindings(AllMapped), [])
+        keys.allmap(AllMapped, AllMapped.insert)
+        binds = keys.class_bindings(AllMapped)
+        self.assert_((XK.XK_a, 0, 'a') in binds)
+        self.assert_((XK.XK_A, 0, 'A') in binds)
+
+
+class KeymapDisplayDummy(DisplayDummy):
+    def __init__(self):
+        DisplayDummy.__init__(self)
+        self.keycodes = keycodes.copy()
+        self.lookups = 0
+        self.refreshes = 0
+
+    def keysym_to_keycodes(self, keysym):
+        self.lookups = self.lookups + 1
+        return iter([(self.keycodes[keysym], 0)])
+
+    def refresh_keyboard_mapping(self, evt):
+        self.refreshes = self.refreshes + 1
+
+class KeymapWindowManager(wmanager.WindowManager):
+    def __init__(self):
+        self.events = EventsDummy()
+        self.display = KeymapDisplayDummy()
+        self.keymap_generation = 0
+        self.keycode_cache = {}
+
+    def flush(self):
+        pass
+
+class MappingEventDummy:
+    type = X.MappingNotify
+
+    def __init__(self, request):
+        self.request = request
+
+
+class TestKeycodeCache(unittest.TestCase):
+    def setUp(self):
+        self.wm = KeymapWindowManager()
+        self.display = self.wm.display
+
+    def test_00_cached(self):
+        self.assertEqual(self.wm.keysym_to_keycodes(XK.XK_x), [(10, 0)])
+        self.assertEqual(self.wm.keysym_to_keycodes(XK.XK_x), [(10, 0)])
+        self.assertEqual(self.display.lookups, 1)
+
+    def test_01_mapping_notify(self):
+        self.wm.keysym_to_keycodes(XK.XK_x)
+
+        # Only keyboard mapping changes clear the cache
+        for r in X.MappingModifier, X.MappingPointer:
+            self.wm.handle_mapping_notify(MappingEventDummy(r))
+        self.assertEqual(self.wm.keymap_generation, 0)
+        self.wm.keysym_to_keycodes(XK.XK_x)
+        self.assertEqual(self.display.lookups, 1)
+
+        self.display.keycodes[XK.XK_x] = 20
+        self.wm.handle_mapping_notify(MappingEventDummy(X.MappingKeyboard))
+        self.assertEqual(self.wm.keymap_generation, 1)
+        self.assertEqual(self.wm.keysym_to_keycodes(XK.XK_x), [(20, 0)])
+        self.assertEqual(self.display.lookups, 2)
+        self.assertEqual(self.display.refreshes, 3)
+
+    def test_02_handlers_rebuild_once(self):
+        screen = ScreenDummy()
+        screen.wm = self.wm
+        handlers = [Bindings(screen), Bindings(screen)]
+        try:
+            self.assertEqual(self.display.lookups, 2)
+
+            # Events not changing the keyboard mapping, or seen
+            # again, don't rebuild the handlers
+            evt = MappingEventDummy(X.MappingModifier)
+            self.wm.handle_mapping_notify(evt)
+            screen.dispatch.handle_event(evt)
+            self.assertEqual(self.display.lookups, 2)
+
+            self.display.keycodes[XK.XK_x] = 20
+            evt = MappingEventDummy(X.MappingKeyboard)
+            self.wm.handle_mapping_notify(evt)
+            screen.dispatch.handle_event(evt)
+            screen.dispatch.handle_event(evt)
+            self.assertEqual(self.display.lookups, 4)
+
+            for h in handlers:
+                self.assertEqual(h.keymap_generation, 1)
+            grabbed = screen.root.grabbed.keys()
+            grabbed.sort()
+            self.assertEqual(grabbed, [(11, 0), (20, X.ControlMask)])
+        finally:
+            for h in handlers:
+                h._cleanup()
+
+
+class TestKeygrabManager(unittest.TestCase):
+    def setUp(self):
+        self.wm = WindowManagerDummy()
+        self.window = WindowDummy()
+        self.mgr = keys.KeygrabManager(self.wm, self.window)
+
+    def test_00_reference_counted(self):
+        self.mgr.grab_keys([(10, 0)])
+        self.mgr.grab_keys([(10, 0)])
+        self.assertEqual(self.window.grabbed, {(10, 0): 1})
+        self.assertEqual(self.mgr.grab_requests, 1)
+        self.assertEqual(self.wm.flushes, 1)
+
+        self.mgr.ungrab_keys([(10, 0)])
+        self.assertEqual(self.window.grabbed, {(10, 0): 1})
+        self.mgr.ungrab_keys([(10, 0)])
+        self.assertEqual(self.window.grabbed, {})
+        self.assertEqual(self.mgr.ungrab_requests, 1)
+        self.assertEqual(self.wm.flushes, 2)
+
+        # Ungrabbing keys not grabbed does nothing
+        self.mgr.ungrab_keys([(10, 0)])
+        self.assertEqual(self.mgr.ungrab_requests, 1)
+        self.assertEqual(self.wm.flushes, 2)
+
+    def test_01_release_modifier(self):
+        # Press and release bindings share the grab
+        self.mgr.grab_keys([(10, X.ControlMask),
+                            (10, X.ControlMask | keys.ReleaseModifier)])
+        self.assertEqual(self.window.grabbed, {(10, X.ControlMask): 1})
+        self.assertEqual(self.mgr.grab_requests, 1)
+
+        self.mgr.ungrab_keys([(10, X.ControlMask)])
+        self.assertEqual(self.window.grabbed, {(10, X.ControlMask): 1})
+        self.mgr.ungrab_keys([(10, X.ControlMask | keys.ReleaseModifier)])
+        self.assertEqual(self.window.grabbed, {})
+
+    def test_02_update(self):
+        self.mgr.grab_keys([(10, 0), (11, 0)])
+        self.mgr.begin_update()
+        self.mgr.begin_update()
+        self.mgr.ungrab_keys([(10, 0), (11, 0)])
+        self.mgr.grab_keys([(10, 0), (12, 0)])
+        self.mgr.end_update()
+        self.assertEqual(self.mgr.grab_requests, 2)
+        self.assertEqual(self.mgr.ungrab_requests, 0)
+
+        # Only the changes are sent when the update is done
+        self.mgr.end_update()
+        self.assertEqual(self.window.grabbed, {(10, 0): 1, (12, 0): 1})
+        self.assertEqual(self.mgr.grab_requests, 3)
+        self.assertEqual(self.mgr.ungrab_requests, 1)
+        self.assertEqual(self.wm.flushes, 2)
+
+    def test_03_rebuild(self):
+        screen = ScreenDummy()
+        h = Bindings(screen)
+        try:
+            mgr = screen.keygrab_mgr
+            self.assertEqual(mgr.grab_requests, 2)
+
+            # An unchanged key map doesn't touch the grabs
+            h._buildmap()
+            self.assertEqual(mgr.grab_requests, 2)
+            self.assertEqual(mgr.ungrab_requests, 0)
+        finally:
+            h._cleanup()
+        self.assertEqual(screen.root.grabbed, {})
+
+
+class TestSequenceParse(unittest.TestCase):
+    def test_00_parse(self):
+        seqs = keys.class_sequences(Sequences)[:]
+        seqs.sort()
+        self.assertEqual(seqs,
+                         [(((XK.XK_c, X.ControlMask), ), 'mode'),
+                          ((C_x, (XK.XK_4, 0), (XK.XK_f, 0)),
+                           'find_file_other_window'),
+                          ((C_x, C_f), 'find_file')])
+
+    def test_01_prefix_conflict(self):
+        class Conflict(keys.KeySequenceHandler):
+            key_sequences = (('C_x C_f', 'find_file'),
+                             ('C_x', 'prefix'))
+
+        self.assertRaises(ValueError, keys.class_sequences, Conflict)
+
+    def test_02_duplicate(self):
+        class Duplicate(keys.KeySequenceHandler):
+            key_sequences = (('C_x C_f', 'find_file'),
+                             ('C_x C_f', 'other'))
+
+        self.assertRaises(ValueError, keys.class_sequences, Duplicate)
+
+    def test_03_bad_key(self):
+        class Bad(keys.KeySequenceHandler):
+            key_sequences = (('C_x NoSuchKey', 'find_file'), )
+
+        self.assertRaises(ValueError, keys.class_sequences, Bad)
+
+
+class TestSequence(unittest.TestCase):
+    def setUp(self):
+        self.screen = ScreenDummy()
+        self.handler = Sequences(self.screen)
+
+    def tearDown(self):
+        self.handler._cleanup()
+
+    def test_00_trie(self):
+        trie = self.handler.sequence_trie
+        x = keys.hash_keycode(keycodes[XK.XK_x], X.ControlMask)
+        f = keys.hash_keycode(keycodes[XK.XK_f], X.ControlMask)
+        c = keys.hash_keycode(keycodes[XK.XK_c], X.ControlMask)
+        self.assertEqual(trie[x][f], self.handler.find_file)
+        self.assertEqual(trie[c], self.handler.mode)
+
+        # Only the first keys are grabbed
+        grabbed = self.screen.root.grabbed.keys()
+        grabbed.sort()
+        self.assertEqual(grabbed, [(10, X.ControlMask), (11, X.ControlMask),
+                                   (12, X.ControlMask)])
+
+    def test_01_sequence(self):
+        press(self.screen, XK.XK_x, X.ControlMask)
+        self.assertEqual(self.screen.root.keyboard_grabs, 1)
+        self.assertEqual(self.handler.called, [])
+
+        # Modifier keys don't abort the sequence
+        press(self.screen, XK.XK_Control_L)
+        press(self.screen, XK.XK_f, X.ControlMask)
+        self.assertEqual(self.handler.called, ['find_file'])
+        self.assertEqual(self.handler.sequence_node, None)
+        self.assertEqual(self.screen.wm.display.ungrabs, 1)
+
+        # Outside sequences the ordinary bindings work
+        press(self.screen, XK.XK_f, X.ControlMask)
+        press(self.screen, XK.XK_c, X.ControlMask)
+        self.assertEqual(self.handler.called, ['find_file', 'C_f', 'mode'])
+
+    def test_02_longer_sequence(self):
+        press(self.screen, XK.XK_x, X.ControlMask)
+        press(self.screen, XK.XK_4)
+        self.assertEqual(self.handler.called, [])
+        press(self.screen, XK.XK_f)
+        self.assertEqual(self.handler.called, ['find_file_other_window'])
+
+    def test_03_abort(self):
+        press(self.screen, XK.XK_x, X.ControlMask)
+        press(self.screen, XK.XK_g)
+        self.assertEqual(self.handler.called, [])
+        self.assertEqual(self.handler.sequence_node, None)
+        self.assertEqual(self.screen.wm.display.bells, 1)
+        self.assertEqual(self.screen.wm.display.ungrabs, 1)
+        self.assertEqual(self.handler.sequence_timer, None)
+
+    def test_04_timeout(self):
+        press(self.screen, XK.XK_x, X.ControlMask)
+        timer = self.handler.sequence_timer
+        self.assert_(timer in self.screen.wm.events.timers)
+
+        # Each key restarts the timer
+        press(self.screen, XK.XK_4)
+        self.assert_(self.handler.sequence_timer is not timer)
+        self.assertEqual(timer.time, None)
+
+        # A stale timer doesn't abort the sequence
+        self.screen.dispatch.handle_event(timer)
+        self.assert_(self.handler.sequence_node is not None)
+
+        self.screen.dispatch.handle_event(self.handler.sequence_timer)
+        self.assertEqual(self.handler.sequence_node, None)
+        self.assertEqual(self.handler.sequence_timer, None)
+        self.assertEqual(self.screen.wm.display.ungrabs, 1)
+
+        # The sequence is forgotten
+        press(self.screen, XK.XK_f)
+        self.assertEqual(self.handler.called, [])
+
+    def test_05_other_handlers(self):
+        other = Other(self.screen)
+        try:
+            press(self.screen, XK.XK_x, X.ControlMask)
+            press(self.screen, XK.XK_4)
+            press(self.screen, XK.XK_f)
+
+            # The sequence keys are kept from other handlers
+            self.assertEqual(self.handler.called, ['find_file_other_window'])
+            self.assertEqual(other.called, [])
+
+            press(self.screen, XK.XK_f)
+            self.assertEqual(other.called, ['f'])
+        finally:
+            other._cleanup()
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_keys.py"
+# End:
@@ -0,0 +1,136 @@
+import sys
+import os
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from plwm import modewindow
+
+
+# Helper dummy classes, only providing what the mode window uses
+
+class WindowManagerDummy:
+    def __init__(self):
+        self.batch_callbacks = []
+        self.flushes = 0
+
+    def after_batch(self, func):
+        self.batch_callbacks.append(func)
+
+    def end_batch(self):
+        callbacks = self.batch_callbacks
+        self.batch_callbacks = []
+        for func in callbacks:
+            func()
+
+    def flush(self):
+        self.flushes = self.flushes + 1
+
+class TextExtentsDummy:
+    def __init__(self, text):
+        self.overall_width = 6 * len(text)
+
+class FontDummy:
+    def query_text_extents(self, text):
+        return TextExtentsDummy(text)
+
+class DrawableDummy:
+    def __init__(self):
+        self.ops = []
+        self.fail = 0
+
+    def fill_rectangle(self, gc, x, y, width, height):
+        if self.fail:
+            raise ValueError('failing request')
+        self.ops.append(('fill', x, width))
+
+    def draw_text(self, gc, x, y, text):
+        self.ops.append(('text', x, text))
+
+    def copy_area(self, gc, src, src_x, src_y, width, height, x, y):
+        self.ops.append(('copy', x, width))
+
+class ModeWindowDummy(modewindow.ModeWindow):
+    def __init__(self, width):
+        self.messages = []
+        self.wm = WindowManagerDummy()
+        self.font = FontDummy()
+        self.width = width
+        self.height = 10
+        self.base = 8
+        self.gc = self.bg_gc = None
+        self.pixmap = DrawableDummy()
+        self.window = DrawableDummy()
+        self.damaged = []
+        self.dirty = {}
+        self.render_pending = 0
+
+
+class TestMergeSpans(unittest.TestCase):
+    def test_00_merge(self):
+        self.assertEqual(modewindow.merge_spans([], 100), [])
+        self.assertEqual(modewindow.merge_spans([(50, 10), (10, 10)], 100),
+                         [(10, 10), (50, 10)])
+        self.assertEqual(modewindow.merge_spans([(10, 10), (15, 10), (20, 5)],
+                                                100),
+                         [(10, 15)])
+        self.assertEqual(modewindow.merge_spans([(10, 20), (12, 3)], 100),
+                         [(10, 20)])
+
+    def test_01_clip(self):
+        self.assertEqual(modewindow.merge_spans([(-5, 10), (95, 10)], 100),
+                         [(0, 5), (95, 5)])
+        self.assertEqual(modewindow.merge_spans([(-10, 5), (100, 5), (7, 0)],
+                                                100),
+                         [])
+
+
+class TestRender(unittest.TestCase):
+    def setUp(self):
+        self.mw = ModeWindowDummy(100)
+        self.m1 = modewindow.Message(0.0, modewindow.LEFT, text = 'ab')
+        self.m2 = modewindow.Message(1.0, modewindow.RIGHT, text = 'xyz')
+        self.mw.add_message(self.m1)
+        self.mw.add_message(self.m2)
+
+    def test_00_one_render(self):
+        # All changes in a batch are rendered once
+        self.assertEqual(len(self.mw.wm.batch_callbacks), 1)
+        self.mw.wm.end_batch()
+        self.assertEqual(self.mw.pixmap.ops,
+                         [('fill', 0, 16), ('fill', 78, 22),
+                          ('text', 2, 'ab'), ('text', 80, 'xyz')])
+        self.assertEqual(self.mw.window.ops,
+                         [('copy', 0, 16), ('copy', 78, 22)])
+        self.assertEqual(self.mw.wm.flushes, 1)
+
+    def test_01_changed_text(self):
+        self.mw.wm.end_batch()
+        self.mw.pixmap.ops = []
+
+        # The area of the drawn text is cleared, and only the
+        # messages touching the damaged spans are drawn
+        self.m1.set_text('abcd')
+        self.m1.set_text('a')
+        self.mw.wm.end_batch()
+        self.assertEqual(self.mw.pixmap.ops,
+                         [('fill', 0, 16), ('text', 2, 'a')])
+
+    def test_02_render_fails(self):
+        self.mw.pixmap.fail = 1
+        self.assertRaises(ValueError, self.mw.wm.end_batch)
+        self.assertEqual(self.mw.render_pending, 0)
+
+        # Later damage is still rendered
+        self.mw.pixmap.fail = 0
+        self.m2.set_text('x')
+        self.assertEqual(len(self.mw.wm.batch_callbacks), 1)
+        self.mw.wm.end_batch()
+        self.assertEqual(self.mw.pixmap.ops[-1], ('text', 92, 'x'))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_modewindow.py"
+# End:
@@ -0,0 +1,99 @@
+import sys
+import os
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from Xlib import X
+from plwm import mouse, keys
+
+
+# Helper dummy classes, only providing what MousegrabManager uses
+
+class WindowManagerDummy:
+    def __init__(self):
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes = self.flushes + 1
+
+class WindowDummy:
+    def __init__(self):
+        self.grabbed = {}
+
+    def grab_button(self, button, modifiers, owner_events, event_mask,
+                    pointer_mode, keyboard_mode, confine_to, cursor,
+                    onerror = None):
+        self.grabbed[(button, modifiers)] = event_mask
+
+    def ungrab_button(self, button, modifiers):
+        del self.grabbed[(button, modifiers)]
+
+
+B1Down = mouse.string_to_buttonsym('B1Down')
+B1Up = mouse.string_to_buttonsym('B1Up')
+RDown = mouse.string_to_buttonsym('RDown')
+
+
+class TestMousegrabManager(unittest.TestCase):
+    def setUp(self):
+        self.wm = WindowManagerDummy()
+        self.window = WindowDummy()
+        self.mgr = mouse.MousegrabManager(self.wm, self.window)
+
+    def test_00_buttonsyms(self):
+        self.assertEqual(B1Down, X.Button1)
+        self.assertEqual(B1Up, 8 + X.Button1)
+        self.assertEqual(RDown, X.Button3)
+        self.assertEqual(mouse.string_to_buttonsym('B6Down'), None)
+
+    def test_01_reference_counted(self):
+        self.mgr.grab_buttons([(B1Down, 0)])
+        self.mgr.grab_buttons([(B1Down, 0)])
+        self.assertEqual(self.window.grabbed, {(1, 0): X.ButtonPressMask})
+        self.assertEqual(self.mgr.grab_requests, 1)
+
+        self.mgr.ungrab_buttons([(B1Down, 0)])
+        self.assertEqual(self.mgr.ungrab_requests, 0)
+        self.mgr.ungrab_buttons([(B1Down, 0)])
+        self.assertEqual(self.window.grabbed, {})
+        self.assertEqual(self.mgr.ungrab_requests, 1)
+        self.assertEqual(self.wm.flushes, 2)
+
+    def test_02_masks_combined(self):
+        # All buttonsyms of a button are grabbed with a single grab
+        self.mgr.grab_buttons([(B1Down, X.ControlMask),
+                               (B1Up, X.ControlMask | keys.ReleaseModifier),
+                               (RDown, 0)])
+        self.assertEqual(self.window.grabbed,
+                         {(1, X.ControlMask): X.ButtonPressMask
+                                              | X.ButtonReleaseMask,
+                          (3, 0): X.ButtonPressMask})
+        self.assertEqual(self.mgr.grab_requests, 2)
+
+        # Changing the mask regrabs the button
+        self.mgr.ungrab_buttons([(B1Up, X.ControlMask | keys.ReleaseModifier)])
+        self.assertEqual(self.window.grabbed[(1, X.ControlMask)],
+                         X.ButtonPressMask)
+        self.assertEqual(self.mgr.grab_requests, 3)
+        self.assertEqual(self.mgr.ungrab_requests, 0)
+
+    def test_03_update(self):
+        self.mgr.grab_buttons([(B1Down, 0), (RDown, 0)])
+        self.mgr.begin_update()
+        self.mgr.ungrab_buttons([(B1Down, 0), (RDown, 0)])
+        self.mgr.grab_buttons([(B1Down, 0)])
+        self.assertEqual(self.mgr.ungrab_requests, 0)
+        self.mgr.end_update()
+
+        self.assertEqual(self.window.grabbed, {(1, 0): X.ButtonPressMask})
+        self.assertEqual(self.mgr.grab_requests, 2)
+        self.assertEqual(self.mgr.ungrab_requests, 1)
+        self.assertEqual(self.wm.flushes, 2)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_mouse.py"
+# End:
@@ -0,0 +1,186 @@
+import sys
+import os
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from plwm import moveresize, event
+
+
+# Helper dummy classes, only providing what the move/resize code uses
+
+class ClockDummy:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class EventsDummy:
+    def __init__(self):
+        self.timers = []
+        self.events = []
+
+    def add_timer(self, timer):
+        self.timers.append(timer)
+
+    def put_event(self, evt):
+        self.events.append(evt)
+
+class WindowManagerDummy:
+    def __init__(self):
+        self.dispatch = event.EventDispatcher()
+        self.events = EventsDummy()
+
+    def fire_timers(self):
+        timers = self.events.timers
+        self.events.timers = []
+        for t in timers:
+            if t.time is not None:
+                self.dispatch.handle_event(t)
+
+class ClientDummy:
+    def __init__(self, wm):
+        self.wm = wm
+        self.moves = []
+        self.outlines = []
+
+    def geometry(self):
+        return 0, 0, 100, 100, 1
+
+    def resize_increment(self):
+        return 0, 0
+
+    def pointer_position(self):
+        return None
+
+    def follow_size_hints(self, width, height):
+        return width, height
+
+    def keep_on_screen(self, x, y, width, height):
+        return x, y, width, height
+
+    def moveresize(self, x, y, width, height):
+        self.moves.append((x, y))
+
+    def outline_show(self, x, y, width, height):
+        self.outlines.append((x, y))
+
+    def outline_hide(self):
+        self.outlines.append(None)
+
+
+class ThrottleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = ClockDummy()
+        self.time = moveresize.time
+        moveresize.time = self.clock
+        self.wm = WindowManagerDummy()
+
+    def tearDown(self):
+        moveresize.time = self.time
+
+
+class TestThrottle(ThrottleTestCase):
+    def setUp(self):
+        ThrottleTestCase.setUp(self)
+        self.called = []
+        self.throttle = moveresize.Throttle(self.wm, self.called.append, 10)
+
+    def test_00_postponed(self):
+        self.throttle(1)
+        self.throttle(2)
+        self.throttle(3)
+        self.assertEqual(self.called, [1])
+
+        # Only the last postponed call is made, when the timer fires
+        self.assertEqual(len(self.wm.events.timers), 1)
+        self.clock.now = self.clock.now + 0.1
+        self.wm.fire_timers()
+        self.assertEqual(self.called, [1, 3])
+        self.assertEqual(self.throttle.calls, 2)
+        self.assertEqual(self.throttle.postponed, 2)
+
+        # A call long enough after the last one is made at once
+        self.clock.now = self.clock.now + 0.1
+        self.throttle(4)
+        self.assertEqual(self.called, [1, 3, 4])
+
+    def test_01_unthrottled(self):
+        throttle = moveresize.Throttle(self.wm, self.called.append, 0)
+        for i in range(3):
+            throttle(i)
+        self.assertEqual(self.called, [0, 1, 2])
+        self.assertEqual(self.wm.events.timers, [])
+
+    def test_02_flush(self):
+        self.throttle(1)
+        self.throttle(2)
+        self.throttle.flush()
+        self.assertEqual(self.called, [1, 2])
+
+        # The timer is cancelled, and flushing again does nothing
+        self.wm.fire_timers()
+        self.throttle.flush()
+        self.assertEqual(self.called, [1, 2])
+
+    def test_03_close(self):
+        self.throttle(1)
+        self.throttle(2)
+        timer = self.throttle.timer
+        self.throttle.close()
+        self.throttle.close()
+        self.assertEqual(timer.time, None)
+
+        # Even a stray timer event doesn't make the dropped call
+        self.wm.dispatch.handle_event(event.TimerEvent(self.throttle.timer_id,
+                                                       after = 0))
+        self.assertEqual(self.called, [1])
+
+
+class TestMoveResize(ThrottleTestCase):
+    def setUp(self):
+        ThrottleTestCase.setUp(self)
+        self.client = ClientDummy(self.wm)
+
+    def test_00_opaque(self):
+        mr = moveresize.MoveResizeOpaque(self.client)
+        for i in range(5):
+            mr.move(1, 0)
+        self.assertEqual(self.client.moves, [(1, 0)])
+
+        # The final geometry is always applied
+        mr.end()
+        self.assertEqual(self.client.moves, [(1, 0), (5, 0)])
+        self.assertEqual(self.wm.events.events[-1].type,
+                         moveresize.MoveResizeEnd)
+
+    def test_01_outline(self):
+        mr = moveresize.MoveResizeOutline(self.client)
+        for i in range(5):
+            mr.move(0, 1)
+        mr.end()
+
+        # The postponed outline isn't drawn, but the final geometry
+        # is reported
+        self.assertEqual(self.client.outlines, [(0, 0), (0, 1), None])
+        self.assertEqual(self.client.moves, [(0, 5)])
+        self.assertEqual([(e.x, e.y) for e in self.wm.events.events
+                          if e.type == moveresize.MoveResizeDo],
+                         [(0, 1), (0, 5)])
+        self.assertEqual(self.wm.events.timers[0].time, None)
+
+    def test_02_abort(self):
+        mr = moveresize.MoveResizeOpaque(self.client)
+        mr.move(1, 0)
+        mr.move(1, 0)
+        mr.abort()
+        self.wm.fire_timers()
+        self.assertEqual(self.client.moves, [(1, 0)])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_moveresize.py"
+# End:
@@ -0,0 +1,109 @@
+import sys
+import os
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+from plwm import outline
+
+
+# Helper dummy classes, only providing what the outline windows use
+
+class WindowDummy:
+    def __init__(self):
+        self.mapped = 0
+        self.configures = 0
+
+    def configure(self, **keys):
+        self.configures = self.configures + 1
+
+    def map(self):
+        self.mapped = 1
+
+    def unmap(self):
+        self.mapped = 0
+
+    def create_gc(self, **keys):
+        return None
+
+    def image_text(self, gc, x, y, text):
+        pass
+
+class RootDummy:
+    def __init__(self):
+        self.windows = []
+
+    def create_window(self, *args, **keys):
+        w = WindowDummy()
+        self.windows.append(w)
+        return w
+
+class InfoDummy:
+    black_pixel = 0
+    white_pixel = 1
+
+class WindowManagerDummy:
+    def get_font_res(self, name, cls, default):
+        return default
+
+class ScreenDummy:
+    number = 0
+
+    def __init__(self):
+        self.wm = WindowManagerDummy()
+        self.root = RootDummy()
+        self.info = InfoDummy()
+
+class ClientDummy(outline.WindowOutlineClient):
+    def __init__(self, screen):
+        self.screen = screen
+        self.__client_init__()
+
+segments = [(i, i, i + 10, i + 10) for i in range(8)]
+
+
+class TestWindowOutline(unittest.TestCase):
+    def setUp(self):
+        self.screen = ScreenDummy()
+        self.c1 = ClientDummy(self.screen)
+        self.c2 = ClientDummy(self.screen)
+
+    def test_00_shared(self):
+        self.assert_(self.c1.outline is self.c2.outline)
+        self.assertEqual(self.screen.root.windows, [])
+
+        self.c1.outline.show(self.c1, segments, None, None)
+        self.c2.outline.show(self.c2, segments, None, None)
+        self.assertEqual(len(self.screen.root.windows), 9)
+
+        # Only the owner hides the outline
+        self.c1.outline_hide()
+        self.assertEqual(self.c2.outline.mapped, 1)
+        self.c2.outline_hide()
+        self.assertEqual(self.c2.outline.mapped, 0)
+
+    def test_01_unchanged_segments(self):
+        o = self.c1.outline
+        o.show(self.c1, segments, None, None)
+        configures = [w.configures for w in o.windows]
+        o.show(self.c1, segments, None, None)
+        self.assertEqual([w.configures for w in o.windows], configures)
+
+    def test_02_client_removed(self):
+        o = self.c1.outline
+        o.show(self.c1, segments, None, None)
+        self.c1.__client_del__()
+        self.assertEqual(o.owner, None)
+        self.assertEqual([w.mapped for w in o.windows], [0] * 8)
+
+        # Removing another client keeps its outline
+        o.show(self.c2, segments, None, None)
+        self.c1.__client_del__()
+        self.assert_(o.owner is self.c2)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_outline.py"
+# End:
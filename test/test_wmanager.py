@@ -0,0 +1,861 @@
+import sys
+import os
+import unittest
+
+sys.path[1:1] = [os.path.join(sys.path[0], '..')]
+
+import struct
+import array
+import random
+import StringIO
+
+from Xlib import X, Xatom, Xutil, error
+from Xlib.protocol import request
+from Xlib.xobject import drawable
+from plwm import wmanager, wmevents, event
+
+
+# Helper dummy classes, only providing what the tested code uses.
+# Windows are represented by integers, the root window is 1.
+
+ROOT = 1
+
+class XEventDummy:
+    send_event = 0
+
+    def __init__(self, type, window, **keys):
+        self.type = type
+        self.window = window
+        self.__dict__.update(keys)
+
+class GeometryDummy:
+    def __init__(self, root):
+        self.root = root
+
+class XWindowDummy:
+    """An unknown window, counting the get_geometry() round trips."""
+
+    def __init__(self, root):
+        self.root = root
+        self.geometry_requests = 0
+
+    def get_geometry(self):
+        self.geometry_requests = self.geometry_requests + 1
+        return GeometryDummy(self.root)
+
+class WindowManagerDummy(wmanager.WindowManager):
+    unknown_window_cache_size = 10
+
+    def __init__(self):
+        self.dispatch = event.EventDispatcher()
+        self.screens = []
+        self.screen_roots = {}
+        self.window_screens = {}
+        self.unknown_windows = {}
+
+        self.dispatch.add_system_handler(X.CreateNotify,
+                                         self.handle_window_lifecycle)
+        self.dispatch.add_system_handler(X.DestroyNotify,
+                                         self.handle_window_lifecycle)
+        for t in (X.CreateNotify, X.DestroyNotify, X.ReparentNotify,
+                  X.ConfigureNotify, X.CirculateNotify):
+            self.dispatch.add_system_handler(t, self.handle_stacking_event)
+
+class ScreenDummy(wmanager.Screen):
+    def __init__(self, wm, root):
+        self.wm = wm
+        self.root = root
+        self.dispatch = event.EventDispatcher()
+        self.windows = {}
+        self.proxy_windows = {}
+        self.proxied_windows = {}
+        self.stacking = wmanager.StackingOrder(root)
+
+        wm.screens.append(self)
+        wm.screen_roots[root] = self
+
+class ClientDummy(wmanager.Client):
+    def __init__(self, screen, window):
+        self.screen = screen
+        self.wm = screen.wm
+        self.window = window
+        self.dispatch = event.EventDispatcher()
+
+        screen.windows[window] = self
+        self.wm.register_window(window, screen)
+
+class Recorder:
+    def __init__(self, dispatch, *types):
+        self.events = []
+        for t in types:
+            dispatch.add_handler(t, self.events.append)
+
+
+# A fake X server, answering the requests used to fetch properties
+# and window attributes.  Replies are only read when a request
+# waiting for one is reached, so round_trips counts how many times
+# the client had to wait for the server.
+
+class LockDummy:
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+class BadWindowDummy(error.BadWindow):
+    def __init__(self):
+        pass
+
+class ServerDummy:
+    def __init__(self):
+        # Map window ids to (properties, attributes), where
+        # properties map atoms to (type, format, value)
+        self.windows = {}
+        self.pending = []
+        self.requests = 0
+        self.round_trips = 0
+        self.send_recv_lock = LockDummy()
+
+    def add_window(self, wid, properties = None, map_state = X.IsViewable,
+                   override_redirect = 0):
+        self.windows[wid] = (properties or {},
+                             {'map_state': map_state,
+                              'override_redirect': override_redirect})
+        return drawable.Window(self, wid)
+
+    def get_atom(self, name):
+        return XlibDisplayDummy.atoms[name]
+
+    def get_resource_class(self, name, default = None):
+        if name == 'window':
+            return drawable.Window
+        return default
+
+    def send_request(self, req, wait_for_response):
+        self.requests = self.requests + 1
+        self.pending.append(req)
+
+    def send_and_recv(self, request = None):
+        self.round_trips = self.round_trips + 1
+        for req in self.pending:
+            self.answer(req)
+        self.pending = []
+
+    def answer(self, req):
+        if isinstance(req, request.GetProperty):
+            wid, prop, ptype = struct.unpack('=LLL', req._binary[4:16])
+        else:
+            wid = struct.unpack('=L', req._binary[4:8])[0]
+
+        try:
+            props, attrs = self.windows[wid]
+        except KeyError:
+            req._error = BadWindowDummy()
+            return
+
+        if not isinstance(req, request.GetProperty):
+            req._data = attrs
+            return
+
+        try:
+            actual, fmt, value = props[prop]
+        except KeyError:
+            req._data = {'property_type': 0, 'bytes_after': 0,
+                         'value': (0, '')}
+            return
+
+        if ptype and ptype != actual:
+            req._data = {'property_type': actual, 'bytes_after': 0,
+                         'value': (0, '')}
+        else:
+            req._data = {'property_type': actual, 'bytes_after': 0,
+                         'value': (fmt, value)}
+
+class XlibDisplayDummy:
+    atoms = {'WM_STATE': 100, 'WM_PROTOCOLS': 101, 'WM_DELETE_WINDOW': 102}
+
+    def __init__(self):
+        self.display = ServerDummy()
+
+    def get_atom(self, name):
+        return self.atoms[name]
+
+def card32(*values):
+    return (32, array.array('I', values))
+
+def wm_hints(flags = 0, icon_window = 0):
+    return (Xatom.WM_HINTS, ) + card32(flags, 1, 0, 0, icon_window,
+                                       0, 0, 0, 0)
+
+def wm_state(state):
+    return (XlibDisplayDummy.atoms['WM_STATE'], ) + card32(state, 0)
+
+
+class TestPropertyPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.display = XlibDisplayDummy()
+        self.server = self.display.display
+        self.window = self.server.add_window(10, {
+            Xatom.WM_CLASS: (Xatom.STRING, 8, 'xterm\0XTerm\0'),
+            Xatom.WM_NAME: (Xatom.STRING, 8, 'shell'),
+            101: (Xatom.ATOM, ) + card32(102),
+            100: wm_state(Xutil.IconicState),
+            })
+
+    def prefetch(self, props):
+        return wmanager.PropertyPrefetch(self.display, self.window, props)
+
+    def test_00_pipelined(self):
+        p = self.prefetch(((Xatom.WM_CLASS, Xatom.STRING, 64),
+                           (Xatom.WM_NAME, Xatom.STRING, 64),
+                           ('WM_PROTOCOLS', Xatom.ATOM, 32),
+                           (Xatom.WM_CLASS, Xatom.STRING, 64)))
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.server.round_trips, 0)
+
+        self.assertEqual(p.get_text(Xatom.WM_NAME), 'shell')
+        self.assertEqual(p.get_text(Xatom.WM_CLASS), 'xterm\0XTerm\0')
+        self.assertEqual(p.get_atoms('WM_PROTOCOLS'), [102])
+        self.assertEqual(self.server.round_trips, 1)
+
+    def test_01_struct(self):
+        p = self.prefetch((('WM_STATE', 'WM_STATE', 2),
+                           (Xatom.WM_HINTS, Xatom.WM_HINTS, 9)))
+        self.assertEqual(p.get_struct('WM_STATE', wmanager.icccm.WMState).state,
+                         Xutil.IconicState)
+        self.assertEqual(p.get_struct(Xatom.WM_HINTS, wmanager.icccm.WMHints),
+                         None)
+
+    def test_02_missing(self):
+        p = self.prefetch(((Xatom.WM_ICON_NAME, Xatom.STRING, 64),
+                           (Xatom.WM_NAME, Xatom.ATOM, 32),
+                           (Xatom.WM_TRANSIENT_FOR, Xatom.WINDOW, 1)))
+        self.assertEqual(p.get_property(Xatom.WM_ICON_NAME), None)
+        self.assertEqual(p.get_text(Xatom.WM_ICON_NAME), None)
+        self.assertEqual(p.get_atoms(Xatom.WM_NAME), [])
+        self.assertEqual(p.get_atoms(Xatom.WM_TRANSIENT_FOR), [])
+        self.assertEqual(self.server.round_trips, 1)
+
+    def test_03_bad_window(self):
+        w = drawable.Window(self.server, 99)
+        p = wmanager.PropertyPrefetch(self.display, w,
+                                      ((Xatom.WM_NAME, Xatom.STRING, 64), ))
+        self.assertRaises(error.BadWindow, p.get_text, Xatom.WM_NAME)
+
+    def test_04_client_properties(self):
+        class Mixin:
+            __client_prefetch__ = ((Xatom.WM_TRANSIENT_FOR, Xatom.WINDOW, 1), )
+
+        class MixinClient(wmanager.Client, Mixin):
+            pass
+
+        props = wmanager.client_prefetch_properties(MixinClient)
+        self.assertEqual(props[:len(wmanager.Client.__client_prefetch__)],
+                         list(wmanager.Client.__client_prefetch__))
+        self.assertEqual(props[-1], (Xatom.WM_TRANSIENT_FOR, Xatom.WINDOW, 1))
+
+        # The list is only collected once per class
+        self.assert_(wmanager.client_prefetch_properties(MixinClient)
+                     is props)
+
+
+class EventsDummy:
+    def __init__(self):
+        self.events = []
+
+    def put_event(self, event):
+        self.events.append(event)
+
+class CacheClient(wmanager.Client):
+    def __init__(self, screen, window):
+        self.screen = screen
+        self.wm = screen.wm
+        self.window = window
+        self.withdrawn = 0
+        self.mapped = 1
+        self.force_iconified = 0
+        self.delayed_moveresize = 0
+        self.res_name = 'xterm'
+        self.event_mask = event.EventMask(window)
+        self.property_cache = {}
+        self.filter_cache = {}
+
+
+class TestPropertyCache(unittest.TestCase):
+    def setUp(self):
+        wm = WindowManagerDummy()
+        wm.display = XlibDisplayDummy()
+        wm.events = EventsDummy()
+        wm.WM_STATE = XlibDisplayDummy.atoms['WM_STATE']
+        wm.property_cache_hits = 0
+        wm.property_cache_misses = 0
+
+        self.server = wm.display.display
+        screen = ScreenDummy(wm, self.server.add_window(ROOT))
+        screen.event_mask = event.EventMask(screen.root)
+        screen.client_index = wmanager.ClientIndex()
+
+        self.props = {Xatom.WM_NAME: (Xatom.STRING, 8, 'shell'),
+                      wm.WM_STATE: wm_state(Xutil.IconicState)}
+        self.client = CacheClient(screen, self.server.add_window(10, self.props))
+        self.wm = wm
+
+    def test_00_name_cached(self):
+        self.assertEqual(self.client.fetch_name(), 'shell')
+        trips = self.server.round_trips
+        self.assertEqual(self.client.get_title(), 'shell')
+        self.assertEqual(self.client.fetch_name(), 'shell')
+        self.assertEqual(self.server.round_trips, trips)
+        self.assertEqual(self.wm.property_cache_misses, 1)
+        self.assertEqual(self.wm.property_cache_hits, 2)
+
+    def test_01_invalidated(self):
+        self.assertEqual(self.client.fetch_name(), 'shell')
+        self.props[Xatom.WM_NAME] = (Xatom.STRING, 8, 'emacs')
+        self.assertEqual(self.client.fetch_name(), 'shell')
+
+        self.client.handle_property_notify(
+            XEventDummy(X.PropertyNotify, 10, atom = Xatom.WM_NAME))
+        self.assertEqual(self.client.fetch_name(), 'emacs')
+        self.assertEqual(self.wm.property_cache_misses, 2)
+
+        # Untitled clients fall back to their resource name
+        self.props[Xatom.WM_NAME] = (Xatom.STRING, 8, '')
+        self.client.handle_property_notify(
+            XEventDummy(X.PropertyNotify, 10, atom = Xatom.WM_NAME))
+        self.assertEqual(self.client.get_title(), 'xterm')
+
+    def test_02_wm_state(self):
+        self.assertEqual(self.client.get_wm_state(), Xutil.IconicState)
+        trips = self.server.round_trips
+
+        # The window manager's own changes keep the cache up to date
+        self.client.deiconify()
+        self.client.handle_property_notify(
+            XEventDummy(X.PropertyNotify, 10, atom = self.wm.WM_STATE))
+        self.assertEqual(self.client.get_wm_state(), Xutil.NormalState)
+        self.client.iconify()
+        self.assertEqual(self.client.get_wm_state(), Xutil.IconicState)
+        self.assertEqual(self.server.round_trips, trips)
+        self.assertEqual(self.wm.property_cache_misses, 1)
+
+        self.client.withdraw()
+        self.assertEqual(self.client.get_wm_state(), Xutil.WithdrawnState)
+        self.assertEqual(self.client.property_cache[self.wm.WM_STATE], None)
+
+    def test_03_bad_window(self):
+        del self.server.windows[10]
+        self.assertEqual(self.client.fetch_name(), None)
+        self.assertEqual(len(self.wm.events.events), 1)
+        self.assertEqual(self.client.property_cache, {})
+
+
+class TreeDummy:
+    def __init__(self, children):
+        self.children = children
+
+class RootWindowDummy:
+    def __init__(self, children):
+        self.children = children
+
+    def query_tree(self):
+        return TreeDummy(self.children)
+
+class InternalWindowDummy(wmanager.InternalWindow):
+    def __init__(self):
+        pass
+
+class ScanScreen(ScreenDummy):
+    number = 0
+
+    def __init__(self, display, windows):
+        wm = WindowManagerDummy()
+        wm.display = display
+        wm.client_class = wmanager.Client
+        ScreenDummy.__init__(self, wm, RootWindowDummy(windows))
+        self.added = []
+
+    def add_client(self, window, maprequest, prefetch = None):
+        self.added.append((window, prefetch))
+        return 1
+
+
+class TestScanClients(unittest.TestCase):
+    def test_00_scan(self):
+        display = XlibDisplayDummy()
+        server = display.display
+        wins = [server.add_window(10, {Xatom.WM_HINTS:
+                                       wm_hints(Xutil.IconWindowHint, 14)}),
+                server.add_window(11, {100: wm_state(Xutil.IconicState)},
+                                  map_state = X.IsUnmapped),
+                server.add_window(12, map_state = X.IsUnmapped),
+                server.add_window(13, override_redirect = 1),
+                server.add_window(14),
+                drawable.Window(server, 15),
+                server.add_window(16)]
+
+        s = ScanScreen(display, wins)
+        s.windows[wins[-1]] = InternalWindowDummy()
+        s.scan_clients()
+
+        # Icon, override-redirect, withdrawn, destroyed and internal
+        # windows are skipped
+        self.assertEqual([w.id for w, p in s.added], [10, 11])
+        self.assertEqual(s.stacking.windows, wins)
+
+        # All hints and attributes are fetched in one round trip, and
+        # the client properties are prefetched for all clients
+        self.assertEqual(server.round_trips, 1)
+        for w, p in s.added:
+            self.assertEqual(p.window, w)
+            p.get_text(Xatom.WM_NAME)
+        self.assertEqual(server.round_trips, 2)
+
+
+class TestStackingOrder(unittest.TestCase):
+    def setUp(self):
+        self.s = wmanager.StackingOrder(ROOT)
+        self.s.reset([10, 11, 12])
+
+    def test_00_create_destroy(self):
+        self.s.handle_event(XEventDummy(X.CreateNotify, 13, parent = ROOT))
+        self.assertEqual(self.s.windows, [10, 11, 12, 13])
+        self.s.handle_event(XEventDummy(X.DestroyNotify, 11, event = ROOT))
+        self.assertEqual(self.s.windows, [10, 12, 13])
+
+    def test_01_restack(self):
+        self.s.handle_event(XEventDummy(X.ConfigureNotify, 12, event = ROOT,
+                                        above_sibling = 10))
+        self.assertEqual(self.s.windows, [10, 12, 11])
+
+        # X.NONE puts the window lowest
+        self.s.handle_event(XEventDummy(X.ConfigureNotify, 11, event = ROOT,
+                                        above_sibling = X.NONE))
+        self.assertEqual(self.s.windows, [11, 10, 12])
+
+        # An unknown sibling puts the window on top
+        self.s.handle_event(XEventDummy(X.ConfigureNotify, 11, event = ROOT,
+                                        above_sibling = 99))
+        self.assertEqual(self.s.windows, [10, 12, 11])
+
+    def test_02_circulate(self):
+        self.s.handle_event(XEventDummy(X.CirculateNotify, 10, event = ROOT,
+                                        place = X.PlaceOnTop))
+        self.assertEqual(self.s.windows, [11, 12, 10])
+        self.s.handle_event(XEventDummy(X.CirculateNotify, 12, event = ROOT,
+                                        place = X.PlaceOnBottom))
+        self.assertEqual(self.s.windows, [12, 11, 10])
+
+    def test_03_reparent(self):
+        self.s.handle_event(XEventDummy(X.ReparentNotify, 11, event = ROOT,
+                                        parent = 12))
+        self.assertEqual(self.s.windows, [10, 12])
+        self.s.handle_event(XEventDummy(X.ReparentNotify, 11, event = ROOT,
+                                        parent = ROOT))
+        self.assertEqual(self.s.windows, [10, 12, 11])
+
+    def test_04_raise_lower(self):
+        self.s.raise_window(10)
+        self.assertEqual(self.s.windows, [11, 12, 10])
+        self.s.lower_window(12)
+        self.assertEqual(self.s.windows, [12, 11, 10])
+
+
+class TestStackingEvents(unittest.TestCase):
+    def setUp(self):
+        self.wm = WindowManagerDummy()
+        self.screen = ScreenDummy(self.wm, ROOT)
+        self.screen.stacking.reset([10, 11])
+        self.client = ClientDummy(self.screen, 11)
+
+    def test_00_root_only(self):
+        # Events reported on the window itself don't change the order
+        self.wm.handle_event(XEventDummy(X.ConfigureNotify, 11, event = 11,
+                                         above_sibling = X.NONE))
+        self.assertEqual(self.screen.stacking.windows, [10, 11])
+
+        self.wm.handle_event(XEventDummy(X.ConfigureNotify, 11, event = ROOT,
+                                         above_sibling = X.NONE))
+        self.assertEqual(self.screen.stacking.windows, [11, 10])
+
+    def test_01_root_copy_not_routed(self):
+        rec = Recorder(self.client.dispatch, X.ConfigureNotify, X.UnmapNotify)
+        for t in X.ConfigureNotify, X.UnmapNotify:
+            self.wm.handle_event(XEventDummy(t, 11, event = 11,
+                                             above_sibling = X.NONE))
+            self.wm.handle_event(XEventDummy(t, 11, event = ROOT,
+                                             above_sibling = X.NONE))
+
+        self.assertEqual([(e.type, e.event) for e in rec.events],
+                         [(X.ConfigureNotify, 11), (X.UnmapNotify, 11)])
+
+    def test_02_synthetic_routed(self):
+        # ICCCM withdrawal is a synthetic UnmapNotify sent to the root
+        rec = Recorder(self.client.dispatch, X.UnmapNotify)
+        evt = XEventDummy(X.UnmapNotify, 11, event = ROOT, send_event = 1)
+        self.wm.handle_event(evt)
+        self.assertEqual(rec.events, [evt])
+
+    def test_03_create_not_routed(self):
+        rec = Recorder(self.screen.dispatch, X.CreateNotify)
+        self.wm.handle_event(XEventDummy(X.CreateNotify, 12, parent = ROOT))
+        self.assertEqual(self.screen.stacking.windows, [10, 11, 12])
+        self.assertEqual(rec.events, [])
+
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        self.wm = WindowManagerDummy()
+        self.screen = ScreenDummy(self.wm, ROOT)
+        self.other = ScreenDummy(self.wm, 2)
+        self.client = ClientDummy(self.screen, 11)
+
+    def test_00_known(self):
+        crec = Recorder(self.client.dispatch, X.PropertyNotify)
+        srec = Recorder(self.screen.dispatch, X.PropertyNotify)
+        for w in 11, ROOT:
+            self.wm.handle_event(XEventDummy(X.PropertyNotify, w))
+        self.assertEqual([e.window for e in crec.events], [11])
+        self.assertEqual([e.window for e in srec.events], [11, ROOT])
+
+    def test_01_reported_on_root(self):
+        # The screen of an unknown window is found from the event
+        # without any round trips
+        rec = Recorder(self.other.dispatch, X.MapRequest, X.KeyPress)
+        w = XWindowDummy(2)
+        self.wm.handle_event(XEventDummy(X.MapRequest, w, parent = 2))
+        self.wm.handle_event(XEventDummy(X.KeyPress, w, root = 2))
+        self.assertEqual([e.type for e in rec.events],
+                         [X.MapRequest, X.KeyPress])
+        self.assertEqual(w.geometry_requests, 0)
+        self.assertEqual(self.wm.unknown_windows, {})
+
+    def test_02_unknown_cached(self):
+        rec = Recorder(self.other.dispatch, X.PropertyNotify)
+        w = XWindowDummy(2)
+        self.wm.handle_event(XEventDummy(X.PropertyNotify, w))
+        self.wm.handle_event(XEventDummy(X.PropertyNotify, w))
+        self.assertEqual(len(rec.events), 2)
+        self.assertEqual(w.geometry_requests, 1)
+
+        # The cache is cleared when the window is destroyed, and the
+        # destroyed window isn't asked for its root
+        self.wm.handle_event(XEventDummy(X.DestroyNotify, w, event = w))
+        self.assertEqual(self.wm.unknown_windows, {})
+        self.assertEqual(w.geometry_requests, 1)
+
+
+class IndexClient(wmanager.Client):
+    def __init__(self, x, y, width, height, border_width = 0, mapped = 1):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.border_width = border_width
+        self.mapped = mapped
+        self.withdrawn = 0
+        self.window = None
+
+    def edge(self, name):
+        return getattr(self, 'get_%s_edge' % name)()
+
+def brute_force_nearest(clients, edge, pos, after, accept):
+    found = []
+    for c in clients:
+        if not c.mapped or not accept(c):
+            continue
+        p = c.edge(edge)
+        if pos is not None and ((after and p <= pos)
+                                or (not after and p >= pos)):
+            continue
+        if found:
+            best = found[0].edge(edge)
+            if (after and p > best) or (not after and p < best):
+                continue
+            if p != best:
+                found = []
+        found.append(c)
+    return found
+
+def sorted_ids(clients):
+    ids = map(id, clients)
+    ids.sort()
+    return ids
+
+
+class TestClientIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = wmanager.ClientIndex()
+        self.a = IndexClient(0, 0, 100, 100, 1)
+        self.b = IndexClient(200, 50, 300, 300)
+        self.c = IndexClient(400, 0, 50, 50, mapped = 0)
+        for c in self.a, self.b, self.c:
+            self.index.add(c)
+
+    def test_00_clients_at(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.clients_at(0, 0), [self.a])
+
+        # The border is included, but not the far edge
+        self.assertEqual(self.index.clients_at(101, 101), [self.a])
+        self.assertEqual(self.index.clients_at(102, 50), [])
+
+        # Unmapped clients aren't found
+        self.assertEqual(self.index.clients_at(420, 60), [self.b])
+        self.assertEqual(self.index.clients_at(420, 10), [])
+
+    def test_01_update(self):
+        self.a.x = 250
+        self.index.update(self.a)
+        self.assertEqual(sorted_ids(self.index.clients_at(300, 60)),
+                         sorted_ids([self.a, self.b]))
+        self.assertEqual(self.index.clients_at(10, 10), [])
+
+        self.c.mapped = 1
+        self.index.update(self.c)
+        self.assertEqual(self.index.clients_at(420, 10), [self.c])
+
+        self.index.remove(self.c)
+        self.index.remove(self.c)
+        self.assertEqual(self.index.clients_at(420, 10), [])
+        self.assertEqual(len(self.index), 2)
+
+        # Clients not in the index are ignored
+        self.index.update(self.c)
+        self.assertEqual(self.index.clients_at(420, 10), [])
+
+    def test_02_nearest(self):
+        accept = lambda c: 1
+        self.assertEqual(self.index.nearest('left', 0, 1, accept), [self.b])
+        self.assertEqual(self.index.nearest('left', 200, 1, accept), [])
+        self.assertEqual(self.index.nearest('right', 500, 0, accept),
+                         [self.a])
+        self.assertEqual(self.index.nearest('right', 501, 0, accept),
+                         [self.b])
+        self.assertEqual(self.index.nearest('top', None, 1, accept),
+                         [self.a])
+        self.assertEqual(self.index.nearest('bottom', None, 0, accept),
+                         [self.b])
+        self.assertEqual(self.index.nearest('left', 0, 1,
+                                            lambda c, b = self.b: c is not b),
+                         [])
+
+    def test_10_random(self):
+        rand = random.Random(4711)
+        self.index = wmanager.ClientIndex()
+        clients = []
+        for i in range(30):
+            c = IndexClient(rand.randrange(0, 1000), rand.randrange(0, 1000),
+                            rand.randrange(1, 400), rand.randrange(1, 400),
+                            rand.randrange(3), rand.randrange(4) > 0)
+            clients.append(c)
+            self.index.add(c)
+
+        for i in range(300):
+            c = rand.choice(clients)
+            c.x = rand.randrange(0, 1000)
+            c.y = rand.randrange(0, 1000)
+            c.mapped = rand.randrange(4) > 0
+            self.index.update(c)
+
+            x = rand.randrange(0, 1500)
+            y = rand.randrange(0, 1500)
+            inside = []
+            for c in clients:
+                if c.mapped and c.x <= x < c.edge('right') \
+                   and c.y <= y < c.edge('bottom'):
+                    inside.append(c)
+            self.assertEqual(sorted_ids(self.index.clients_at(x, y)),
+                             sorted_ids(inside))
+
+            edge = rand.choice(wmanager.ClientIndex.edge_names)
+            pos = rand.choice([None, rand.randrange(0, 1500)])
+            after = rand.randrange(2)
+            accept = lambda c, r = rand.randrange(1, 4): id(c) % r == 0
+            self.assertEqual(
+                sorted_ids(self.index.nearest(edge, pos, after, accept)),
+                sorted_ids(brute_force_nearest(clients, edge, pos, after,
+                                               accept)))
+
+
+class InnerDisplayDummy:
+    request_serial = 0
+
+class DisplayDummy:
+    def __init__(self):
+        self.display = InnerDisplayDummy()
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes = self.flushes + 1
+
+    def sync(self):
+        pass
+
+class BatchEvent:
+    def __init__(self, type = None, fail = 0):
+        self.type = type
+        self.fail = fail
+
+class BatchWindowManager(WindowManagerDummy):
+    def __init__(self, batches):
+        WindowManagerDummy.__init__(self)
+        self.display = DisplayDummy()
+        self.in_batch = 0
+        self.batch_start_serial = 0
+        self.batch_count = 0
+        self.batch_request_count = 0
+        self.batch_flush_count = 0
+        self.batch_callbacks = []
+
+        self.batches = batches
+        self.handled = []
+
+    def next_event_batch(self):
+        if not self.batches:
+            raise KeyboardInterrupt()
+        return self.batches.pop(0)
+
+    def handle_event(self, event):
+        self.handled.append((event, self.in_batch))
+        self.flush()
+        if event.fail:
+            raise ValueError('failing handler')
+
+
+class TimerWindowManager(BatchWindowManager):
+    handle_event = wmanager.WindowManager.handle_event
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+
+    def test_00_batch(self):
+        events = [BatchEvent(), BatchEvent()]
+        wm = BatchWindowManager([events])
+        called = []
+        wm.after_batch(lambda: called.append(1))
+        self.assertEqual(called, [1])
+
+        def handle_event(evt, wm = wm, called = called):
+            called.append('event')
+            wm.after_batch(lambda: called.append('after'))
+
+        # The callbacks are called when the batch has been handled
+        wm.handle_event = handle_event
+        self.assertRaises(KeyboardInterrupt, wm.brave_loop)
+        self.assertEqual(called, [1, 'event', 'event', 'after', 'after'])
+        self.assertEqual(wm.in_batch, 0)
+        self.assertEqual(wm.batch_count, 1)
+
+    def test_01_one_flush(self):
+        events = [BatchEvent(), BatchEvent(), BatchEvent()]
+        wm = BatchWindowManager([events, [BatchEvent()]])
+        self.assertRaises(KeyboardInterrupt, wm.brave_loop)
+        self.assertEqual([b for e, b in wm.handled], [1, 1, 1, 1])
+        self.assertEqual(wm.display.flushes, 2)
+        self.assertEqual(wm.batch_count, 2)
+
+    def test_02_handler_fails(self):
+        events = [BatchEvent(), BatchEvent(fail = 1), BatchEvent()]
+        wm = BatchWindowManager([events])
+        self.assertRaises(KeyboardInterrupt, wm.brave_loop)
+
+        # The failed batch is ended, and the rest of the events
+        # handled in a new one
+        self.assertEqual([(e, b) for e, b in wm.handled],
+                         [(events[0], 1), (events[1], 1), (events[2], 1)])
+        self.assertEqual(wm.in_batch, 0)
+        self.assertEqual(wm.batch_count, 2)
+        self.assertEqual(wm.display.flushes, 2)
+        self.assert_(sys.stderr.getvalue().find('failing handler') >= 0)
+
+    def test_03_too_many_failures(self):
+        wm = BatchWindowManager([[BatchEvent(fail = 1)] * 3])
+        self.assertRaises(ValueError, wm.brave_loop, 1)
+        self.assertEqual(wm.in_batch, 0)
+
+    def test_04_callback_fails(self):
+        wm = BatchWindowManager([])
+        called = []
+
+        def fail():
+            called.append('fail')
+            raise ValueError('failing callback')
+
+        wm.begin_batch()
+        wm.after_batch(fail)
+        wm.after_batch(lambda: called.append('after'))
+
+        # The other callbacks are still called, and the batch ended
+        self.assertRaises(ValueError, wm.end_batch)
+        self.assertEqual(called, ['fail', 'after'])
+        self.assertEqual(wm.in_batch, 0)
+        self.assertEqual(wm.batch_callbacks, [])
+        self.assertEqual(wm.display.flushes, 1)
+
+    def test_05_quit(self):
+        events = [BatchEvent(wmevents.QuitWindowManager), BatchEvent()]
+        wm = BatchWindowManager([events])
+        wm.brave_loop()
+        self.assertEqual(len(wm.handled), 1)
+        self.assertEqual(wm.in_batch, 0)
+
+        wm = BatchWindowManager([events])
+        wm.loop()
+        self.assertEqual(len(wm.handled), 1)
+        self.assertEqual(wm.in_batch, 0)
+
+    def test_06_cancelled_timer(self):
+        timer_type = event.new_event_type()
+        timer = event.TimerEvent(timer_type, after = 0)
+        cancel = BatchEvent(event.new_event_type())
+        wm = TimerWindowManager([[cancel, timer]])
+        wm.dispatch.add_handler(cancel.type, lambda evt, t = timer: t.cancel())
+        rec = Recorder(wm.dispatch, timer_type)
+
+        # The timer was fetched before the first event in the batch
+        # cancelled it
+        self.assertRaises(KeyboardInterrupt, wm.brave_loop)
+        self.assertEqual(rec.events, [])
+
+        timer = event.TimerEvent(timer_type, after = 0)
+        wm.handle_event(timer)
+        self.assertEqual(rec.events, [timer])
+
+
+class TestTopLevelWindow(unittest.TestCase):
+    def setUp(self):
+        self.wm = WindowManagerDummy()
+        self.screen = ScreenDummy(self.wm, ROOT)
+
+    def test_00_proxy(self):
+        s = self.screen
+        self.assertEqual(s.top_level_window(11), 11)
+
+        s.add_proxy_window(20, 11)
+        self.assertEqual(s.top_level_window(11), 20)
+
+        # Proxies can be nested
+        s.add_proxy_window(30, 20)
+        self.assertEqual(s.top_level_window(11), 30)
+        self.assertEqual(s.top_level_window(20), 30)
+
+        s.remove_proxy_window(30)
+        self.assertEqual(s.top_level_window(11), 20)
+        s.remove_proxy_window(20)
+        self.assertEqual(s.top_level_window(11), 11)
+        self.assertEqual(s.proxied_windows, {})
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "cd ../test; python test_wmanager.py"
+# End: